@@ -0,0 +1,938 @@
+"""
+Benchmarks for the recommendation pipeline, on synthetic data in the exact
+structure init_data reads (what snapshot.py writes).
+
+    python benchmark.py generate --scale 100k --out bench_data/100k.json
+    python benchmark.py run --scale 1k                        # generates bench_data/1k.json if missing
+    python benchmark.py run --data data.json --save baseline.json
+    python benchmark.py run --scale 100k --compare baseline.json --tolerance 0.25
+    python benchmark.py occasion --products 1000 10000 100000 --max-ratio 3
+    python benchmark.py history --orders 10 1000 20000 --max-ratio 3
+    python benchmark.py binary --scale 100k --workers 4
+    python benchmark.py serve --scale 100k --workers 1 2 4 8 --duration 20
+    python benchmark.py cf --users 100000 --orders 300000 --budget 30 --max-mb 512
+    python benchmark.py check --scale 1k
+
+`run` times load_data, rec_user_his, rec_user_best_selling, rec_user_occasion,
+rec_user_converter and GET /api/v1/recommend/<user_id> (plain and with
+?expand=product) through the Flask test client. It reports p50/p95/p99, load memory, and threaded vs sequential
+throughput, checking that threaded results match the sequential ones.
+--save writes the report as JSON. --compare exits with status 1 when a p95
+(or the load time) is more than --tolerance slower than that baseline.
+
+`occasion` times rec_user_occasion on catalogs of each --products size. The
+occasion pools are built at load time, so the cost should not grow with the
+catalog; it exits with status 1 when the largest catalog's p50 is more than
+--max-ratio times the smallest one's.
+
+`history` times the history recommender for users with more and more orders.
+Order rows are pre-sorted per user at load time, so the cost should not grow
+with the user's order count; it exits with status 1 when the heaviest user is
+more than --max-ratio times slower than the lightest one.
+
+`binary` converts a JSON dataset to a binary snapshot (<dataset>.bin) and
+loads each format in --workers freshly spawned processes, all alive at the
+same time like server workers. It reports per-worker load time, peak RSS, and
+RSS/PSS/private memory (PSS and private need Linux /proc), and exits with
+status 1 unless every worker returns the same recommendations.
+
+`serve` is a load test of rec_prefork.py: for each --workers count it starts
+the pre-fork server on the dataset, checks a few responses against the
+recommenders, then has --clients processes with --connections keep-alive
+connections each send GET /api/v1/recommend/<user_id> for --duration seconds.
+It reports requests/s, latency and the speedup over the first count, plus the
+workers' memory (PSS shows how much of the snapshot they share). The result
+cache is off unless --cache, so every request is computed. Clients run on the
+same host and take CPU from the server: give them spare cores, or expect the
+scaling to flatten early. Exits with status 1 on any error or mismatch.
+
+`cf` builds the item-item neighbour index (recommendation.ItemNeighbors) for
+--users buyers placing --orders orders, under --budget seconds and --max-mb,
+and times rec_user_similar. It reports build time, traced peak memory against
+the build's own estimate, index size and request latency, and exits with
+status 1 if the budget stopped the build early.
+
+`check` runs consistency checks between paths that must agree, and exits with
+status 1 if any fails:
+    - precomputed: bodies and ETags served from a precompute.py store are
+      byte-identical to the live path's (plain and ?expand=product)
+    - concurrency: GET /api/v1/recommend/<user_id> sent from many threads at
+      once through the Flask test client returns what it returns sequentially
+    - delta: an older copy of the dataset brought up to date by apply_delta
+      gives the same order histories and recommendations as a full load
+    - his_engines: REC_HIS_ENGINE=numpy picks the same history products as the
+      loop engine, also after stock changes (skipped without numpy)
+"""
+import argparse
+import contextlib
+import hashlib
+import http.client
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from pathlib import Path
+
+import recommendation as rec
+
+SCALES = {"1k": 1_000, "100k": 100_000, "1m": 1_000_000}
+COLORS = ["Red Flowers", "Pink Flowers", "White Flowers", "Yellow Flowers",
+          "Purple Flowers", "Orange Flowers", "Blue Flowers"]
+FLOWER_TYPES = ["Roses", "Tulips", "Lilies", "Orchids", "Daisies", "Carnations"]
+# fixed "today" for occasion timings: Christmas is the upcoming event
+OCCASION_NOW = datetime(2026, 12, 20)
+
+
+############# Synthetic data
+
+def _object_id(r):
+    return f"{r.getrandbits(96):024x}"
+
+def generate_products(n_products, r):
+    occasions = list(rec.events) + ["Birthday", "Wedding", "Sympathy", "Just Because"]
+    return [{
+        "product_id": _object_id(r),
+        "type": "flower",
+        "name": f"Bouquet {i}",
+        "price": round(r.uniform(5, 80), 2),
+        "stock": r.choice([0, 3, 10, 10, 25]),
+        "available": r.random() < 0.9,
+        "description": "Synthetic benchmark product.",
+        "image_url": [f"bouquet_{i}"],
+        "flower_details": {
+            "occasion": r.sample(occasions, r.randint(0, 3)),
+            "color": r.sample(COLORS, r.randint(1, 3)),
+            "flower_type": ", ".join(r.sample(FLOWER_TYPES, r.randint(1, 2))),
+            "options": [],
+        },
+    } for i in range(n_products)]
+
+def generate_dataset(n_orders, n_products=10_000, n_users=None, seed=0):
+    '''
+    Dataset dict {carts, products, orders, order_items} like snapshot.py writes.
+    Users and products are skewed (a few heavy users and best sellers), dates
+    span the last two years and each order has 1-4 lines.
+    '''
+    r = random.Random(seed)
+    n_users = n_users or max(10, n_orders // 5)
+    products = generate_products(n_products, r)
+    product_ids = [p["product_id"] for p in products]
+    users = [_object_id(r) for _ in range(n_users)]
+    first_day = date.today() - timedelta(days=730)
+
+    def pick(items):
+        # squared uniform: low indices are picked far more often
+        return items[int(len(items) * r.random() ** 2)]
+
+    orders, order_items = [], []
+    for _ in range(n_orders):
+        order_id = _object_id(r)
+        lines = []
+        for _ in range(r.randint(1, 4)):
+            quantity = r.randint(1, 3)
+            price = round(r.uniform(5, 80), 2)
+            lines.append({"product_id": pick(product_ids), "option": {}, "price": price,
+                          "quantity": quantity, "off_price": 0})
+        orders.append({
+            "order_id": order_id,
+            "user_id": pick(users),
+            "order_date": (first_day + timedelta(days=r.randrange(730))).isoformat(),
+            "shipping_address": "1 Synthetic Street",
+            "total_amount": round(sum(l["price"] * l["quantity"] for l in lines), 2),
+            "off_price": 0,
+            "status": r.choice(["Done", "Done", "Required", "Shipping"]),
+        })
+        order_items.append({"order_id": order_id, "products": lines})
+
+    carts = [{"user_id": u, "products": [{"product_id": pick(product_ids), "quantity": 1}
+                                         for _ in range(r.randint(0, 3))]}
+             for u in users if r.random() < 0.6]
+    return {"carts": carts, "products": products, "orders": orders, "order_items": order_items}
+
+def write_dataset(path, n_orders, n_products=10_000, seed=0):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    data = generate_dataset(n_orders, n_products, seed=seed)
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+    return path
+
+def heavy_user_snapshot(order_counts, n_products=200, lines=3, seed=0):
+    '''
+    Snapshot with one user per entry of order_counts ("heavy<n>" has n orders)
+    over a catalog of n_products flowers.
+    '''
+    r = random.Random(seed)
+    products = [{
+        "product_id": f"p{i:05d}", "type": "flower", "name": f"P{i}", "price": 10.0,
+        "stock": 10, "available": True,
+        "flower_details": {"flower_type": r.choice(FLOWER_TYPES), "color": r.sample(COLORS, 2), "occasion": []},
+    } for i in range(n_products)]
+
+    orders, order_items = [], []
+    first_day = date(2020, 1, 1)
+    for n in order_counts:
+        for k in range(n):
+            order_id = f"heavy{n}-{k}"
+            orders.append({"order_id": order_id, "user_id": f"heavy{n}",
+                           "order_date": (first_day + timedelta(days=r.randrange(2000))).isoformat()})
+            order_items.append({"order_id": order_id, "products": [
+                {"product_id": f"p{r.randrange(n_products):05d}", "option": {}, "price": 10.0, "quantity": 1}
+                for _ in range(lines)]})
+    return rec.Snapshot(rec.OrderStore(orders, order_items), products, [])
+
+
+############# Timing
+
+def percentiles(samples):
+    '''p50/p95/p99/mean of per-call seconds, in microseconds (nearest rank).'''
+    ordered = sorted(samples)
+    if not ordered:
+        return {"n": 0}
+    def rank(q):
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1e6
+    return {"n": len(ordered), "p50": rank(0.50), "p95": rank(0.95), "p99": rank(0.99),
+            "mean": sum(ordered) / len(ordered) * 1e6}
+
+def _timed_calls(fn, args_list):
+    samples = []
+    clock = time.perf_counter
+    for args in args_list:
+        started = clock()
+        fn(*args)
+        samples.append(clock() - started)
+    return samples
+
+def _per_call(fn, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - started) / repeat
+
+def sample_users(snap, n, seed=0):
+    users = sorted(set(snap.orders.orders_by_user) | set(snap.cart_by_user))
+    r = random.Random(seed)
+    return [r.choice(users) for _ in range(n)] if users else []
+
+def bench_concurrency(snap, user_ids, threads):
+    '''Throughput of rec_user_converter sequentially vs from `threads` threads, and whether results agree.'''
+    started = time.perf_counter()
+    expected = [rec.rec_user_converter(u, snap=snap) for u in user_ids]
+    sequential = time.perf_counter() - started
+
+    start_gate = threading.Barrier(threads)
+    def work(chunk):
+        start_gate.wait()
+        return [rec.rec_user_converter(u, snap=snap) for u in chunk]
+
+    chunks = [user_ids[i::threads] for i in range(threads)]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        results = list(pool.map(work, chunks))
+    threaded = time.perf_counter() - started
+
+    mismatches = sum(got != expected[i * threads + t]
+                     for t, chunk_results in enumerate(results)
+                     for i, got in enumerate(chunk_results))
+    return {
+        "threads": threads,
+        "calls": len(user_ids),
+        "sequential_per_s": len(user_ids) / sequential if sequential else 0.0,
+        "threaded_per_s": len(user_ids) / threaded if threaded else 0.0,
+        "mismatches": mismatches,
+    }
+
+def bench_flask(data_path, user_ids):
+    '''Uncached and cached GET /api/v1/recommend/<user_id> (plain and ?expand=product) through the Flask test client.'''
+    os.environ["REC_DATA_PATH"] = str(data_path)
+    os.environ.setdefault("REC_LOG_LEVEL", "WARNING")  # keep sampled request logs out of the timings
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        import rec_sever  # loads REC_DATA_PATH on import
+        client = rec_sever.app.test_client()
+        cache_size = rec_sever.result_cache.max_size
+        rec_sever.result_cache.max_size = 0
+        uncached = _timed_calls(lambda u: client.get(f"/api/v1/recommend/{u}"), [(u,) for u in user_ids])
+        rec_sever.result_cache.max_size = cache_size
+        for u in user_ids:
+            client.get(f"/api/v1/recommend/{u}")
+        cached = _timed_calls(lambda u: client.get(f"/api/v1/recommend/{u}"), [(u,) for u in user_ids])
+        for u in user_ids:
+            client.get(f"/api/v1/recommend/{u}?expand=product")
+        cached_expand = _timed_calls(lambda u: client.get(f"/api/v1/recommend/{u}?expand=product"), [(u,) for u in user_ids])
+    return {"flask_uncached": percentiles(uncached), "flask_cached": percentiles(cached),
+            "flask_cached_expand": percentiles(cached_expand)}
+
+def run_suite(data_path, samples=2000, threads=8, trace_memory=False, flask=True):
+    '''Time the pipeline on data_path; returns the report dict (see module docstring).'''
+    stats = rec.load_data(data_path, trace_memory=trace_memory)
+    snap = rec.current_snapshot()
+    users = sample_users(snap, samples)
+
+    latency = {
+        "rec_user_his": _timed_calls(lambda u: rec.rec_user_his(u, snap, 3, set()), [(u,) for u in users]),
+        "rec_user_best_selling": _timed_calls(lambda u: rec.rec_user_best_selling(u, snap, set()), [(u,) for u in users]),
+        "rec_user_occasion": _timed_calls(lambda: rec.rec_user_occasion(snap, set(), OCCASION_NOW), [()] * len(users)),
+        "rec_user_converter": _timed_calls(lambda u: rec.rec_user_converter(u, snap=snap), [(u,) for u in users]),
+    }
+    report = {
+        "meta": {
+            "data_path": str(data_path),
+            "python": platform.python_version(),
+            "his_engine": rec.HIS_ENGINE,
+            "created_at": time.time(),
+        },
+        "counts": {key: stats[key] for key in ("orders", "order_lines", "products", "carts")},
+        "load": {
+            "seconds": stats["seconds"],
+            "peak_rss_kb": stats["peak_rss_kb"],
+            "traced_peak_kb": stats.get("traced_peak_kb"),
+        },
+        "latency_us": {name: percentiles(s) for name, s in latency.items()},
+        "concurrency": bench_concurrency(snap, users[:min(len(users), 1000)], threads),
+    }
+    if flask:
+        report["latency_us"].update(bench_flask(data_path, users[:min(len(users), 1000)]))
+    return report
+
+def compare(report, baseline, tolerance=0.25):
+    '''Regressions against a saved report: (metric, baseline, current) where current is > (1 + tolerance) x baseline.'''
+    regressions = []
+    for name, current in report["latency_us"].items():
+        before = baseline.get("latency_us", {}).get(name, {}).get("p95")
+        if before and current.get("p95", 0) > before * (1 + tolerance):
+            regressions.append((f"{name} p95 us", before, current["p95"]))
+    before = baseline.get("load", {}).get("seconds")
+    if before and report["load"]["seconds"] > before * (1 + tolerance):
+        regressions.append(("load seconds", before, report["load"]["seconds"]))
+    return regressions
+
+def print_report(report):
+    counts = report["counts"]
+    load = report["load"]
+    print(f"[Bench] {report['meta']['data_path']}: {counts['orders']} orders, {counts['order_lines']} lines, "
+          f"{counts['products']} products, {counts['carts']} carts")
+    traced = f", traced peak {load['traced_peak_kb'] // 1024} MiB" if load.get("traced_peak_kb") else ""
+    print(f"[Bench] load_data {load['seconds']:.2f}s, peak RSS {(load['peak_rss_kb'] or 0) // 1024} MiB{traced}")
+    for name, p in report["latency_us"].items():
+        print(f"[Bench] {name:<22} p50 {p['p50']:9.1f} us  p95 {p['p95']:9.1f} us  p99 {p['p99']:9.1f} us  (n={p['n']})")
+    c = report["concurrency"]
+    print(f"[Bench] rec_user_converter x{c['calls']}: {c['sequential_per_s']:,.0f}/s sequential, "
+          f"{c['threaded_per_s']:,.0f}/s with {c['threads']} threads, {c['mismatches']} mismatches")
+
+def bench_occasion(catalog_sizes, repeat=5000, seed=0):
+    '''p50/p95/p99 of rec_user_occasion per catalog size, with nothing and with 3 products already recommended.'''
+    results = {}
+    for n in catalog_sizes:
+        snap = rec.Snapshot(rec.OrderStore(), generate_products(n, random.Random(seed)), [])
+        event = rec.get_nearest_upcoming_event(OCCASION_NOW)
+        taken = {p["product_id"] for p in itertools.islice(snap.products_by_occasion.get(event, []), 3)}
+        results[n] = {
+            "empty": percentiles(_timed_calls(lambda: rec.rec_user_occasion(snap, set(), OCCASION_NOW), [()] * repeat)),
+            "3_taken": percentiles(_timed_calls(lambda: rec.rec_user_occasion(snap, set(taken), OCCASION_NOW), [()] * repeat)),
+        }
+    return results
+
+def bench_history(order_counts, top_k=3, repeat=2000):
+    '''Seconds per call of get_orders_from_user and rec_user_his, per order count.'''
+    snap = heavy_user_snapshot(order_counts)
+    results = {}
+    for n in order_counts:
+        user_id = f"heavy{n}"
+        results[n] = {
+            'latest_orders': _per_call(lambda: rec.get_orders_from_user(user_id, snap, top_k), repeat),
+            'rec_user_his': _per_call(lambda: rec.rec_user_his(user_id, snap, top_k, set()), repeat),
+        }
+    return results
+
+
+############# Binary snapshot
+
+def _snapshot_worker(data_path, user_ids, conn):
+    # one server worker: load, answer for user_ids, then stay alive until the parent has read its memory
+    stats = rec.load_data(data_path)
+    results = [rec.rec_user_converter(u) for u in user_ids]
+    conn.send({"mode": stats["mode"], "seconds": stats["seconds"], "peak_rss_kb": stats["peak_rss_kb"],
+               "digest": hashlib.sha1(json.dumps(results, sort_keys=True).encode("utf-8")).hexdigest()})
+    conn.recv()
+
+def _memory_kb(pid):
+    '''
+    Peak RSS, RSS, PSS and private (unshared) memory of a process in kB, from
+    /proc (Linux); {} without it. The peak comes from VmHWM rather than
+    ru_maxrss, which a spawned child inherits from its parent across exec.
+    '''
+    fields = {"VmHWM": "peak_rss_kb", "Rss": "rss_kb", "Pss": "pss_kb", "Private_Clean": "private_kb", "Private_Dirty": "private_kb"}
+    memory = {}
+    for name in ("status", "smaps_rollup"):
+        try:
+            with open(f"/proc/{pid}/{name}", "r") as f:
+                lines = f.read().splitlines()
+        except OSError:
+            return {}
+        for line in lines:
+            key, _, value = line.partition(":")
+            if key in fields:
+                memory[fields[key]] = memory.get(fields[key], 0) + int(value.split()[0])
+    return memory
+
+def bench_binary(json_path, workers=4, n_users=200):
+    '''Per-worker load time and memory of json_path vs its binary conversion (see module docstring).'''
+    bin_path = os.path.splitext(json_path)[0] + ".bin"
+    started = time.perf_counter()
+    snap = rec.build_snapshot(json_path)
+    rec.write_binary_snapshot(snap, bin_path)
+    report = {
+        "convert_seconds": time.perf_counter() - started,
+        "size_bytes": {"json": os.path.getsize(json_path), "binary": os.path.getsize(bin_path)},
+    }
+    users = sample_users(snap, n_users)
+    del snap
+
+    # spawn, not fork: each worker imports and loads on its own, sharing nothing but the OS page cache
+    ctx = multiprocessing.get_context("spawn")
+    for fmt, path in (("json", json_path), ("binary", bin_path)):
+        conns, procs = [], []
+        for _ in range(workers):
+            parent, child = ctx.Pipe()
+            proc = ctx.Process(target=_snapshot_worker, args=(path, users, child))
+            proc.start()
+            conns.append(parent)
+            procs.append(proc)
+        loaded = [conn.recv() for conn in conns]
+        memory = [_memory_kb(proc.pid) for proc in procs]  # every worker is loaded and alive here
+        for conn in conns:
+            conn.send(None)
+        for proc in procs:
+            proc.join()
+        report[fmt] = [{**stats, **mem} for stats, mem in zip(loaded, memory)]
+    report["results_match"] = len({w["digest"] for fmt in ("json", "binary") for w in report[fmt]}) == 1
+    return report
+
+def print_binary_report(report):
+    size = report["size_bytes"]
+    print(f"[Bench] converted in {report['convert_seconds']:.2f}s: JSON {size['json'] / 2**20:.1f} MiB -> "
+          f"binary {size['binary'] / 2**20:.1f} MiB")
+    for fmt in ("json", "binary"):
+        workers = report[fmt]
+        def mean_mib(key):
+            values = [w[key] for w in workers if w.get(key) is not None]
+            return f"{sum(values) / len(values) / 1024:7.1f} MiB" if values else "    n/a"
+        load = sorted(w["seconds"] for w in workers)
+        print(f"[Bench] {fmt:<6} x{len(workers)} workers: load p50 {load[len(load) // 2]:.2f}s max {load[-1]:.2f}s | per worker: "
+              f"peak RSS {mean_mib('peak_rss_kb')}, RSS {mean_mib('rss_kb')}, PSS {mean_mib('pss_kb')}, private {mean_mib('private_kb')}")
+    print(f"[Bench] recommendations identical across formats and workers: {report['results_match']}")
+
+############# Pre-fork serving
+
+def default_cpus():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # not on Linux
+        return os.cpu_count() or 1
+
+def _load_client(port, paths, duration, connections, conn):
+    # one load-generating process: `connections` keep-alive clients cycling through paths
+    latencies, errors = [], []
+    deadline = time.perf_counter() + duration
+
+    def client(offset):
+        connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        i = offset
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                connection.request("GET", paths[i % len(paths)])
+                resp = connection.getresponse()
+                resp.read()
+                ok = resp.status == 200
+            except (OSError, http.client.HTTPException):
+                ok = False
+                connection.close()
+            if ok:
+                latencies.append(time.perf_counter() - started)
+            else:
+                errors.append(i)
+            i += 1
+        connection.close()
+
+    threads = [threading.Thread(target=client, args=(k * 7919,)) for k in range(connections)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    conn.send({"latencies": latencies, "errors": len(errors)})
+
+def _children(pid):
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children", "r") as f:
+            return [int(p) for p in f.read().split()]
+    except OSError:
+        return []
+
+def _wait_ready(port, proc, timeout=300):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"rec_prefork.py exited with status {proc.returncode}")
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/healthz", timeout=1).read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"rec_prefork.py not ready after {timeout}s")
+
+def bench_serve(data_path, worker_counts, duration=10.0, clients=None, connections=8, n_users=2000, cache=False):
+    '''Throughput of rec_prefork.py for each worker count (see module docstring).'''
+    snap = rec.build_snapshot(data_path)
+    users = sample_users(snap, n_users)
+    expected = {u: list(rec.rec_user_converter(u, 3, snap)) for u in users[:50]}
+    del snap
+    paths = [f"/api/v1/recommend/{u}" for u in users]
+    clients = clients or default_cpus()
+    env = {**os.environ, "REC_DATA_PATH": str(data_path), "REC_LOG_LEVEL": "WARNING", "REC_LOG_SAMPLE_RATE": "0"}
+    if not cache:
+        env["REC_CACHE_SIZE"] = "0"
+    ctx = multiprocessing.get_context("spawn")
+
+    report = {"clients": clients, "connections": connections, "duration": duration, "runs": []}
+    for workers in worker_counts:
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        server = subprocess.Popen(
+            [sys.executable, str(Path(__file__).resolve().parent / "rec_prefork.py"),
+             "--host", "127.0.0.1", "--port", str(port), "--workers", str(workers)], env=env)
+        try:
+            _wait_ready(port, server)
+            mismatches = sum(
+                json.loads(urllib.request.urlopen(f"http://127.0.0.1:{port}/api/v1/recommend/{u}").read()) != want
+                for u, want in expected.items())
+            conns, procs = [], []
+            for k in range(clients):
+                parent, child = ctx.Pipe()
+                proc = ctx.Process(target=_load_client, args=(port, paths[k::clients] or paths, duration, connections, child))
+                proc.start()
+                conns.append(parent)
+                procs.append(proc)
+            results = [conn.recv() for conn in conns]
+            for proc in procs:
+                proc.join()
+            memory = [_memory_kb(pid) for pid in _children(server.pid)]
+        finally:
+            server.send_signal(signal.SIGTERM)
+            server.wait(timeout=120)
+        latencies = [x for res in results for x in res["latencies"]]
+        report["runs"].append({
+            "workers": workers,
+            "requests_per_s": len(latencies) / duration,
+            "latency": percentiles(latencies),
+            "errors": sum(res["errors"] for res in results),
+            "mismatches": mismatches,
+            "worker_memory": memory,
+        })
+    return report
+
+def print_serve_report(report):
+    print(f"[Bench] {report['clients']} client processes x {report['connections']} connections, "
+          f"{report['duration']:.0f}s per worker count, {default_cpus()} CPUs")
+    base = report["runs"][0]["requests_per_s"] if report["runs"] else 0
+    for run in report["runs"]:
+        lat = run["latency"]
+        pss = [m["pss_kb"] for m in run["worker_memory"] if "pss_kb" in m]
+        private = [m["private_kb"] for m in run["worker_memory"] if "private_kb" in m]
+        memory = (f" | per worker PSS {sum(pss) / len(pss) / 1024:.1f} MiB, private {sum(private) / len(private) / 1024:.1f} MiB"
+                  if pss and private else "")
+        latency = f"p50 {lat['p50'] / 1000:6.2f} ms  p99 {lat['p99'] / 1000:7.2f} ms" if lat["n"] else "no responses"
+        print(f"[Bench] {run['workers']:>3} workers: {run['requests_per_s']:9,.0f} req/s "
+              f"({run['requests_per_s'] / base if base else 0:.2f}x)  {latency}  "
+              f"errors {run['errors']}  mismatches {run['mismatches']}{memory}")
+
+############# Collaborative filtering
+
+def cf_store(n_users, n_orders, n_products=5_000, seed=0):
+    '''
+    OrderStore and catalog with n_users buyers (each orders at least once,
+    then skewed like generate_dataset), filled record by record so that
+    hundreds of thousands of orders don't need a dataset in memory first.
+    '''
+    r = random.Random(seed)
+    products = generate_products(n_products, r)
+    product_ids = [p["product_id"] for p in products]
+    users = [f"u{i:06d}" for i in range(n_users)]
+    first_day = date.today() - timedelta(days=730)
+
+    def pick(items):
+        return items[int(len(items) * r.random() ** 2)]
+
+    store = rec.OrderStore()
+    for k in range(n_orders):
+        order_id = f"o{k:07d}"
+        store.add_order({"order_id": order_id, "user_id": users[k] if k < n_users else pick(users),
+                         "order_date": (first_day + timedelta(days=r.randrange(730))).isoformat()})
+        store.add_order_item({"order_id": order_id, "products": [
+            {"product_id": pick(product_ids), "option": {}, "price": 10.0, "quantity": 1}
+            for _ in range(r.randint(1, 4))]})
+    return store.finish(), products
+
+def bench_cf(n_users, n_orders, n_products=5_000, neighbors=20, budget=30.0, max_mb=512.0, samples=2000):
+    '''ItemNeighbors build cost and rec_user_similar latency (see module docstring).'''
+    store, products = cf_store(n_users, n_orders, n_products)
+    build = lambda: rec.ItemNeighbors.build(store, neighbors=neighbors, budget=budget, max_mb=max_mb)
+    index = build()
+    tracemalloc.start()  # second build: numpy reports its buffers to tracemalloc
+    build()
+    traced_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    snap = rec.Snapshot(store, products, [])
+    snap.item_neighbors = index
+    users = sample_users(snap, samples)
+    timings = _timed_calls(lambda u: rec.rec_user_similar(u, snap, set()), [(u,) for u in users])
+    found = sum(bool(rec.rec_user_similar(u, snap, set())[0]["product_id"]) for u in users)
+    return {"users": len(store.orders_by_user), "orders": len(store), "lines": store.line_count(),
+            "build": index.stats, "traced_peak_mb": traced_peak / 2**20,
+            "rec_user_similar": percentiles(timings), "found_rate": found / len(users) if users else 0.0}
+
+def print_cf_report(report):
+    build, p = report["build"], report["rec_user_similar"]
+    print(f"[Bench] {report['users']:,} users, {report['orders']:,} orders, {report['lines']:,} lines -> "
+          f"{build['pairs']:,} user/product pairs")
+    print(f"[Bench] ItemNeighbors.build {build['seconds']:.2f}s: {build['products_done']:,}/{build['products_bought']:,} "
+          f"bought products, peak {report['traced_peak_mb']:.1f} MiB traced (estimated {build['estimated_mb']} MiB), "
+          f"index {build['index_mb']} MiB, stopped: {build['stopped'] or 'no'}")
+    print(f"[Bench] rec_user_similar       p50 {p['p50']:9.1f} us  p95 {p['p95']:9.1f} us  p99 {p['p99']:9.1f} us  "
+          f"(n={p['n']}, {report['found_rate']:.0%} with a recommendation)")
+
+############# Consistency checks
+
+def _import_server(data_path):
+    os.environ["REC_DATA_PATH"] = str(data_path)
+    os.environ.setdefault("REC_LOG_LEVEL", "WARNING")
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        import rec_sever  # loads REC_DATA_PATH on import
+    return rec_sever
+
+def check_precomputed(data_path, n_users=200):
+    '''
+    Users whose response (body or ETag) differs between a precompute.py store
+    and the live path. Any difference breaks If-None-Match revalidation as soon
+    as a request falls back from one to the other.
+    '''
+    import precompute
+    rec_sever = _import_server(data_path)
+    client = rec_sever.app.test_client()
+    cache_size, saved_store = rec_sever.result_cache.max_size, rec_sever.precomputed
+    rec_sever.result_cache.max_size = 0
+    failed = []
+    with tempfile.TemporaryDirectory() as tmp:
+        store_path = os.path.join(tmp, "recs.sqlite")
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            precompute.precompute(data_path, store_path, workers=1)  # also reloads data_path here
+        store = precompute.PrecomputedStore(store_path)
+        try:
+            for user_id in sample_users(rec.current_snapshot(), n_users):
+                stored = store.get(user_id)
+                for url in (f"/api/v1/recommend/{user_id}", f"/api/v1/recommend/{user_id}?expand=product"):
+                    served = {}
+                    for source, path_store in (("precomputed", store), ("live", None)):
+                        rec_sever.precomputed = path_store
+                        resp = client.get(url)
+                        served[source] = (resp.status_code, resp.get_data(), resp.headers.get("ETag"))
+                    if served["precomputed"] != served["live"]:
+                        failed.append(url)
+                if stored is None or stored[0] != client.get(f"/api/v1/recommend/{user_id}").get_data():
+                    failed.append(f"store:{user_id}")
+        finally:
+            rec_sever.precomputed = saved_store
+            rec_sever.result_cache.max_size = cache_size
+    return failed
+
+def check_concurrency(data_path, n_users=500, threads=16, rounds=3):
+    '''
+    Requests whose response differs when `threads` threads send them through
+    rec_sever.app at once from when they are sent one at a time. The result
+    cache is off, so every request runs the recommenders; a short GIL switch
+    interval makes the threads interleave inside them.
+    '''
+    rec_sever = _import_server(data_path)
+    users = sample_users(rec.current_snapshot(), n_users)
+    urls = [f"/api/v1/recommend/{u}" for u in users] + [f"/api/v1/recommend/{u}?expand=product" for u in users]
+    cache_size, switch_interval = rec_sever.result_cache.max_size, sys.getswitchinterval()
+    rec_sever.result_cache.max_size = 0
+    try:
+        client = rec_sever.app.test_client()
+        expected = {}
+        for url in urls:
+            resp = client.get(url)
+            expected[url] = (resp.status_code, resp.get_data())
+
+        start_gate = threading.Barrier(threads)
+        def work(chunk):
+            client = rec_sever.app.test_client()
+            start_gate.wait()
+            got = []
+            for url in chunk:
+                resp = client.get(url)
+                got.append((url, (resp.status_code, resp.get_data())))
+            return got
+
+        sys.setswitchinterval(1e-5)
+        failed = []
+        for round_ in range(rounds):
+            shuffled = random.Random(round_).sample(urls, len(urls))
+            with ThreadPoolExecutor(threads) as pool:
+                for got in pool.map(work, [shuffled[i::threads] for i in range(threads)]):
+                    failed.extend(url for url, response in got if response != expected[url])
+    finally:
+        sys.setswitchinterval(switch_interval)
+        rec_sever.result_cache.max_size = cache_size
+    return failed
+
+def check_delta(data_path, n_users=500, moved=200, seed=0):
+    '''
+    Users whose order history or recommendations differ between a full load
+    of the dataset and an older copy of it brought up to date by apply_delta.
+    The older copy lacks the last quarter of the orders and has `moved` orders
+    on another day; in the dataset those share their day with another order of
+    the same user, so the delta has to put them back among same-day orders.
+    '''
+    with open(data_path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    r = random.Random(seed)
+    cut = len(data["orders"]) * 3 // 4
+    by_user = {}
+    for order in data["orders"][:cut]:
+        by_user.setdefault(order["user_id"], []).append(order)
+    # give each moved order the day of a later-read order of its user, then move it elsewhere in the old copy
+    repeat_buyers = [user_orders for user_orders in by_user.values() if len(user_orders) > 1]
+    old_days = {}
+    for user_orders in r.sample(repeat_buyers, min(moved, len(repeat_buyers))):
+        order, sibling = user_orders[0], r.choice(user_orders[1:])
+        old_days[order["order_id"]] = order["order_date"]
+        order["order_date"] = sibling["order_date"]
+    older = dict(data, orders=[dict(o, order_date=old_days.get(o["order_id"], o["order_date"])) for o in data["orders"][:cut]])
+    kept = {o["order_id"] for o in older["orders"]}
+    older["order_items"] = [oi for oi in data["order_items"] if oi["order_id"] in kept]
+
+    def state():
+        snap = rec.current_snapshot()
+        users = sorted(set(sample_users(snap, n_users, seed)) | {o["user_id"] for o in data["orders"] if o["order_id"] in old_days})
+        return {u: (list(snap.orders.orders_by_user.get(u, ())), rec.rec_user_converter(u, snap=snap)) for u in users}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        full_path, older_path = os.path.join(tmp, "full.json"), os.path.join(tmp, "older.json")
+        for path, dataset in ((full_path, data), (older_path, older)):
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(dataset, f)
+        rec.load_data(full_path)
+        expected = state()
+        rec.load_data(older_path)
+    rec.apply_delta(orders=[o for o in data["orders"] if o["order_id"] in old_days] + data["orders"][cut:],
+                    order_items=data["order_items"])
+    got = state()
+    return [u for u in expected if got[u] != expected[u]]
+
+def check_his_engines(data_path, n_users=500, seed=0):
+    '''
+    Users for whom REC_HIS_ENGINE=numpy picks another history product than the
+    loop engine: with nothing excluded, with the user's other recommendations
+    excluded (so the fallbacks run), and both again after update_stock sells
+    out a tenth of the catalog. None (skipped) without numpy.
+    '''
+    if rec.np is None:
+        return None
+    rec.load_data(data_path)
+    snap = rec.current_snapshot()
+    users = sample_users(snap, n_users, seed)
+    saved_engine = rec.HIS_ENGINE
+
+    def picks(engine):
+        rec.HIS_ENGINE = engine
+        taken = {u: {r["product_id"] for r in rec.rec_user_converter(u, snap=snap)} for u in users}
+        return {u: (rec.rec_user_his(u, snap, 3, set())[0], rec.rec_user_his(u, snap, 3, set(taken[u]))[0])
+                for u in users}
+
+    failed = []
+    try:
+        for stage in ("loaded", "stock"):
+            if stage == "stock":
+                sold_out = random.Random(seed).sample(sorted(snap.sellable), len(snap.sellable) // 10)
+                rec.update_stock([{"product_id": pid, "stock": 0} for pid in sold_out], snap)
+            loop, numpy = picks("loop"), picks("numpy")
+            failed += [f"{stage}:{u}" for u in users if loop[u] != numpy[u]]
+    finally:
+        rec.HIS_ENGINE = saved_engine
+    return sorted(set(failed))
+
+CHECKS = {
+    "precomputed": check_precomputed,
+    "concurrency": check_concurrency,
+    "delta": check_delta,
+    "his_engines": check_his_engines,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark recommendation hot paths")
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    generate = sub.add_parser("generate", help="write a synthetic dataset")
+    generate.add_argument("--scale", choices=SCALES, default="1k", help="number of orders")
+    generate.add_argument("--products", type=int, default=10_000)
+    generate.add_argument("--seed", type=int, default=0)
+    generate.add_argument("--out", default=None, help="default: bench_data/<scale>.json")
+
+    run = sub.add_parser("run", help="time the pipeline on a dataset")
+    run.add_argument("--data", default=None, help="dataset to load (default: generated --scale dataset)")
+    run.add_argument("--scale", choices=SCALES, default="1k")
+    run.add_argument("--samples", type=int, default=2000, help="requests per timed function")
+    run.add_argument("--threads", type=int, default=8)
+    run.add_argument("--trace-memory", action="store_true", help="also trace the loader's peak allocation (slower)")
+    run.add_argument("--no-flask", action="store_true", help="skip the Flask test-client timings")
+    run.add_argument("--save", default=None, help="write the report to this JSON file")
+    run.add_argument("--compare", default=None, help="baseline report to compare against")
+    run.add_argument("--tolerance", type=float, default=0.25, help="allowed p95 slowdown vs the baseline")
+
+    occasion = sub.add_parser("occasion", help="occasion latency vs catalog size")
+    occasion.add_argument("--products", type=int, nargs="+", default=[1_000, 10_000, 100_000])
+    occasion.add_argument("--max-ratio", type=float, default=3.0, help="allowed p50 slowdown of the largest vs the smallest catalog")
+
+    history = sub.add_parser("history", help="history recommender for heavy users")
+    history.add_argument("--orders", type=int, nargs="+", default=[10, 100, 1000, 5000, 20000], help="orders per user")
+    history.add_argument("--top-k", type=int, default=3)
+    history.add_argument("--repeat", type=int, default=2000)
+    history.add_argument("--max-ratio", type=float, default=3.0, help="allowed slowdown of the heaviest vs the lightest user")
+
+    binary = sub.add_parser("binary", help="JSON vs binary snapshot: load time and per-worker memory")
+    binary.add_argument("--data", default=None, help="JSON dataset (default: generated --scale dataset)")
+    binary.add_argument("--scale", choices=SCALES, default="100k")
+    binary.add_argument("--workers", type=int, default=4, help="worker processes per format")
+    binary.add_argument("--users", type=int, default=200, help="users whose recommendations are compared")
+
+    serve = sub.add_parser("serve", help="load test rec_prefork.py: throughput vs worker count")
+    serve.add_argument("--data", default=None, help="dataset to serve (default: generated --scale dataset)")
+    serve.add_argument("--scale", choices=SCALES, default="100k")
+    serve.add_argument("--workers", type=int, nargs="+", default=None, help="worker counts (default: 1, 2, 4, ... up to the CPU count)")
+    serve.add_argument("--duration", type=float, default=10.0, help="seconds of load per worker count")
+    serve.add_argument("--clients", type=int, default=None, help="load-generating processes (default: one per CPU)")
+    serve.add_argument("--connections", type=int, default=8, help="keep-alive connections per client process")
+    serve.add_argument("--users", type=int, default=2000, help="distinct users requested")
+    serve.add_argument("--cache", action="store_true", help="keep the server's result cache on")
+    serve.add_argument("--save", default=None, help="write the report to this JSON file")
+
+    cf = sub.add_parser("cf", help="item-item neighbour index: build budget and request latency")
+    cf.add_argument("--users", type=int, default=100_000)
+    cf.add_argument("--orders", type=int, default=300_000)
+    cf.add_argument("--products", type=int, default=5_000)
+    cf.add_argument("--neighbors", type=int, default=20, help="neighbours kept per product")
+    cf.add_argument("--budget", type=float, default=30.0, help="build time budget, seconds")
+    cf.add_argument("--max-mb", type=float, default=512.0, help="build memory budget")
+    cf.add_argument("--samples", type=int, default=2000, help="rec_user_similar calls timed")
+
+    check = sub.add_parser("check", help="consistency checks between paths that must agree")
+    check.add_argument("--data", default=None, help="dataset (default: generated --scale dataset)")
+    check.add_argument("--scale", choices=SCALES, default="1k")
+    check.add_argument("names", nargs="*", metavar="NAME", help=f"checks to run: {', '.join(CHECKS)} (default: all)")
+    args = parser.parse_args()
+
+    if args.bench == "generate":
+        out = write_dataset(args.out or f"bench_data/{args.scale}.json", SCALES[args.scale], args.products, args.seed)
+        print(f"[Bench] wrote {SCALES[args.scale]} orders, {args.products} products -> {out}")
+
+    elif args.bench == "run":
+        data_path = args.data or f"bench_data/{args.scale}.json"
+        if args.data is None and not os.path.exists(data_path):
+            write_dataset(data_path, SCALES[args.scale])
+        report = run_suite(data_path, args.samples, args.threads, args.trace_memory, flask=not args.no_flask)
+        print_report(report)
+        if args.save:
+            with open(args.save, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2)
+            print(f"[Bench] report saved to {args.save}")
+        failed = report["concurrency"]["mismatches"] > 0
+        if args.compare:
+            with open(args.compare, "r", encoding="utf-8") as f:
+                regressions = compare(report, json.load(f), args.tolerance)
+            for metric, before, now in regressions:
+                print(f"[Bench] REGRESSION {metric}: {before:.1f} -> {now:.1f}")
+            print(f"[Bench] {len(regressions)} regressions vs {args.compare} (tolerance {args.tolerance:.0%})")
+            failed = failed or bool(regressions)
+        raise SystemExit(1 if failed else 0)
+
+    elif args.bench == "occasion":
+        results = bench_occasion(args.products)
+        for n, timings in results.items():
+            for case, p in timings.items():
+                print(f"[Bench] occasion, {n:>7} products, {case:<7}: p50 {p['p50']:6.2f} us  p95 {p['p95']:6.2f} us  p99 {p['p99']:6.2f} us")
+        smallest, largest = results[min(results)], results[max(results)]
+        ratio = max(largest[case]['p50'] / smallest[case]['p50'] for case in smallest)
+        print(f"[Bench] rec_user_occasion largest/smallest catalog: {ratio:.2f}x (max {args.max_ratio}x)")
+        raise SystemExit(0 if ratio <= args.max_ratio else 1)
+
+    elif args.bench == "history":
+        results = bench_history(args.orders, args.top_k, args.repeat)
+        for n, timings in results.items():
+            print(f"[Bench] {n:>6} orders: latest {args.top_k} orders {timings['latest_orders'] * 1e6:7.2f} us, "
+                  f"rec_user_his {timings['rec_user_his'] * 1e6:8.2f} us")
+        lightest, heaviest = results[min(results)], results[max(results)]
+        ratio = heaviest['rec_user_his'] / lightest['rec_user_his']
+        print(f"[Bench] rec_user_his heaviest/lightest: {ratio:.2f}x (max {args.max_ratio}x)")
+        raise SystemExit(0 if ratio <= args.max_ratio else 1)
+
+    elif args.bench == "binary":
+        data_path = args.data or f"bench_data/{args.scale}.json"
+        if args.data is None and not os.path.exists(data_path):
+            write_dataset(data_path, SCALES[args.scale])
+        report = bench_binary(data_path, args.workers, args.users)
+        print_binary_report(report)
+        raise SystemExit(0 if report["results_match"] else 1)
+
+    elif args.bench == "serve":
+        data_path = args.data or f"bench_data/{args.scale}.json"
+        if args.data is None and not os.path.exists(data_path):
+            write_dataset(data_path, SCALES[args.scale])
+        counts = args.workers or sorted({min(2 ** i, default_cpus()) for i in range(default_cpus().bit_length() + 1)})
+        report = bench_serve(data_path, counts, args.duration, args.clients, args.connections, args.users, args.cache)
+        print_serve_report(report)
+        if args.save:
+            with open(args.save, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2)
+            print(f"[Bench] report saved to {args.save}")
+        raise SystemExit(1 if any(run["errors"] or run["mismatches"] for run in report["runs"]) else 0)
+
+    elif args.bench == "cf":
+        report = bench_cf(args.users, args.orders, args.products, args.neighbors, args.budget, args.max_mb, args.samples)
+        print_cf_report(report)
+        raise SystemExit(1 if report["build"]["stopped"] else 0)
+
+    elif args.bench == "check":
+        data_path = args.data or f"bench_data/{args.scale}.json"
+        if args.data is None and not os.path.exists(data_path):
+            write_dataset(data_path, SCALES[args.scale])
+        unknown = set(args.names) - set(CHECKS)
+        if unknown:
+            parser.error(f"unknown checks: {', '.join(sorted(unknown))}")
+        failures = 0
+        for name in args.names or CHECKS:
+            failed = CHECKS[name](data_path)
+            if failed is None:
+                print(f"[Check] {name}: skipped")
+                continue
+            failures += bool(failed)
+            print(f"[Check] {name}: {'FAILED ' + str(len(failed)) + ' ' + str(failed[:3]) if failed else 'ok'}")
+        raise SystemExit(1 if failures else 0)
@@ -0,0 +1,150 @@
+"""
+Observability for the servers, without extra dependencies: in-process metrics
+rendered in the Prometheus text format (served on /metrics) and JSON-lines
+logging (json_logger).
+
+    STAGE_SECONDS = metrics.Histogram("rec_stage_seconds", "Time per stage", ["stage"])
+    STAGE_SECONDS.observe(0.0012, "history")
+    metrics.render()  # text exposition of every metric created so far
+
+Metrics register themselves on creation; define them once at module level.
+"""
+import bisect
+import json
+import logging
+import math
+import threading
+
+# seconds: 50 us .. 10 s
+DEFAULT_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REGISTRY = []
+_REGISTRY_LOCK = threading.Lock()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    pairs += [f'{n}="{_escape(v)}"' for n, v in extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _number(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        with _REGISTRY_LOCK:
+            REGISTRY.append(self)
+
+    def _header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self._values = {}
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        with self._lock:
+            values = list(self._values.items())
+        return self._header() + [f"{self.name}{_labels(self.label_names, k)} {_number(v)}" for k, v in values]
+
+
+class Gauge(_Metric):
+    '''A gauge (or counter, with kind="counter") whose value is read from fn() at scrape time.'''
+    def __init__(self, name, help, fn, kind="gauge"):
+        super().__init__(name, help)
+        self.kind = kind
+        self.fn = fn
+
+    def render(self):
+        value = self.fn()
+        if value is None:
+            return []
+        return self._header() + [f"{self.name} {_number(value)}"]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [per-bucket counts (last one is +Inf), sum, count]
+        self._series = {}
+
+    def observe(self, value, *label_values):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        with self._lock:
+            snapshot = [(k, list(s[0]), s[1], s[2]) for k, s in self._series.items()]
+        lines = self._header()
+        for label_values, counts, total, count in snapshot:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (math.inf,), counts):
+                cumulative += n
+                le = _labels(self.label_names, label_values, [("le", _number(bound))])
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            labels = _labels(self.label_names, label_values)
+            lines.append(f"{self.name}_sum{labels} {_number(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+def render():
+    '''Every registered metric in the Prometheus text exposition format.'''
+    with _REGISTRY_LOCK:
+        metrics = list(REGISTRY)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {"ts": round(record.created, 3), "level": record.levelname, "logger": record.name, "msg": record.getMessage()}
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+def json_logger(name, level="INFO"):
+    '''Logger writing one JSON object per line to stderr; pass extra={"fields": {...}} to add keys.'''
+    log = logging.getLogger(name)
+    if not log.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(JsonFormatter())
+        log.addHandler(handler)
+        log.propagate = False
+    log.setLevel(str(level).upper())
+    return log
@@ -0,0 +1,164 @@
+"""
+Local stand-in for the e-commerce backend (REC_API_BASE), serving a snapshot
+file converted back to the backend's shape. Meant for trying rec_asgi.py,
+snapshot.py and load tests without the real backend.
+
+    python mock_backend.py --data data.json --port 5001 --latency 0.05
+    REC_API_BASE=http://127.0.0.1:5001 uvicorn rec_asgi:app
+
+Routes (GET only): /api/carts, /api/carts/<user_id>, /api/orders,
+/api/orders/user/<user_id>, /api/products?page=N, /api/products/<product_id>.
+Runs on asyncio with HTTP/1.1 keep-alive, so thousands of concurrent
+connections do not need thousands of threads.
+"""
+import argparse
+import asyncio
+import json
+from collections import defaultdict
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import recommendation as rec
+
+PAGE_SIZE = 50
+
+
+def backend_records(data_path):
+    '''carts, orders and products of a snapshot file in the backend's structure (what the converters read).'''
+    orders, order_items, products, carts = rec.init_data(data_path)
+    items_by_order = {}
+    for order_item in order_items:
+        items_by_order.setdefault(order_item["order_id"], order_item["products"])
+
+    backend_products = [{
+        "_id": p["product_id"],
+        "name": p.get("name", ""),
+        "price": p.get("price", 0),
+        "stock": p.get("stock", 0),
+        "available": p.get("available", True),
+        "description": p.get("description", ""),
+        "image_url": p.get("image_url", []),
+        "flower_type": [t for t in p.get("flower_details", {}).get("flower_type", "").split(", ") if t],
+        "colors": p.get("flower_details", {}).get("color", []),
+        "occasions": p.get("flower_details", {}).get("occasion", []),
+    } for p in products]
+
+    backend_orders = []
+    for order in orders:
+        created = f"{order['order_date']}T00:00:00.000Z"
+        backend_orders.append({
+            "_id": order["order_id"],
+            "user_id": order["user_id"],
+            "shipping_address": order.get("shipping_address", ""),
+            "subtotal": order.get("total_amount", 0),
+            "off_price": order.get("off_price", 0),
+            "status": order.get("status", ""),
+            "items": [{"product_id": item["product_id"], "quantity": item.get("quantity", 0),
+                       "subtotal": item.get("price", 0) * item.get("quantity", 0), "off_price": item.get("off_price", 0)}
+                      for item in items_by_order.get(order["order_id"], [])],
+            "createdAt": created,
+            "updatedAt": created,
+        })
+
+    backend_carts = [{"_id": f"cart-{i}", "user_id": cart["user_id"], "items": cart["products"]}
+                     for i, cart in enumerate(carts)]
+    return backend_carts, backend_orders, backend_products
+
+
+class MockBackend:
+    def __init__(self, data_path, latency=0.0):
+        self.latency = latency
+        self.carts, self.orders, self.products = backend_records(data_path)
+        self.cart_by_user = {}
+        for cart in self.carts:
+            self.cart_by_user.setdefault(cart["user_id"], cart)
+        self.orders_by_user = defaultdict(list)
+        for order in self.orders:
+            self.orders_by_user[order["user_id"]].append(order)
+        self.product_by_id = {p["_id"]: p for p in self.products}
+        self.requests = 0
+
+    def route(self, path, query):
+        '''(status, body) for a GET.'''
+        parts = [unquote(p) for p in path.strip("/").split("/")]
+        if parts[:1] != ["api"] or len(parts) < 2:
+            return 404, {"message": "not found"}
+        resource, rest = parts[1], parts[2:]
+        if resource == "carts":
+            if not rest:
+                return 200, self.carts
+            cart = self.cart_by_user.get(rest[0])
+            return (200, cart) if cart else (404, {"message": "cart not found"})
+        if resource == "orders":
+            if not rest:
+                return 200, self.orders
+            if rest[0] == "user" and len(rest) == 2:
+                return 200, self.orders_by_user.get(rest[1], [])
+            order = next((o for o in self.orders if o["_id"] == rest[0]), None)
+            return (200, order) if order else (404, {"message": "order not found"})
+        if resource == "products":
+            if not rest:
+                page = int(query.get("page", ["1"])[0])
+                total_pages = max(1, -(-len(self.products) // PAGE_SIZE))
+                return 200, {"totalPages": total_pages, "products": self.products[(page - 1) * PAGE_SIZE:page * PAGE_SIZE]}
+            product = self.product_by_id.get(rest[0])
+            return (200, product) if product else (404, {"message": "product not found"})
+        return 404, {"message": "not found"}
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _version = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                if int(headers.get("content-length", 0) or 0):
+                    await reader.readexactly(int(headers["content-length"]))
+
+                self.requests += 1
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                url = urlsplit(target)
+                if method == "GET":
+                    status, payload = self.route(url.path, parse_qs(url.query))
+                else:
+                    status, payload = 405, {"message": "read-only mock"}
+                body = json.dumps(payload).encode("utf-8")
+                keep_alive = headers.get("connection", "").lower() != "close"
+                writer.write(
+                    f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                    f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1") + body
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=5001):
+        server = await asyncio.start_server(self.handle, host, port, backlog=4096)
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a snapshot file as a mock backend")
+    parser.add_argument("--data", default=None, help="snapshot to serve (default: REC_DATA_PATH or ./data.json)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5001)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    args = parser.parse_args()
+
+    backend = MockBackend(args.data or rec.DATA_PATH, args.latency)
+    print(f"[Mock] serving {len(backend.carts)} carts, {len(backend.orders)} orders, {len(backend.products)} products "
+          f"on http://{args.host}:{args.port} (latency {args.latency}s)")
+    asyncio.run(backend.serve(args.host, args.port))
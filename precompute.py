@@ -0,0 +1,145 @@
+"""
+Offline precompute: run rec_user_converter for every user found in orders and
+carts, using several processes, and store the serialized results in SQLite.
+rec_sever serves from the store (REC_PRECOMPUTED_PATH) and falls back to live
+computation for users that are not in it, or once its data no longer matches.
+
+    python precompute.py --data data.json --out recs.sqlite --workers 8
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sqlite3
+import threading
+import time
+
+import recommendation as rec
+import responses
+
+
+def serialize(results):
+    # the same bytes and ETag as rec_sever's live path for the same results
+    body = responses.results_body(results)
+    return body, responses.etag(body)
+
+
+def _init_worker(data_path):
+    # every worker process loads its own copy of the snapshot once
+    rec.load_data(data_path)
+
+
+def _compute_chunk(user_ids):
+    rows = []
+    for user_id, results in rec.rec_user_converter_batch(user_ids):
+        body, etag = serialize(results)
+        rows.append((user_id, body, etag))
+    return rows
+
+
+def known_users(snap):
+    return sorted(set(snap.orders.orders_by_user) | set(snap.cart_by_user))
+
+
+def precompute(data_path, out_path, workers=None, chunk_size=500):
+    '''
+    Materialize recommendations for all known users into out_path (SQLite).
+    The store is written to a temp file and renamed into place, and records the
+    signature of the data file it was computed from. Returns timing stats.
+    '''
+    started = time.perf_counter()
+    stats = rec.load_data(data_path)
+    user_ids = known_users(rec.current_snapshot())
+    chunks = [user_ids[i:i + chunk_size] for i in range(0, len(user_ids), chunk_size)]
+
+    tmp_path = f"{out_path}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    conn.execute("CREATE TABLE recs (user_id TEXT PRIMARY KEY, body BLOB NOT NULL, etag TEXT NOT NULL) WITHOUT ROWID")
+    conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    computed = time.perf_counter()
+    with multiprocessing.Pool(workers or os.cpu_count(), initializer=_init_worker, initargs=(str(data_path),)) as pool:
+        for rows in pool.imap_unordered(_compute_chunk, chunks):
+            conn.executemany("INSERT OR REPLACE INTO recs VALUES (?, ?, ?)", rows)
+    compute_seconds = time.perf_counter() - computed
+
+    meta = {
+        "source_path": str(data_path),
+        "source_signature": json.dumps(stats['source_signature']),
+        "users": str(len(user_ids)),
+        "built_at": str(time.time()),
+    }
+    conn.executemany("INSERT INTO meta VALUES (?, ?)", meta.items())
+    conn.commit()
+    conn.close()
+    os.replace(tmp_path, out_path)
+
+    return {
+        'users': len(user_ids),
+        'compute_seconds': compute_seconds,
+        'total_seconds': time.perf_counter() - started,
+    }
+
+
+class PrecomputedStore:
+    """
+    Read-only view of a precompute.py store. Lookups hit the primary key of a
+    memory-mapped SQLite file; each thread gets its own connection.
+    """
+    def __init__(self, path):
+        self.path = str(path)
+        self._local = threading.local()
+        self.meta = dict(self._conn().execute("SELECT key, value FROM meta"))
+        self.source_signature = json.loads(self.meta["source_signature"])
+        # SQLite connections must not cross a fork (rec_prefork.py): children open their own
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+            conn.execute("PRAGMA mmap_size = 268435456")
+            self._local.conn = conn
+        return conn
+
+    def matches(self, load_stats):
+        # only valid for the exact data file it was computed from
+        return list(load_stats.get('source_signature', [])) == self.source_signature
+
+    def get(self, user_id):
+        row = self._conn().execute("SELECT body, etag FROM recs WHERE user_id = ?", (user_id,)).fetchone()
+        return (bytes(row[0]), row[1]) if row else None
+
+    def user_ids(self):
+        return [row[0] for row in self._conn().execute("SELECT user_id FROM recs")]
+
+
+def benchmark_lookups(store, n=10000):
+    user_ids = store.user_ids()
+    if not user_ids:
+        return 0.0
+    sample = [random.choice(user_ids) for _ in range(n)]
+    started = time.perf_counter()
+    for user_id in sample:
+        store.get(user_id)
+    return (time.perf_counter() - started) / n
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precompute recommendations for all known users")
+    parser.add_argument("--data", default=None, help="snapshot to read (default: REC_DATA_PATH or ./data.json)")
+    parser.add_argument("--out", default=os.environ.get("REC_PRECOMPUTED_PATH", "recs.sqlite"), help="SQLite store to write")
+    parser.add_argument("--workers", type=int, default=None, help="processes (default: cpu count)")
+    args = parser.parse_args()
+
+    result = precompute(args.data or rec.DATA_PATH, args.out, args.workers)
+    print(f"[Precompute] {result['users']} users in {result['compute_seconds']:.2f}s "
+          f"({result['total_seconds']:.2f}s including load) -> {args.out}")
+    per_lookup = benchmark_lookups(PrecomputedStore(args.out))
+    print(f"[Precompute] store lookup: {per_lookup * 1e6:.1f} us/lookup ({1 / per_lookup if per_lookup else 0:,.0f} lookups/s)")
@@ -0,0 +1,155 @@
+"""
+ASGI serving mode, next to the Flask app in rec_sever.py. Every recommendation
+merges the user's live cart, fetched from the backend without blocking:
+
+    uvicorn rec_asgi:app --host 0.0.0.0 --port 8000
+
+GET /api/v1/recommend/<user_id> (or ?user_id=, both with rec_sever's
+?expand=product) asks the backend (REC_API_BASE)
+for the user's cart through AsyncApi: one pooled connection per process, at
+most REC_ASYNC_MAX_INFLIGHT backend requests in flight. Carts are cached for
+REC_LIVE_CART_TTL seconds and concurrent requests for one user share a fetch
+(recommendation.LiveCarts). The recommenders run on the local snapshot in a
+thread pool (REC_COMPUTE_WORKERS), so the event loop only ever waits on I/O.
+A cart that takes longer than REC_LIVE_CART_TIMEOUT seconds, or a backend
+error, falls back to the snapshot's cart.
+Bodies and ETags come from responses.py, so they are byte for byte the Flask
+app's. /healthz and /metrics behave as in rec_sever.
+
+Against a local mock backend:
+
+    python mock_backend.py --data data.json --port 5001 --latency 0.05 &
+    REC_API_BASE=http://127.0.0.1:5001 uvicorn rec_asgi:app --port 8000
+"""
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, unquote
+
+import metrics
+import recommendation as rec  # must be in same dir
+import responses
+import snapshot
+
+THIS_DIR = Path(__file__).resolve().parent
+DATA_PATH = Path(os.environ.get("REC_DATA_PATH", THIS_DIR / "data.json"))
+COMPUTE_WORKERS = int(os.environ.get("REC_COMPUTE_WORKERS", 4))
+
+log = metrics.json_logger("rec_asgi", os.environ.get("REC_LOG_LEVEL", "INFO"))
+
+load_stats = rec.load_data(DATA_PATH)
+log.info("data loaded", extra={"fields": {
+    "data_path": str(DATA_PATH), "mode": load_stats['mode'], "load_ms": round(load_stats['seconds'] * 1000, 1),
+    "orders": load_stats['orders'], "products": load_stats['products'],
+}})
+
+SYNC_INTERVAL = float(os.environ.get("REC_SYNC_INTERVAL", 0))
+if SYNC_INTERVAL > 0:
+    snapshot.start_sync_loop(SYNC_INTERVAL)
+
+RELOAD_INTERVAL = float(os.environ.get("REC_RELOAD_INTERVAL", 0))
+if RELOAD_INTERVAL > 0:
+    snapshot.start_reload_watcher(DATA_PATH, RELOAD_INTERVAL)
+
+REQUEST_SECONDS = metrics.Histogram("rec_http_request_seconds", "HTTP request latency", ["route", "method", "status"])
+# fetches beyond the connection pool queue in AsyncApi (bounded by the wait timeout),
+# and still fill the cache when they land; only a backlog past this is shed
+live_carts = rec.LiveCarts(max_inflight=rec.ASYNC_MAX_INFLIGHT * 10)
+metrics.Gauge("rec_live_cart_cache_entries", "Users in the live cart cache", lambda: len(live_carts))
+
+# created at lifespan startup, inside the server's event loop
+api: Optional[rec.AsyncApi] = None
+executor: Optional[ThreadPoolExecutor] = None
+
+
+def _results_body(user_id: str, snap, expand: bool, version: int) -> bytes:
+    return responses.results_body(rec.rec_user_converter(user_id, 3, snap), snap, expand, version)
+
+async def recommend(user_id: str, expand: bool = False) -> bytes:
+    '''Response body for user_id, as rec_sever serves it (see responses.results_body).'''
+    snap = rec.current_snapshot()
+    version = snap.version  # once: stock pushes and syncs bump it on this same object
+    # None (slow or failing backend, counted in rec_live_cart_total): keep the snapshot's cart
+    cart = await live_carts.aget(user_id, api.get_cart_by_user_id)
+    if cart is not None:
+        snap = snap.with_cart(user_id, cart)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, _results_body, user_id, snap, expand, version)
+
+
+############# ASGI plumbing
+
+def _json(status: int, payload: Any, extra_headers=()) -> Tuple[int, bytes, list]:
+    return status, responses.dumps(payload) + b"\n", [(b"content-type", b"application/json"), *extra_headers]
+
+async def _recommend_response(user_id: str, query: Dict[str, List[str]], headers: Dict[bytes, bytes]):
+    # ?expand=product (or 1): inline each recommended product's name, price and image
+    expand = query.get("expand", [""])[0] in ("product", "1")
+    try:
+        body = await recommend(user_id, expand)
+    except Exception as e:
+        log.error("recommendation failed", exc_info=True, extra={"fields": {"user_id": user_id}})
+        return _json(400, {"error": f"Error generating recommendations: {e}"})
+    status, resp_headers = 200, [(b"content-type", b"application/json")]
+    etag = responses.etag(body)
+    resp_headers += [(b"etag", f'"{etag}"'.encode()), (b"cache-control", b"private, no-cache")]
+    if_none_match = headers.get(b"if-none-match", b"").decode("latin-1")
+    if etag in {tag.strip().removeprefix("W/").strip('"') for tag in if_none_match.split(",")}:
+        return 304, b"", resp_headers[1:]
+    return status, body, resp_headers
+
+async def _route(scope) -> Tuple[str, Tuple[int, bytes, list]]:
+    path, method = scope["path"], scope["method"]
+    headers = dict(scope.get("headers", []))
+    query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+    if method != "GET":
+        return "unmatched", _json(405, {"error": "Method not allowed"})
+    if path == "/healthz":
+        stats = rec.LOAD_STATS
+        return path, _json(200, {
+            "status": "ok",
+            "data_version": rec.current_snapshot().version,
+            "load_build_ms": round(stats.get('build_seconds', 0) * 1000, 3),
+            "loaded_at": stats.get('loaded_at'),
+        })
+    if path == "/metrics":
+        return path, (200, metrics.render().encode("utf-8"), [(b"content-type", metrics.CONTENT_TYPE.encode())])
+    if path == "/api/v1/recommend":
+        user_id = query.get("user_id", [""])[0]
+        if not user_id:
+            return path, _json(400, {"error": "Missing user_id"})
+        return path, await _recommend_response(user_id, query, headers)
+    prefix = "/api/v1/recommend/"
+    if path.startswith(prefix) and "/" not in path[len(prefix):] and path != prefix:
+        return "/api/v1/recommend/<user_id>", await _recommend_response(unquote(path[len(prefix):]), query, headers)
+    return "unmatched", _json(404, {"error": "Not found"})
+
+async def _lifespan(receive, send):
+    global api, executor
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            api = rec.AsyncApi()
+            executor = ThreadPoolExecutor(COMPUTE_WORKERS, thread_name_prefix="rec-compute")
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await api.aclose()
+            executor.shutdown(wait=False)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+    started = time.perf_counter()
+    route, (status, body, headers) = await _route(scope)
+    headers.append((b"content-length", str(len(body)).encode()))
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": body})
+    REQUEST_SECONDS.observe(time.perf_counter() - started, route, scope["method"], str(status))
@@ -0,0 +1,269 @@
+"""
+Pre-fork serving entry point for the Flask app in rec_sever.py. The master
+process loads the snapshot once, then forks REC_WORKERS workers (default: one
+per usable CPU) that share it copy-on-write and accept on one listening socket:
+
+    REC_DATA_PATH=data.json python rec_prefork.py --port 8000 --workers 4
+
+Signals to the master:
+    HUP        reload REC_DATA_PATH in the master, then replace the workers one
+               at a time (a new one is forked before each old one drains)
+    TERM, INT  stop; workers finish their in-flight requests first
+
+A worker that exits or crashes is replaced. With REC_WORKER_MAX_REQUESTS each
+worker is also recycled after that many requests (plus up to 10% jitter, so
+they don't all restart at once). Draining workers get REC_GRACEFUL_TIMEOUT
+seconds before they are killed.
+
+REC_RELOAD_INTERVAL makes the master poll REC_DATA_PATH and reload as on HUP.
+REC_SYNC_INTERVAL runs the delta sync in every worker; each worker then patches
+its own copy, so the pages it touches stop being shared. Caches, /metrics and
+stock pushes (POST /api/v1/products/stock) are per worker too.
+
+Objects loaded before the fork are moved out of the garbage collector's
+generations (gc.freeze), so collections in the workers don't write to them
+and unshare their pages. A binary snapshot (snapshot.py --binary) is shared
+through the page cache whatever the workers do.
+"""
+import argparse
+import gc
+import logging
+import os
+import random
+import signal
+import socket
+import threading
+import time
+
+from werkzeug.serving import ThreadedWSGIServer
+from werkzeug.wsgi import ClosingIterator
+
+import metrics
+import recommendation as rec
+import snapshot
+
+# the master owns reloads and starts the delta sync in each worker
+os.environ["REC_PREFORK"] = "1"
+import rec_sever  # loads the snapshot: once, in the master
+
+log = metrics.json_logger("rec_prefork", os.environ.get("REC_LOG_LEVEL", "INFO"))
+
+
+def default_workers():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # not on Linux
+        return os.cpu_count() or 1
+
+WORKERS = int(os.environ.get("REC_WORKERS", 0)) or default_workers()
+MAX_REQUESTS = int(os.environ.get("REC_WORKER_MAX_REQUESTS", 0))
+GRACEFUL_TIMEOUT = float(os.environ.get("REC_GRACEFUL_TIMEOUT", 30))
+
+
+############# Worker
+
+class _Worker:
+    '''
+    One forked worker: a threaded werkzeug server on the master's listening
+    socket. Counts requests in flight (until the response body is closed, so
+    streamed batches count too) to know when a draining worker is done.
+    '''
+    def __init__(self, listener, max_requests=0):
+        self.server = ThreadedWSGIServer(*listener.getsockname()[:2], self.app, fd=listener.fileno())
+        self.max_requests = max_requests + random.randint(0, max_requests // 10) if max_requests else 0
+        self.served = 0
+        self.inflight = 0
+        self.stopping = threading.Event()
+        self._lock = threading.Lock()
+
+    def app(self, environ, start_response):
+        with self._lock:
+            self.inflight += 1
+            self.served += 1
+            if self.served == self.max_requests:
+                self.stopping.set()
+        try:
+            body = rec_sever.app(environ, start_response)
+        except BaseException:
+            self._done()
+            raise
+        return ClosingIterator(body, self._done)
+
+    def _done(self):
+        with self._lock:
+            self.inflight -= 1
+
+    def run(self, graceful_timeout):
+        # serve_forever runs in this (main) thread; shutdown() has to come from another one
+        threading.Thread(target=lambda: (self.stopping.wait(), self.server.shutdown()),
+                         name="worker-stop", daemon=True).start()
+        self.server.serve_forever()  # closes this process's copy of the listening socket when done
+        deadline = time.monotonic() + graceful_timeout
+        while self.inflight and time.monotonic() < deadline:
+            time.sleep(0.05)
+        return self.inflight
+
+def _worker_main(listener):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl-C reaches the whole group; the master decides
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    # rec_sever logs requests (sampled) itself; werkzeug would print every one
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    worker = _Worker(listener, MAX_REQUESTS)
+    signal.signal(signal.SIGTERM, lambda *_: worker.stopping.set())
+    if rec_sever.SYNC_INTERVAL > 0:
+        snapshot.start_sync_loop(rec_sever.SYNC_INTERVAL)
+    log.info("worker started", extra={"fields": {"pid": os.getpid(), "data_version": rec.current_snapshot().version}})
+    abandoned = worker.run(GRACEFUL_TIMEOUT)
+    log.info("worker stopped", extra={"fields": {"pid": os.getpid(), "served": worker.served, "abandoned": abandoned}})
+
+
+############# Master
+
+class Master:
+    '''
+    Forks and supervises the workers. Signal handlers only record what was
+    asked; the main loop acts on it, reaps exited workers and keeps `workers`
+    of the current generation running.
+    '''
+    def __init__(self, listener, workers, reload_interval=0.0):
+        self.listener = listener
+        self.workers = workers
+        self.reload_interval = reload_interval
+        self.current = set()   # pids serving the loaded snapshot
+        self.draining = {}     # pid -> deadline for it to exit
+        self.reload_requested = False
+        self.stop_requested = False
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                _worker_main(self.listener)
+            except BaseException:
+                log.error("worker failed", exc_info=True, extra={"fields": {"pid": os.getpid()}})
+                code = 1
+            finally:
+                os._exit(code)
+        self.current.add(pid)
+        return pid
+
+    def retire(self, pid):
+        self.current.discard(pid)
+        self.draining[pid] = time.monotonic() + GRACEFUL_TIMEOUT + 5
+        self._signal(pid, signal.SIGTERM)
+
+    def _signal(self, pid, sig):
+        try:
+            os.kill(pid, sig)
+        except ProcessLookupError:
+            pass
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            code = os.waitstatus_to_exitcode(status)
+            if self.draining.pop(pid, None) is None and pid in self.current:
+                self.current.discard(pid)
+                # a recycled worker (max requests) exits 0 on its own
+                level = logging.INFO if code == 0 else logging.WARNING
+                log.log(level, "worker exited, replacing it", extra={"fields": {"pid": pid, "exit_code": code}})
+
+    def reload(self):
+        started = time.perf_counter()
+        gc.unfreeze()  # so the old snapshot, frozen at the last fork, can be freed here
+        try:
+            stats = rec.load_data(rec_sever.DATA_PATH)
+        except Exception as e:
+            log.error("reload failed, keeping the workers", extra={"fields": {"error": str(e)}})
+            return
+        finally:
+            self._freeze()
+        log.info("data reloaded, replacing workers", extra={"fields": {
+            "data_version": stats['version'], "load_ms": round(stats['seconds'] * 1000, 1),
+        }})
+        for old in list(self.current):
+            self.spawn()
+            self.retire(old)
+        log.info("workers replaced", extra={"fields": {"seconds": round(time.perf_counter() - started, 3)}})
+
+    def _freeze(self):
+        gc.collect()
+        gc.freeze()
+
+    def _data_changed(self):
+        try:
+            st = os.stat(rec_sever.DATA_PATH)
+        except FileNotFoundError:
+            return False
+        return [st.st_size, st.st_mtime_ns] != list(rec.LOAD_STATS.get('source_signature', []))
+
+    def run(self):
+        def on_reload(*_):
+            self.reload_requested = True
+        def on_stop(*_):
+            self.stop_requested = True
+        signal.signal(signal.SIGHUP, on_reload)
+        signal.signal(signal.SIGTERM, on_stop)
+        signal.signal(signal.SIGINT, on_stop)
+
+        self._freeze()
+        next_check = time.monotonic() + self.reload_interval
+        while not self.stop_requested:
+            self.reap()
+            if self.reload_interval > 0 and time.monotonic() >= next_check:
+                next_check = time.monotonic() + self.reload_interval
+                self.reload_requested = self.reload_requested or self._data_changed()
+            if self.reload_requested:
+                self.reload_requested = False
+                self.reload()
+            while len(self.current) < self.workers:
+                self.spawn()
+            for pid, deadline in list(self.draining.items()):
+                if time.monotonic() > deadline:
+                    log.warning("worker did not drain in time, killing it", extra={"fields": {"pid": pid}})
+                    self._signal(pid, signal.SIGKILL)
+            time.sleep(0.1)
+        self.stop()
+
+    def stop(self):
+        log.info("stopping", extra={"fields": {"workers": len(self.current) + len(self.draining)}})
+        for pid in list(self.current):
+            self.retire(pid)
+        while self.draining:
+            self.reap()
+            for pid, deadline in list(self.draining.items()):
+                if time.monotonic() > deadline:
+                    self._signal(pid, signal.SIGKILL)
+            time.sleep(0.05)
+        self.listener.close()
+
+
+def listen(host, port, backlog=2048):
+    # non-blocking: every idle worker wakes on a new connection and all but one
+    # get EAGAIN from accept(), which socketserver ignores, instead of blocking there
+    listener = socket.create_server((host, port), family=socket.AF_INET6 if ":" in host else socket.AF_INET,
+                                    backlog=backlog, reuse_port=False)
+    listener.setblocking(False)
+    return listener
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve rec_sever's app from pre-forked worker processes")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", 8000)))
+    parser.add_argument("--workers", type=int, default=WORKERS, help="worker processes (default: REC_WORKERS or one per CPU)")
+    args = parser.parse_args()
+
+    listener = listen(args.host, args.port)
+    log.info("serving", extra={"fields": {
+        "address": f"{args.host}:{listener.getsockname()[1]}", "workers": args.workers, "master_pid": os.getpid(),
+        "data_version": rec.current_snapshot().version, "max_requests": MAX_REQUESTS,
+    }})
+    Master(listener, args.workers, rec_sever.RELOAD_INTERVAL).run()
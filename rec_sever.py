@@ -1,48 +1,344 @@
+import hmac
+import json
+import logging
 import os
+import random
+import threading
+import time
+from collections import OrderedDict
 from pathlib import Path
-from typing import Any, Dict, List, Union
+from typing import Any, Dict, List, Optional, Tuple, Union
 
-from flask import Flask, jsonify, request, abort
+from flask import Flask, Response, g, jsonify, request, abort, stream_with_context
 from flask_cors import CORS
 
 import requests
 
+import metrics
 import recommendation as rec  # must be in same dir
+import responses
+import snapshot
+from precompute import PrecomputedStore
 
 app = Flask(__name__)
 CORS(app, resources={r"/api/*": {"origins": "*"}})
 
-# Load data.json (same folder) unless overridden by env var
+# Structured (one JSON object per line) logging. Per-request records are sampled:
+# REC_LOG_SAMPLE_RATE of requests are logged at INFO (with full results at DEBUG),
+# requests slower than REC_LOG_SLOW_MS always at WARNING, errors always.
+LOG_SAMPLE_RATE = float(os.environ.get("REC_LOG_SAMPLE_RATE", 0.01))
+LOG_SLOW_MS = float(os.environ.get("REC_LOG_SLOW_MS", 500))
+log = metrics.json_logger("rec_sever", os.environ.get("REC_LOG_LEVEL", "INFO"))
+
+# Load data.json (same folder) unless overridden by env var; a binary snapshot
+# (snapshot.py --binary) is memory-mapped and shared by all workers on the host
 THIS_DIR = Path(__file__).resolve().parent
 DATA_PATH = Path(os.environ.get("REC_DATA_PATH", THIS_DIR / "data.json"))
-rec.load_data(DATA_PATH)
 
-def _get_results(user_id: Union[int, str]) -> List[Dict[str, Any]]:
+# Opt-in: refresh the snapshot from the backend before loading, bounded by a time budget,
+# in DATA_PATH's format (binary for a .bin snapshot). Default is off: the server boots
+# from the last snapshot written by snapshot.py.
+if os.environ.get("REC_EXTRACT_ON_START", "0") == "1":
+    snapshot.refresh_snapshot(DATA_PATH, budget=float(os.environ.get("REC_EXTRACT_BUDGET", 10)))
+
+load_stats = rec.load_data(DATA_PATH)
+log.info("data loaded", extra={"fields": {
+    "data_path": str(DATA_PATH), "mode": load_stats['mode'], "load_ms": round(load_stats['seconds'] * 1000, 1),
+    "peak_rss_kb": load_stats['peak_rss_kb'], "orders": load_stats['orders'], "products": load_stats['products'],
+}})
+
+# Under rec_prefork.py (REC_PREFORK=1) the master reloads and each worker syncs,
+# so neither thread is started here: threads don't survive a fork
+PREFORK = os.environ.get("REC_PREFORK", "0") == "1"
+
+# Opt-in: merge records changed on the backend every REC_SYNC_INTERVAL seconds
+SYNC_INTERVAL = float(os.environ.get("REC_SYNC_INTERVAL", 0))
+if SYNC_INTERVAL > 0 and not PREFORK:
+    snapshot.start_sync_loop(SYNC_INTERVAL)
+
+# Opt-in: hot reload when REC_DATA_PATH changes (checked every REC_RELOAD_INTERVAL seconds)
+RELOAD_INTERVAL = float(os.environ.get("REC_RELOAD_INTERVAL", 0))
+if RELOAD_INTERVAL > 0 and not PREFORK:
+    snapshot.start_reload_watcher(DATA_PATH, RELOAD_INTERVAL)
+
+class ResultCache:
+    """
+    Bounded LRU + TTL cache of serialized recommendation responses, keyed by
+    (user_id, data version, variant); the variant is the live cart's contents
+    when it differs from the snapshot's (REC_LIVE_CARTS), else (), with "expand"
+    appended for responses with inlined products. Entries from
+    an older snapshot are dropped as soon as a request sees a newer version, so
+    a reload or delta sync invalidates it; a request still on an older snapshot
+    misses without touching the current entries.
+    """
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._version = None
+        self._entries: "OrderedDict[Tuple[str, int, tuple], Tuple[float, bytes, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id: str, version: int, variant: tuple = ()) -> Optional[Tuple[bytes, str]]:
+        key = (user_id, version, variant)
+        with self._lock:
+            if self._version is None or version > self._version:
+                self._entries.clear()
+                self._version = version
+            elif version < self._version:
+                # a request still on a replaced snapshot: its entries are gone, and put() won't store it
+                self.misses += 1
+                return None
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry[0] > self.ttl:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1], entry[2]
+
+    def put(self, user_id: str, version: int, body: bytes, etag: str, variant: tuple = ()) -> None:
+        if self.max_size <= 0:
+            return
+        key = (user_id, version, variant)
+        with self._lock:
+            if version != self._version:
+                return  # computed on a snapshot that has since been replaced
+            self._entries[key] = (time.monotonic(), body, etag)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+# REC_CACHE_SIZE=0 disables caching
+result_cache = ResultCache(
+    max_size=int(os.environ.get("REC_CACHE_SIZE", 10000)),
+    ttl=float(os.environ.get("REC_CACHE_TTL", 300)),
+)
+CACHE_CONTROL = os.environ.get("REC_CACHE_CONTROL", "public, max-age=60")
+
+REQUEST_SECONDS = metrics.Histogram("rec_http_request_seconds", "HTTP request latency", ["route", "method", "status"])
+RESULT_SOURCE = metrics.Counter("rec_results_total", "Recommendation responses by where the body came from", ["source"])
+metrics.Gauge("rec_result_cache_hits_total", "Result cache hits", lambda: result_cache.hits, kind="counter")
+metrics.Gauge("rec_result_cache_misses_total", "Result cache misses", lambda: result_cache.misses, kind="counter")
+metrics.Gauge("rec_result_cache_entries", "Entries in the result cache", lambda: len(result_cache))
+
+# Opt-in: lay each user's current cart (CartApi.get_by_user_id, cached for
+# REC_LIVE_CART_TTL seconds) over the snapshot's. Consider a shorter or private
+# REC_CACHE_CONTROL with it, so browsers don't keep recommendations for an old cart.
+live_carts = rec.LiveCarts() if os.environ.get("REC_LIVE_CARTS", "0") == "1" else None
+if live_carts is not None:
+    metrics.Gauge("rec_live_cart_cache_entries", "Users in the live cart cache", lambda: len(live_carts))
+
+# Opt-in: serve known users from a store written by precompute.py
+PRECOMPUTED_PATH = os.environ.get("REC_PRECOMPUTED_PATH")
+precomputed = PrecomputedStore(PRECOMPUTED_PATH) if PRECOMPUTED_PATH and Path(PRECOMPUTED_PATH).exists() else None
+
+def _precomputed_lookup(user_id: str, version: int) -> Optional[Tuple[bytes, str]]:
+    if precomputed is None:
+        return None
+    stats = rec.LOAD_STATS
+    # stale once the server has reloaded other data or merged a delta sync
+    if version != stats.get('version') or not precomputed.matches(stats):
+        return None
+    return precomputed.get(user_id)
+
+def _get_results(user_id: Union[int, str], snap=None) -> List[Dict[str, Any]]:
     try:
         uid = user_id 
-        r_history, r_cross, r_occ, r_best = rec.rec_user_converter(uid)
-        results = [r_history, r_cross, r_occ, r_best]
-        print(f"[Recommendation] user_id={user_id} -> {[results[0].get('product_id',''), results[1].get('product_id',''), results[2].get('product_id',''), results[3].get('product_id','')]}") 
-        print(results)
+        # history, cross_selling, occasion, best (and similar with REC_CF=1)
+        results = list(rec.rec_user_converter(uid, snap=snap))
     except Exception as e:
+        log.error("recommendation failed", exc_info=True, extra={"fields": {"user_id": str(user_id)}})
         abort(400, description=f"Error generating recommendations: {e}")
-    return [r_history, r_cross, r_occ, r_best]
+    fields = g.get("log_fields")
+    if fields is not None:
+        fields["product_ids"] = [r.get('product_id', '') for r in results]
+        if log.isEnabledFor(logging.DEBUG):
+            fields["results"] = results
+    return results
+
+@app.before_request
+def _start_timer() -> None:
+    g.started = time.perf_counter()
+
+@app.after_request
+def _observe_request(resp):
+    elapsed = time.perf_counter() - g.get("started", time.perf_counter())
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    REQUEST_SECONDS.observe(elapsed, route, request.method, str(resp.status_code))
+
+    fields = g.get("log_fields")
+    if fields is not None:
+        fields.update(duration_ms=round(elapsed * 1000, 3), status=resp.status_code)
+        if elapsed * 1000 >= LOG_SLOW_MS:
+            log.warning("slow recommendation", extra={"fields": fields})
+        elif random.random() < LOG_SAMPLE_RATE:
+            log.log(logging.DEBUG if "results" in fields else logging.INFO, "recommendation", extra={"fields": fields})
+    return resp
+
+@app.get("/metrics")
+def metrics_endpoint():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
 
 @app.get("/healthz")
 def health():
-    return jsonify({"status": "ok"}), 200
+    stats = rec.LOAD_STATS
+    return jsonify({
+        "status": "ok",
+        "data_version": rec.current_snapshot().version,
+        "load_build_ms": round(stats.get('build_seconds', 0) * 1000, 3),
+        "load_swap_us": round(stats.get('swap_seconds', 0) * 1e6, 3),
+        "loaded_at": stats.get('loaded_at'),
+    }), 200
+
+def _recommend_response(user_id: str):
+    # pin the snapshot, and read its version once up front: apply_delta and update_stock
+    # bump it on this same object, and a body computed from the data before a bump
+    # must not be cached under the version after it
+    snap = rec.current_snapshot()
+    version = snap.version
+    fields = g.log_fields = {"user_id": user_id, "data_version": version}
+    # ?expand=product (or 1): inline each recommended product's name, price and image
+    expand = request.args.get("expand", "") in ("product", "1")
+    variant: tuple = ()
+    if live_carts is not None:
+        cart = live_carts.get(user_id)  # None: use the snapshot's cart
+        if cart is not None and rec.cart_key(cart) != rec.cart_key(snap.cart_by_user.get(user_id)):
+            snap = snap.with_cart(user_id, cart)
+            variant = rec.cart_key(cart)
+            fields["live_cart"] = True
+
+    if expand:
+        fields["expand"] = True
+    cache_variant = variant + ("expand",) if expand else variant
+
+    source = "precomputed"
+    # precomputed results used the snapshot's cart
+    cached = _precomputed_lookup(user_id, version) if not variant else None
+    if cached is not None and expand:
+        # stored without products; inlining them costs far less than computing
+        body = responses.results_body(json.loads(cached[0]), snap, expand=True, version=version)
+        cached = body, responses.etag(body)
+    if cached is None:
+        source = "cache"
+        cached = result_cache.get(user_id, version, cache_variant)
+    if cached is None:
+        source = "live"
+        body = responses.results_body(_get_results(user_id, snap), snap, expand, version)
+        etag = responses.etag(body)
+        result_cache.put(user_id, version, body, etag, cache_variant)
+    else:
+        body, etag = cached
+    fields["source"] = source
+    RESULT_SOURCE.inc(source)
+
+    resp = app.response_class(body, status=200, mimetype="application/json")
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = CACHE_CONTROL
+    # answers If-None-Match with an empty 304
+    return resp.make_conditional(request)
 
 @app.get("/api/v1/recommend/<user_id>")
 def recommend_path(user_id: str):
-    return jsonify(_get_results(user_id)), 200
+    return _recommend_response(user_id)
+
+BATCH_MAX_USERS = int(os.environ.get("REC_BATCH_MAX_USERS", 50000))
+
+def _batch_records(user_ids: List[str], snap, per_user_errors: bool = False):
+    if not per_user_errors:
+        for uid, results in rec.rec_user_converter_batch(user_ids, snap=snap):
+            yield {"user_id": uid, "recommendations": list(results)}
+        return
+    for uid in user_ids:
+        try:
+            results = list(rec.rec_user_converter(uid, snap=snap))
+        except Exception as e:
+            log.error("recommendation failed", exc_info=True, extra={"fields": {"user_id": uid, "batch": True}})
+            yield {"user_id": uid, "error": f"Error generating recommendations: {e}"}
+            continue
+        yield {"user_id": uid, "recommendations": results}
+
+@app.post("/api/v1/recommend/batch")
+def recommend_batch():
+    """
+    Body: {"user_ids": [...]}. Returns {"results": [{"user_id", "recommendations"}, ...]}
+    in request order, or one such record per line (NDJSON) with ?stream=1 or
+    Accept: application/x-ndjson, which keeps memory flat for large batches.
+    A streamed response has already sent its 200 when a user fails, so that
+    user's line is {"user_id", "error"} instead and the stream carries on.
+    """
+    payload = request.get_json(silent=True)
+    user_ids = payload.get("user_ids") if isinstance(payload, dict) else None
+    if not isinstance(user_ids, list) or not all(isinstance(u, (str, int)) for u in user_ids):
+        abort(400, description="Expected JSON body {\"user_ids\": [...]}")
+    if len(user_ids) > BATCH_MAX_USERS:
+        abort(413, description=f"At most {BATCH_MAX_USERS} user_ids per batch")
+    user_ids = [str(u) for u in user_ids]
+
+    # one snapshot for the whole batch, even if a reload lands halfway through
+    snap = rec.current_snapshot()
+    stream = request.args.get("stream") == "1" or request.accept_mimetypes.best == "application/x-ndjson"
+    if stream:
+        lines = (json.dumps(record) + "\n" for record in _batch_records(user_ids, snap, per_user_errors=True))
+        return Response(stream_with_context(lines), mimetype="application/x-ndjson")
+    try:
+        results = list(_batch_records(user_ids, snap))
+    except Exception as e:
+        abort(400, description=f"Error generating recommendations: {e}")
+    return jsonify({"results": results}), 200
 
 @app.get("/api/v1/recommend")
 def recommend_query():
     uid = request.args.get("user_id")
     if not uid:
         abort(400, description="Missing user_id")
-    return jsonify(_get_results(uid)), 200
+    return _recommend_response(uid)
+
+# Opt-in: the backend can push stock changes instead of waiting for the next sync.
+# Requires "Authorization: Bearer $REC_PUSH_TOKEN"; the route is off when unset.
+# Each worker process holds its own snapshot, so with several workers push to
+# each of them (or keep REC_SYNC_INTERVAL on to converge).
+PUSH_TOKEN = os.environ.get("REC_PUSH_TOKEN")
+STOCK_PUSHES = metrics.Counter("rec_stock_push_products_total", "Products in stock pushes by outcome", ["outcome"])
+
+def _valid_stock_change(change: Any) -> bool:
+    if not isinstance(change, dict) or not isinstance(change.get("product_id"), str):
+        return False
+    if not ("stock" in change or "available" in change):
+        return False
+    stock = change.get("stock", 0)
+    return (isinstance(stock, int) and not isinstance(stock, bool)
+            and isinstance(change.get("available", True), bool))
+
+@app.post("/api/v1/products/stock")
+def push_stock():
+    """
+    Body: {"products": [{"product_id", "stock"?, "available"?}, ...]}. Applied to the
+    live snapshot in place (rec.update_stock); products whose sellability flips join
+    or leave the candidate pools. Returns the updated, flipped and unknown product ids.
+    """
+    if not PUSH_TOKEN:
+        abort(404)
+    if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {PUSH_TOKEN}"):
+        abort(401, description="Invalid push token")
+    payload = request.get_json(silent=True)
+    changes = payload.get("products") if isinstance(payload, dict) else None
+    if not isinstance(changes, list) or not all(_valid_stock_change(c) for c in changes):
+        abort(400, description="Expected JSON body {\"products\": [{\"product_id\", \"stock\", \"available\"}]}")
+    result = rec.update_stock(changes)
+    for outcome, pids in result.items():
+        if pids:
+            STOCK_PUSHES.inc(outcome, amount=len(pids))
+    log.info("stock pushed", extra={"fields": {k: len(v) for k, v in result.items()}})
+    return jsonify({**result, "data_version": rec.current_snapshot().version}), 200
 
+# Flask's development server, one process. In production run rec_prefork.py,
+# which serves this app from pre-forked workers sharing one loaded snapshot.
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8000))
     debug = os.environ.get("FLASK_DEBUG", "0") == "1"
@@ -1,28 +1,118 @@
+import asyncio
+import bisect
+import copy
+import functools
+import heapq
+import itertools
 import json
-from datetime import datetime, timedelta
-from collections import Counter, defaultdict
+import mmap
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from array import array
+from datetime import date, datetime, timedelta
+from collections import ChainMap, Counter, OrderedDict, defaultdict
 from itertools import combinations
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+try:
+    import numpy as np
+except ImportError:  # only needed for REC_HIS_ENGINE=numpy and REC_CF=1
+    np = None
+
+try:
+    import aiohttp
+except ImportError:  # only needed for AsyncApi (rec_asgi.py)
+    aiohttp = None
 
 import re
 from typing import Dict, Iterable, List, Mapping, MutableMapping, Sequence, Set, Tuple,  Optional
 ProductID = str
 
+# Snapshot written by snapshot.py (extract_to_json / extract_to_binary) and read by load_data
+DATA_PATH = os.environ.get("REC_DATA_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data.json"))
+
+# rec_user_his candidate search: "loop" (default) or "numpy" (vectorized, needs numpy)
+HIS_ENGINE = os.environ.get("REC_HIS_ENGINE", "loop")
+
+# Opt-in: item-item collaborative filtering ("similar", after best; needs numpy).
+# The neighbour index is built with every snapshot, within a time and memory budget.
+CF_ENABLED = os.environ.get("REC_CF", "0") == "1"
+CF_NEIGHBORS = int(os.environ.get("REC_CF_NEIGHBORS", 20))            # neighbours kept per product
+CF_MAX_USER_ITEMS = int(os.environ.get("REC_CF_MAX_USER_ITEMS", 200))  # a user's most recent distinct products used
+CF_BUDGET = float(os.environ.get("REC_CF_BUDGET", 10))                # seconds per build
+CF_MAX_MB = float(os.environ.get("REC_CF_MAX_MB", 256))               # memory per build
+
 ############# BE data extract
 
-API_BASE = "https://frontend-ec-project-server.onrender.com"
+API_BASE = os.environ.get("REC_API_BASE", "https://frontend-ec-project-server.onrender.com")
 # API_BASE = "http://localhost:5001"
 
+API_TIMEOUT = float(os.environ.get("REC_API_TIMEOUT", 10))       # seconds, per request
+API_RETRIES = int(os.environ.get("REC_API_RETRIES", 3))
+FETCH_WORKERS = int(os.environ.get("REC_FETCH_WORKERS", 4))      # concurrent requests during extraction
+ASYNC_MAX_INFLIGHT = int(os.environ.get("REC_ASYNC_MAX_INFLIGHT", 100))  # AsyncApi requests in flight per process
+
+# LiveCarts: how long a fetched cart is reused, how many are kept, how long a request waits for one
+LIVE_CART_TTL = float(os.environ.get("REC_LIVE_CART_TTL", 30))
+LIVE_CART_CACHE_SIZE = int(os.environ.get("REC_LIVE_CART_CACHE_SIZE", 10000))
+LIVE_CART_TIMEOUT = float(os.environ.get("REC_LIVE_CART_TIMEOUT", 0.3))
+
+
+class _ApiSession(requests.Session):
+    '''requests.Session with a default timeout (requests has none)'''
+    def __init__(self, timeout):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+def _make_session():
+    s = _ApiSession(API_TIMEOUT)
+    # retry idempotent GETs with exponential backoff (0.5s, 1s, 2s, ...)
+    retry = Retry(
+        total=API_RETRIES,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset({"GET"}),
+    )
+    adapter = HTTPAdapter(max_retries=retry, pool_maxsize=max(FETCH_WORKERS, 10))
+    s.mount("http://", adapter)
+    s.mount("https://", adapter)
+    s.headers.update({"Content-Type": "application/json"})
+    return s
+
 # Shared session (similar to axiosClient)
-session = requests.Session()
-session.headers.update({"Content-Type": "application/json"})
+session = _make_session()
+
+def _reset_session():
+    # a forked worker (rec_prefork.py) must not reuse the parent's pooled connections
+    global session
+    session = _make_session()
+
+os.register_at_fork(after_in_child=_reset_session)
 
 
 class CartApi:
     @staticmethod
-    def get_all():
-        return session.get(f"{API_BASE}/api/carts").json()
+    def get_all(params=None):
+        return session.get(f"{API_BASE}/api/carts", params=params).json()
 
     @staticmethod
     def get_by_user_id(user_id):
@@ -68,8 +158,8 @@ class ProductApi:
 
 class OrderApi:
     @staticmethod
-    def get_all():
-        return session.get(f"{API_BASE}/api/orders").json()
+    def get_all(params=None):
+        return session.get(f"{API_BASE}/api/orders", params=params).json()
 
     @staticmethod
     def get_by_id(order_id):
@@ -87,16 +177,87 @@ class OrderApi:
     def update(order_id, data):
         return session.put(f"{API_BASE}/api/orders/{order_id}", json=data).json()
     
-def get_all_products():
-    total_page = ProductApi.get_all()
-    total_page = total_page.get("totalPages", 1)
-    all_products = []
-    for page in range(0, total_page):
-        response = ProductApi.get_all(params={"page": page + 1})
-        all_products.extend(response.get("products", []))
+class AsyncApi:
+    '''
+    Non-blocking counterpart of CartApi / OrderApi / ProductApi, for the ASGI
+    server (rec_asgi.py). All calls share one aiohttp session whose keep-alive
+    pool holds at most max_inflight connections, so at most that many requests
+    are in flight; the rest wait for a connection. Create it inside the running
+    event loop and close it with aclose(). There are no retries: callers on the
+    request path have a timeout and a fallback instead.
+    Reads return the decoded JSON, or None when the backend answers 404.
+    '''
+    def __init__(self, base=None, max_inflight=None, timeout=None):
+        if aiohttp is None:
+            raise RuntimeError("AsyncApi needs aiohttp (pip install aiohttp)")
+        self.base = (base or API_BASE).rstrip("/")
+        self.max_inflight = max_inflight or ASYNC_MAX_INFLIGHT
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.max_inflight),
+            timeout=aiohttp.ClientTimeout(total=timeout or API_TIMEOUT),
+            headers={"Content-Type": "application/json"},
+        )
+
+    async def get(self, path, params=None):
+        async with self.session.get(f"{self.base}{path}", params=params) as resp:
+            if resp.status == 404:
+                return None
+            resp.raise_for_status()
+            return await resp.json(content_type=None)
+
+    async def get_cart_by_user_id(self, user_id):
+        return await self.get(f"/api/carts/{user_id}")
+
+    async def get_orders_by_user_id(self, user_id):
+        return await self.get(f"/api/orders/user/{user_id}")
+
+    async def get_product_by_id(self, product_id):
+        return await self.get(f"/api/products/{product_id}")
+
+    async def aclose(self):
+        await self.session.close()
+
+# Seconds spent per endpoint during the last fetch_all_data call
+FETCH_TIMINGS = {}
+# Counts from the last fetch_all_data call (product_pages), kept apart so
+# FETCH_TIMINGS holds seconds only
+FETCH_COUNTS = {}
+
+# High-water mark (latest updatedAt seen) per collection during extraction;
+# saved next to the snapshot and carried by Snapshot.sync_state for sync_delta
+SYNC_STATE = {}
+
+def _advance_watermark(collection, records, state=SYNC_STATE):
+    latest = max((r.get("updatedAt", "") for r in records), default="")
+    if latest > state.get(collection, ""):
+        state[collection] = latest
+
+def _sync_state_path(data_path):
+    # sidecar next to the snapshot, so the server knows how fresh the snapshot is
+    return f"{data_path}.sync.json"
+
+def _timed(name, fn, *args):
+    started = time.perf_counter()
+    try:
+        return fn(*args)
+    finally:
+        FETCH_TIMINGS[name] = time.perf_counter() - started
+
+def get_all_products(max_workers=None, params=None):
+    # page 1 also tells us totalPages, so it is kept instead of being fetched twice
+    first = ProductApi.get_all(params={**(params or {}), "page": 1})
+    total_page = first.get("totalPages", 1)
+    all_products = list(first.get("products", []))
+    if total_page > 1:
+        with ThreadPoolExecutor(max_workers=max_workers or FETCH_WORKERS) as pool:
+            # map keeps page order
+            pages = pool.map(lambda page: ProductApi.get_all(params={**(params or {}), "page": page}), range(2, total_page + 1))
+            for response in pages:
+                all_products.extend(response.get("products", []))
+    FETCH_COUNTS['product_pages'] = total_page
     return all_products
 
-def convert_carts():
+def convert_carts(carts=None):
     '''
     Convert New to Old 
     Old cart structure:
@@ -133,23 +294,23 @@ def convert_carts():
         "updatedAt": str,
         "__v": int}
     '''
-    carts = CartApi.get_all()
-    carts_new = []
-    for cart in carts:
-        new_cart = {
-            "user_id": cart["user_id"],  # convert to int
-            "products": [
-                {
-                    "product_id": item["product_id"],
-                    "quantity": item["quantity"]
-                } for item in cart.get("items", [])
-            ]
-        }
-        carts_new.append(new_cart)
-    
-    return carts_new
+    if carts is None:
+        carts = CartApi.get_all()
+        _advance_watermark('carts', carts)
+    return [_convert_cart(cart) for cart in carts]
 
-def conver_orders():
+def _convert_cart(cart):
+    return {
+        "user_id": cart["user_id"],  # convert to int
+        "products": [
+            {
+                "product_id": item["product_id"],
+                "quantity": item["quantity"]
+            } for item in cart.get("items", [])
+        ]
+    }
+
+def conver_orders(orders=None):
     '''
     Convert orders (New) into oders and order_items (Old)
     
@@ -211,37 +372,42 @@ def conver_orders():
         "__v": 0
         }
     '''
-    orders = OrderApi.get_all()
+    if orders is None:
+        orders = OrderApi.get_all()
+        _advance_watermark('orders', orders)
     orders_new = []
     order_items_new = []
     for order in orders:
-        new_order = {
-            "order_id": order["_id"],
-            "user_id": order["user_id"],
-            "order_date": order["createdAt"][:10],  # extract date part
-            "shipping_address": order["shipping_address"],
-            "total_amount": order["subtotal"],
-            "off_price": order["off_price"],
-            "status": order["status"]
-        }
+        new_order, new_order_items = _convert_order(order)
         orders_new.append(new_order)
-        
-        new_order_items = {
-            "order_id": order["_id"],
-            "products": [
-                {
-                    "product_id": item["product_id"],
-                    "option": {},  # default to empty
-                    "price": item["subtotal"] / item["quantity"] if item["quantity"] > 0 else 0,  # calculate unit price
-                    "quantity": item["quantity"],
-                    "off_price": item["off_price"]
-                } for item in order.get("items", [])
-            ]
-        }
         order_items_new.append(new_order_items)
     return orders_new, order_items_new
 
-def convert_products():
+def _convert_order(order):
+    new_order = {
+        "order_id": order["_id"],
+        "user_id": order["user_id"],
+        "order_date": order["createdAt"][:10],  # extract date part
+        "shipping_address": order["shipping_address"],
+        "total_amount": order["subtotal"],
+        "off_price": order["off_price"],
+        "status": order["status"]
+    }
+    new_order_items = {
+        "order_id": order["_id"],
+        "products": [
+            {
+                "product_id": item["product_id"],
+                "option": {},  # default to empty
+                "price": item["subtotal"] / item["quantity"] if item["quantity"] > 0 else 0,  # calculate unit price
+                "quantity": item["quantity"],
+                "off_price": item["off_price"]
+            } for item in order.get("items", [])
+        ]
+    }
+    return new_order, new_order_items
+
+def convert_products(max_workers=None, products=None):
     '''
     Convert New to Old 
     Old product structure:
@@ -307,32 +473,47 @@ def convert_products():
             "condition": "New arrive"
         }
     '''
-    products = get_all_products()
-    products_new = []
-    for product in products:
-        new_product = {
-            "product_id": product["_id"],
-            "type": "flower",  # default to flower
-            "name": product["name"],
-            "price": product.get("dynamicPrice", product["price"]),
-            "stock": product["stock"],
-            "available": product["available"],
-            "description": product["description"],
-            "image_url": product["image_url"],
-            "flower_details": {
-                "occasion": product.get("occasions", []),
-                "color": product.get("colors", []),
-                "flower_type": ", ".join(product.get("flower_type", [])),
-                "options": []  # default to empty
-            }
+    if products is None:
+        products = get_all_products(max_workers)
+        _advance_watermark('products', products)
+    return [_convert_product(product) for product in products]
+
+def _convert_product(product):
+    return {
+        "product_id": product["_id"],
+        "type": "flower",  # default to flower
+        "name": product["name"],
+        "price": product.get("dynamicPrice", product["price"]),
+        "stock": product["stock"],
+        "available": product["available"],
+        "description": product["description"],
+        "image_url": product["image_url"],
+        "flower_details": {
+            "occasion": product.get("occasions", []),
+            "color": product.get("colors", []),
+            "flower_type": ", ".join(product.get("flower_type", [])),
+            "options": []  # default to empty
         }
-        products_new.append(new_product)
-    return products_new
+    }
 
-def fetch_all_data():
-    carts = convert_carts()
-    products = convert_products()
-    orders, order_items = conver_orders()
+def fetch_all_data(max_workers=None):
+    '''
+    Fetch carts, products and orders concurrently. Product pages are fetched
+    in parallel too, with at most max_workers (REC_FETCH_WORKERS) requests in
+    flight for the page listing. Per-endpoint timings land in FETCH_TIMINGS,
+    the number of product pages in FETCH_COUNTS.
+    '''
+    FETCH_TIMINGS.clear()
+    FETCH_COUNTS.clear()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        carts_job = pool.submit(_timed, 'carts', convert_carts)
+        products_job = pool.submit(_timed, 'products', convert_products, max_workers)
+        orders_job = pool.submit(_timed, 'orders', conver_orders)
+        carts = carts_job.result()
+        products = products_job.result()
+        orders, order_items = orders_job.result()
+    FETCH_TIMINGS['total'] = time.perf_counter() - started
     return {
         "carts": carts,
         "products": products,
@@ -340,29 +521,130 @@ def fetch_all_data():
         "order_items": order_items
     }
     
-def extract_to_json():
+def extract_to_json(data_path=None):
+    '''
+    Fetch everything from the backend and write a snapshot for load_data.
+    Written to a temp file first and renamed, so a running server never reads
+    a half-written snapshot.
+    '''
+    data_path = str(data_path or DATA_PATH)
     data = fetch_all_data()
-    with open("data.json", "w", encoding="utf-8") as f:
+    tmp_path = f"{data_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
         json.dump(data, f, ensure_ascii=False, indent=4)
+    os.replace(tmp_path, data_path)
+    with open(_sync_state_path(data_path), "w", encoding="utf-8") as f:
+        json.dump(SYNC_STATE, f)
+    return data_path
 
-extract_to_json()
+def extract_to_binary(data_path=None):
+    '''
+    extract_to_json's sibling: fetch everything and write a binary snapshot
+    (write_binary_snapshot), which load_data memory-maps instead of parsing.
+    '''
+    data = fetch_all_data()
+    snap = Snapshot(OrderStore(data["orders"], data["order_items"]), data["products"], data["carts"], SYNC_STATE)
+    return write_binary_snapshot(snap, data_path or DATA_PATH)
 
 ############# Utility function
 
-def init_data(data_path = 'data.json'):
+_DATA_SECTIONS = ("carts", "products", "orders", "order_items")
+
+def iter_json_sections(data_path = 'data.json', chunk_size = 1 << 16):
+    '''
+    Stream data.json one record at a time instead of json.load-ing it whole.
+    Yields (section, record) for every element of the top-level arrays
+    (carts, products, orders, order_items); only the current chunk of text and
+    the record being decoded are held in memory.
+    '''
+    decoder = json.JSONDecoder()
+    with open(data_path, 'r', encoding='utf-8') as file:
+        buf = ''
+        pos = 0
+        eof = False
+
+        def fill():
+            nonlocal buf, pos, eof
+            chunk = file.read(chunk_size)
+            if not chunk:
+                eof = True
+            buf = buf[pos:] + chunk
+            pos = 0
+
+        def skip_ws():
+            nonlocal pos
+            while True:
+                while pos < len(buf) and buf[pos] in ' \t\r\n':
+                    pos += 1
+                if pos < len(buf) or eof:
+                    return
+                fill()
+
+        def peek():
+            skip_ws()
+            if pos >= len(buf):
+                raise ValueError(f"Unexpected end of {data_path}")
+            return buf[pos]
+
+        def expect(char):
+            nonlocal pos
+            if peek() != char:
+                raise ValueError(f"Expected {char!r} at offset {pos} in {data_path}")
+            pos += 1
+
+        def decode():
+            nonlocal pos
+            skip_ws()
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buf, pos)
+                    # a value ending exactly at the buffer edge may be truncated (e.g. a number)
+                    if end < len(buf) or eof:
+                        pos = end
+                        return value
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                fill()
+
+        expect('{')
+        while peek() != '}':
+            if buf[pos] == ',':
+                pos += 1
+            section = decode()
+            expect(':')
+            if peek() != '[':
+                decode()  # scalar / object sections are not part of the dataset
+                continue
+            pos += 1
+            while peek() != ']':
+                if buf[pos] == ',':
+                    pos += 1
+                    continue
+                yield section, decode()
+            pos += 1
+
+def init_data(data_path = 'data.json', stream = False):
     
-    # Open the file and load the JSON data
-    with open(data_path, 'r') as file:
-        data = json.load(file)
+    if stream:
+        # Parse section by section, never materializing the whole document
+        data = {section: [] for section in _DATA_SECTIONS}
+        for section, record in iter_json_sections(data_path):
+            data.setdefault(section, []).append(record)
+    else:
+        # Open the file and load the JSON data
+        with open(data_path, 'r') as file:
+            data = json.load(file)
         
     # Extract arrays from data
     orders = data.get("orders", [])
     #orders = [order for order in orders if order.get('status','') == 'Done']
     
-    orders_id_list = [order['order_id'] for order in orders]
+    # hash-set join: O(orders + order_items) instead of a list scan per item
+    orders_id_set = {order['order_id'] for order in orders}
     
     order_items = data.get("order_items", [])
-    order_items = [order_item for order_item in order_items if order_item.get('order_id',-1) in orders_id_list]
+    order_items = [order_item for order_item in order_items if order_item.get('order_id',-1) in orders_id_set]
     
     products = data.get("products", [])
     carts = data.get('carts',[])
@@ -370,13 +652,13 @@ def init_data(data_path = 'data.json'):
     return orders, order_items, products, carts
 
 
-def extract_type(product_ids, products, type_filter = ['flower']):
+def extract_type(product_ids, snap, type_filter = ['flower']):
     
     product_types = []
     # Iterate through each product_id
     for product_id in product_ids:
         # Find the product
-        product = next((p for p in products if p["product_id"] == product_id), None)
+        product = snap.product_by_id.get(product_id)
         if product and product["type"] in type_filter and "flower_details" in product:
             product_types.append({
                 'type' : product.get('type',''),
@@ -406,58 +688,438 @@ def user_data_counter(user_product_types):
     
     return type_count, flower_count, color_count
 
-def _is_sellable(pid):
-    p = _PRODUCT_BY_ID.get(pid)
+def _is_sellable(pid, snap):
+    # snap.sellable is kept current by apply_delta / update_stock
+    return pid in snap.sellable
+
+def _product_sellable(p):
     if not p or not p.get("available", True):
         return False
     # if flowers with options, check any option has stock > 0; otherwise use top-level stock
     return p.get("stock", 0) > 0
 
+############# Order store
+
+@functools.lru_cache(maxsize=4096)
+def _day_ordinal(order_date):
+    # order dates are ISO (createdAt[:10]) and repeat a lot, so parse each one once;
+    # strptime stays as the fallback for non-padded dates like 2025-3-4
+    try:
+        return date.fromisoformat(order_date).toordinal()
+    except ValueError:
+        return datetime.strptime(order_date, "%Y-%m-%d").toordinal()
+
+def _order_day(order):
+    return _day_ordinal(order["order_date"])
+
+# item_span = first_line << _SPAN_BITS | line_count
+_SPAN_BITS = 16
+_SPAN_MASK = (1 << _SPAN_BITS) - 1
+
+# OrderStore columns and their array typecodes
+_ORDER_COLUMNS = (('order_user', 'i'), ('order_day', 'i'), ('item_span', 'q'),
+                  ('item_product', 'i'), ('item_qty', 'i'), ('item_price', 'd'))
+
+class _RowsByUser(Mapping):
+    '''orders_by_user of a memory-mapped OrderStore: user_id -> that user's slice of the row column.'''
+    def __init__(self, user_index, user_ids, start, rows):
+        self.user_index = user_index
+        self.user_ids = user_ids
+        self.start = start
+        self.rows = rows
+        self.size = sum(1 for i in range(len(start) - 1) if start[i] != start[i + 1])
+
+    def __getitem__(self, user_id):
+        i = self.user_index[user_id]
+        # users interned by a sync after this mapping was read are past the end
+        if i + 1 >= len(self.start) or self.start[i] == self.start[i + 1]:
+            raise KeyError(user_id)
+        return self.rows[self.start[i]:self.start[i + 1]]
+
+    def __iter__(self):
+        start = self.start
+        return (self.user_ids[i] for i in range(len(start) - 1) if start[i] != start[i + 1])
+
+    def __len__(self):
+        return self.size
+
+class OrderStore:
+    '''
+    Orders and order_items in columnar form, keeping only what the recommenders
+    read. User and product ids are interned to ints; everything else lives in
+    flat arrays instead of one dict per order line.
+        - per order row: order_user, order_day (date ordinal), item_span (first line row
+          and line count packed in one int, so sync replaces both in one assignment)
+        - per line row: item_product, item_qty, item_price (option price if present, else product price)
+        - order_row: order_id -> order row
+        - orders_by_user: user_id -> array of order rows, newest first
+    Rows are append-only: when sync replaces the lines of an order, new line rows
+    are appended and the old ones are left unreferenced until the next full load.
+    A store read from a binary snapshot (from_columns) is frozen: its columns are
+    read-only views of the mapped file, copied into arrays by the first sync.
+    '''
+    def __init__(self, orders=(), order_items=()):
+        self.user_ids: List[str] = []
+        self.user_index: Dict[str, int] = {}
+        self.product_ids: List[ProductID] = []
+        self.product_index: Dict[ProductID, int] = {}
+        self._order_row: Optional[Dict[str, int]] = {}
+        self._order_ids = None
+        self.frozen = False
+        self.order_user = array('i')
+        self.order_day = array('i')
+        self.item_span = array('q')
+        self.item_product = array('i')
+        self.item_qty = array('i')
+        self.item_price = array('d')
+        self.orders_by_user: Dict[str, array] = {}
+        self.dead_lines = 0
+        # order_items read before their order; whatever is left at finish() is dropped
+        self._pending = {}
+        for order in orders:
+            self.add_order(order)
+        for order_item in order_items:
+            self.add_order_item(order_item)
+        self.finish()
+
+    @classmethod
+    def from_columns(cls, columns, user_ids, product_ids, order_ids, user_start, user_rows):
+        '''
+        Frozen store over existing columns (memoryviews of a binary snapshot).
+            - columns: name -> sequence, for every name in _ORDER_COLUMNS, with no dead lines
+            - order_ids: callable returning the order_id of each order row, called
+              on first use of order_row (only loading and sync need it)
+            - user_start, user_rows: order rows per user index, newest first, as
+              user_rows[user_start[i]:user_start[i + 1]]
+        '''
+        store = cls()
+        for name, _typecode in _ORDER_COLUMNS:
+            setattr(store, name, columns[name])
+        store.user_ids = list(user_ids)
+        store.user_index = {user_id: i for i, user_id in enumerate(store.user_ids)}
+        store.product_ids = list(product_ids)
+        store.product_index = {pid: i for i, pid in enumerate(store.product_ids)}
+        store._order_ids = order_ids
+        store._order_row = None
+        store.orders_by_user = _RowsByUser(store.user_index, store.user_ids, user_start, user_rows)
+        store.frozen = True
+        return store
+
+    @property
+    def order_row(self):
+        # built on first use for frozen stores: only loading and sync look orders up by id
+        if self._order_row is None:
+            self._order_row = {order_id: row for row, order_id in enumerate(self._order_ids())}
+        return self._order_row
+
+    def _thaw(self):
+        # copy-on-write: the first change copies the mapped columns into private arrays
+        if not self.frozen:
+            return
+        for name, typecode in _ORDER_COLUMNS:
+            column = array(typecode)
+            column.frombytes(getattr(self, name).cast('B'))
+            setattr(self, name, column)
+        self.orders_by_user = dict(self.orders_by_user.items())
+        self.frozen = False
+
+    def _user(self, user_id):
+        i = self.user_index.get(user_id)
+        if i is None:
+            i = self.user_index[user_id] = len(self.user_ids)
+            self.user_ids.append(user_id)
+        return i
+
+    def _product(self, pid):
+        i = self.product_index.get(pid)
+        if i is None:
+            i = self.product_index[pid] = len(self.product_ids)
+            self.product_ids.append(pid)
+        return i
+
+    def __len__(self):
+        return len(self.order_user)
+
+    def line_count(self):
+        return len(self.item_product) - self.dead_lines
+
+    ### loading: the first record per order_id wins, like the old dict indexes
+
+    def add_order(self, order):
+        if order['order_id'] in self.order_row:
+            return
+        row = self.order_row[order['order_id']] = len(self.order_user)
+        self.order_user.append(self._user(order['user_id']))
+        self.order_day.append(_order_day(order))
+        self.item_span.append(-1)  # -1: no order_item yet
+        pending = self._pending.pop(order['order_id'], None)
+        if pending is not None:
+            self._set_lines(row, pending['products'])
+
+    def add_order_item(self, order_item):
+        row = self.order_row.get(order_item.get('order_id', -1))
+        if row is None:
+            self._pending.setdefault(order_item.get('order_id', -1), order_item)
+        elif self.item_span[row] < 0:
+            self._set_lines(row, order_item['products'])
+
+    def finish(self):
+        '''Drop order_items without an order and group order rows per user, newest first.'''
+        self._pending = {}
+        rows_by_user = defaultdict(list)
+        for row, user in enumerate(self.order_user):
+            rows_by_user[user].append(row)
+        day = self.order_day
+        # sort is stable, so orders on the same day keep their file order
+        self.orders_by_user = {
+            self.user_ids[user]: array('i', sorted(rows, key=day.__getitem__, reverse=True))
+            for user, rows in rows_by_user.items()
+        }
+        return self
+
+    def _set_lines(self, row, products):
+        if len(products) > _SPAN_MASK:
+            raise ValueError(f"order with {len(products)} lines, at most {_SPAN_MASK} supported")
+        start = len(self.item_product)
+        for product in products:
+            opt = product.get('option') or {}
+            self.item_product.append(self._product(product.get('product_id', '')))
+            self.item_qty.append(int(product.get('quantity', 0) or 0))
+            self.item_price.append(float(opt.get('price', product.get('price', 0.0) or 0.0)))
+        old = self.item_span[row]
+        if old >= 0:
+            self.dead_lines += old & _SPAN_MASK
+        self.item_span[row] = start << _SPAN_BITS | len(products)
+
+    ### reading
+
+    def _range(self, row):
+        span = self.item_span[row]
+        if span < 0:
+            return 0, 0
+        start = span >> _SPAN_BITS
+        return start, start + (span & _SPAN_MASK)
+
+    def lines(self, row):
+        '''(product_id, quantity, unit_price) of an order row.'''
+        start, end = self._range(row)
+        ids = self.product_ids
+        return [(ids[p], q, price) for p, q, price in zip(self.item_product[start:end], self.item_qty[start:end], self.item_price[start:end])]
+
+    def product_ids_of(self, row):
+        start, end = self._range(row)
+        ids = self.product_ids
+        return [ids[p] for p in self.item_product[start:end]]
+
+    def iter_lines(self):
+        '''All live lines as (product_id, quantity, unit_price), in the order they were read.'''
+        ids = self.product_ids
+        if not self.dead_lines:
+            for p, q, price in zip(self.item_product, self.item_qty, self.item_price):
+                yield ids[p], q, price
+            return
+        for row in sorted((r for r in range(len(self)) if self.item_span[r] >= 0), key=self.item_span.__getitem__):
+            yield from self.lines(row)
+
+    def user_products(self, user_id, limit=None):
+        '''Distinct product indices bought by user_id, most recent order first (at most limit).'''
+        seen = {}
+        for row in self.orders_by_user.get(user_id, ()):
+            start, end = self._range(row)
+            for p in self.item_product[start:end]:
+                seen.setdefault(p, None)
+            if limit and len(seen) >= limit:
+                break
+        return list(seen)[:limit]
+
+    def baskets(self):
+        '''Product ids per order, for orders that have an order_item.'''
+        for row in range(len(self)):
+            if self.item_span[row] >= 0:
+                yield self.product_ids_of(row)
+
+    ### sync
+
+    def _insert_user_row(self, row):
+        # newest first, same-day orders by row (the order they were read), like the stable sort at load;
+        # a moved order goes back to its row's place among them, not after them
+        user_id = self.user_ids[self.order_user[row]]
+        rows = array('i', self.orders_by_user.get(user_id, ()))
+        day = self.order_day
+        pos = bisect.bisect_right(rows, (-day[row], row), key=lambda r: (-day[r], r))
+        rows.insert(pos, row)
+        self.orders_by_user[user_id] = rows
+
+    def upsert_order(self, order):
+        self._thaw()
+        row = self.order_row.get(order['order_id'])
+        if row is None:
+            self.add_order(order)
+            self._insert_user_row(self.order_row[order['order_id']])
+            return
+        user, day = self._user(order['user_id']), _order_day(order)
+        if (self.order_user[row], self.order_day[row]) == (user, day):
+            return
+        old_user_id = self.user_ids[self.order_user[row]]
+        self.orders_by_user[old_user_id] = array('i', (r for r in self.orders_by_user.get(old_user_id, ()) if r != row))
+        self.order_user[row] = user
+        self.order_day[row] = day
+        self._insert_user_row(row)
+
+    def replace_lines(self, order_item):
+        '''Set the lines of a known order; returns its previous lines.'''
+        self._thaw()
+        row = self.order_row[order_item['order_id']]
+        old = self.lines(row)
+        self._set_lines(row, order_item['products'])
+        return old
+
+############# Indexes
+
+_POOL_CHUNK = 64
+
+class ProductPool:
+    '''
+    The sellable products of one flower_type, color or occasion, in catalog
+    order; iterate it like a list. They are kept in chunks of 1 to
+    2 * _POOL_CHUNK products, so put / drop (a stock flip, a catalog edit) copy
+    one chunk and the list of chunks, O(_POOL_CHUNK + size / _POOL_CHUNK),
+    instead of the whole pool. A pool is never changed in place: put and drop
+    return a new one sharing the untouched chunks, which the writer swaps into
+    the index with one assignment, so a concurrent reader iterates either the
+    old pool or the new one.
+    '''
+    __slots__ = ('chunks', 'heads', 'size')
+
+    def __init__(self, chunks, heads, size):
+        self.chunks = chunks  # lists of product dicts
+        self.heads = heads    # catalog position of each chunk's first product
+        self.size = size
+
+    @classmethod
+    def from_products(cls, products, product_pos):
+        '''Pool of `products`, already in catalog order.'''
+        chunks = [products[i:i + _POOL_CHUNK] for i in range(0, len(products), _POOL_CHUNK)]
+        return cls(chunks, [product_pos[chunk[0]['product_id']] for chunk in chunks], len(products))
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self.chunks)
+
+    def __len__(self):
+        return self.size
+
+    def _locate(self, pos, product_pos):
+        # (chunk, index in it, found) of the product at catalog position pos
+        i = max(bisect.bisect_right(self.heads, pos) - 1, 0)
+        chunk = self.chunks[i]
+        j = bisect.bisect_left(chunk, pos, key=lambda p: product_pos[p['product_id']])
+        return i, j, j < len(chunk) and product_pos[chunk[j]['product_id']] == pos
+
+    def _replace(self, i, parts, size, product_pos):
+        return ProductPool(self.chunks[:i] + parts + self.chunks[i + 1:],
+                           self.heads[:i] + [product_pos[part[0]['product_id']] for part in parts] + self.heads[i + 1:],
+                           size)
+
+    def put(self, product, product_pos):
+        '''This pool with product added, or replacing the one with its product_id.'''
+        if not self.chunks:
+            return ProductPool.from_products([product], product_pos)
+        i, j, found = self._locate(product_pos[product['product_id']], product_pos)
+        chunk = self.chunks[i]
+        chunk = chunk[:j] + [product] + chunk[j + found:]
+        parts = [chunk[:_POOL_CHUNK], chunk[_POOL_CHUNK:]] if len(chunk) > 2 * _POOL_CHUNK else [chunk]
+        return self._replace(i, parts, self.size + (not found), product_pos)
+
+    def drop(self, pid, product_pos):
+        '''This pool without product pid (itself if pid is not in it).'''
+        if not self.chunks:
+            return self
+        i, j, found = self._locate(product_pos[pid], product_pos)
+        if not found:
+            return self
+        chunk = self.chunks[i][:j] + self.chunks[i][j + 1:]
+        return self._replace(i, [chunk] if chunk else [], self.size - 1, product_pos)
+
+def build_indexes(products, carts):
+    '''
+    Build the lookup tables used on the request path, so a recommendation only
+    touches the user's own history instead of scanning the whole dataset
+    (orders are indexed by OrderStore).
+        - cart_by_user: user_id -> cart (first cart wins, same as the old linear scan)
+        - products_by_flower_type: flower_type -> ProductPool of sellable products
+        - products_by_color: color -> ProductPool of sellable products
+        - products_by_occasion: occasion -> ProductPool of sellable products
+        - product_pos: product_id -> position in the catalog
+    The candidate pools hold sellable products only, so the recommenders never
+    walk past sold-out ones; apply_delta and update_stock move products in and out.
+    '''
+    cart_by_user = {}
+    for cart in carts:
+        cart_by_user.setdefault(cart["user_id"], cart)
+
+    products_by_flower_type = defaultdict(list)
+    products_by_color = defaultdict(list)
+    products_by_occasion = defaultdict(list)
+    product_pos = {}
+    for pos, p in enumerate(products):
+        product_pos.setdefault(p['product_id'], pos)
+        if not _product_sellable(p):
+            continue
+        details = p.get('flower_details', {})
+        ft = details.get('flower_type')
+        if ft:
+            products_by_flower_type[ft].append(p)
+        for c in dict.fromkeys(details.get('color', [])):
+            products_by_color[c].append(p)
+        for occasion in dict.fromkeys(details.get('occasion', [])):
+            products_by_occasion[occasion].append(p)
+
+    def pools(index):
+        return {key: ProductPool.from_products(pool, product_pos) for key, pool in index.items()}
+
+    return {
+        'cart_by_user': cart_by_user,
+        'products_by_flower_type': pools(products_by_flower_type),
+        'products_by_color': pools(products_by_color),
+        'products_by_occasion': pools(products_by_occasion),
+        'product_pos': product_pos,
+    }
+
 ############# Recommendation History
 
-def get_orders_from_user(user_id, orders ,top_k = 1):
-    # Filter orders by user_id
-    user_orders = [order for order in orders if order["user_id"] == user_id]
-    
-    # Sort orders by order_date in descending order
-    user_orders.sort(key=lambda x: datetime.strptime(x["order_date"], "%Y-%m-%d"), reverse=True)
-    
-    # Return the top_k orders (or all if fewer than top_k)
-    return user_orders[:top_k]
+def get_orders_from_user(user_id, snap, top_k = 1):
+    # Order rows are grouped per user and pre-sorted by order_date (desc) at load time
+    return snap.orders.orders_by_user.get(user_id, ())[:top_k]
+
+def get_products_ids_from_orders(orders, snap):
+    # Ordered set (dict keys): unique, and iterates in first-seen order so ties in
+    # user_data_counter break the same way in every process (set order depends on the hash seed)
+    product_ids = {}
+
+    # Iterate through each order row and its lines
+    for row in orders:
+        for pid in snap.orders.product_ids_of(row):
+            product_ids[pid] = None
 
-def get_products_ids_from_orders(orders, order_items):
-    product_ids = set()  # Use set for uniqueness
-    
-    # Iterate through each order
-    for order in orders:
-        # Find corresponding order_items
-        order_item = next((item for item in order_items if item["order_id"] == order["order_id"]), None)
-        if order_item:
-            # Extract product_ids from the order's products
-            for product in order_item["products"]:
-                product_ids.add(product["product_id"])
-    
     return product_ids
 
-def get_products_from_user_orders(user_id, orders, order_items, products, top_k, type_filter = ['flower']):
-    user_orders = get_orders_from_user(user_id, orders, top_k=top_k)
-    user_products_ids = get_products_ids_from_orders(user_orders, order_items)
-    user_product_types = extract_type(user_products_ids, products, type_filter)
-    
-    return user_products_ids, user_product_types
+def get_products_from_user_orders(user_id, snap, top_k, type_filter = ['flower']):
+    user_orders = get_orders_from_user(user_id, snap, top_k=top_k)
+    user_products_ids = get_products_ids_from_orders(user_orders, snap)
+    user_product_types = extract_type(user_products_ids, snap, type_filter)
 
-from collections import Counter
+    return user_products_ids, user_product_types
 
-def rec_user_his(user_id, orders, order_items, products, top_k, recommended_list ,type_filter = ['flower']):
+def rec_user_his(user_id, snap, top_k, recommended_list ,type_filter = ['flower']):
     '''
     Recommend the flower that:
         - User not buy yet
         - Come up with one most refered attribute
         - Come up with the attribute that not occur get_preference
-    
+
     '''
-    user_products_ids ,user_product_types = get_products_from_user_orders(user_id, orders, order_items ,products, top_k, type_filter)
-    
+    user_products_ids ,user_product_types = get_products_from_user_orders(user_id, snap, top_k, type_filter)
+
     
     _, flower_count, color_count = user_data_counter(user_product_types)
     
@@ -475,39 +1137,266 @@ def rec_user_his(user_id, orders, order_items, products, top_k, recommended_list
     ranked_color  = [c for c,_ in Counter(color_count).most_common()]
     # print(ranked_flower, ranked_color)
 
+    if HIS_ENGINE == 'numpy' and np is not None:
+        # same three passes as below, scored over the whole catalog at once
+        pid, color = his_pick_numpy(snap, ranked_flower, ranked_color, flower_count, color_count,
+                                    user_products_ids, recommended_list)
+        if pid:
+            recommended_list.add(pid)
+        return {'flag':'history','product_id':pid,'color':color,'event':''}, recommended_list
+
+    # the pools below hold sellable products only
+
     # try same flower_type with a color they haven't bought
     for ft in ranked_flower:
-        for p in products:
-            if p.get('flower_details',{}).get('flower_type') == ft:
-                pid = p['product_id']
-                new_colors = [c for c in p.get('flower_details',{}).get('color',[]) if c not in color_count]
-                if new_colors and _is_sellable(pid) and pid not in user_products_ids and pid not in recommended_list:
-                    recommended_list.add(pid)
-                    return {'flag':'history','product_id':pid,'color':new_colors[0],'event':''}, recommended_list
+        for p in snap.products_by_flower_type.get(ft, []):
+            pid = p['product_id']
+            new_colors = [c for c in p.get('flower_details',{}).get('color',[]) if c not in color_count]
+            if new_colors and pid not in user_products_ids and pid not in recommended_list:
+                recommended_list.add(pid)
+                return {'flag':'history','product_id':pid,'color':new_colors[0],'event':''}, recommended_list
 
     # fallback: top color they like but new product
     for c in ranked_color:
-        for p in products:
-            if c in p.get('flower_details',{}).get('color',[]):
-                pid = p['product_id']
-                if pid not in user_products_ids and _is_sellable(pid) and pid not in recommended_list:
-                    recommended_list.add(pid)
-                    return {'flag':'history','product_id':pid,'color':c,'event':''}, recommended_list
-
-    # final fallback: any new flower type
-    for p in products:
-        pid = p['product_id']
-        ft = p.get('flower_details',{}).get('flower_type','')
-        if ft and ft not in flower_count and _is_sellable(pid) and pid not in recommended_list:
-            recommended_list.add(pid)
-            return {'flag':'history','product_id':pid,'color':'','event':''}, recommended_list
+        for p in snap.products_by_color.get(c, []):
+            pid = p['product_id']
+            if pid not in user_products_ids and pid not in recommended_list:
+                recommended_list.add(pid)
+                return {'flag':'history','product_id':pid,'color':c,'event':''}, recommended_list
+
+    # final fallback: any new flower type, i.e. the first product in catalog order
+    # among the heads of the pools of flower types they haven't bought
+    best = None
+    for ft, pool in list(snap.products_by_flower_type.items()):
+        if ft in flower_count:
+            continue
+        p = next((p for p in pool if p['product_id'] not in recommended_list), None)
+        if p is not None and (best is None or snap.product_pos[p['product_id']] < snap.product_pos[best]):
+            best = p['product_id']
+    if best is not None:
+        recommended_list.add(best)
+        return {'flag':'history','product_id':best,'color':'','event':''}, recommended_list
 
     return {'flag':'history','product_id':'','color':'','event':''}, recommended_list
         
 
+############# Vectorized history scoring
+
+def encode_products(products):
+    '''
+    Catalog as NumPy arrays for his_pick_numpy (row i = products[i]):
+        - flower_type: flower_type code per product (one-hot as an index; the
+          last code means "no flower_type")
+        - colors: multi-hot (products x colors) bool matrix
+        - available / in_stock: the two halves of _is_sellable, and sellable = both
+        - products: the product dicts the rows were encoded from
+    apply_delta publishes new products before it re-encodes, so readers size
+    everything from these arrays, never from snap.products.
+    '''
+    flower_types = {}
+    color_codes = {}
+    for p in products:
+        details = p.get('flower_details', {})
+        if details.get('flower_type'):
+            flower_types.setdefault(details['flower_type'], len(flower_types))
+        for c in details.get('color', []):
+            color_codes.setdefault(c, len(color_codes))
+
+    n = len(products)
+    no_type = len(flower_types)
+    flower_type = np.full(n, no_type, dtype=np.int32)
+    colors = np.zeros((n, len(color_codes)), dtype=bool)
+    available = np.zeros(n, dtype=bool)
+    in_stock = np.zeros(n, dtype=bool)
+    for i, p in enumerate(products):
+        details = p.get('flower_details', {})
+        flower_type[i] = flower_types.get(details.get('flower_type') or None, no_type)
+        for c in details.get('color', []):
+            colors[i, color_codes[c]] = True
+        available[i] = bool(p.get("available", True))
+        in_stock[i] = p.get("stock", 0) > 0
+
+    return {
+        'flower_type_codes': flower_types,
+        'color_codes': color_codes,
+        'flower_type': flower_type,
+        'colors': colors,
+        'available': available,
+        'in_stock': in_stock,
+        'sellable': available & in_stock,
+        'index': np.arange(n, dtype=np.float64),
+        'products': list(products),
+    }
+
+def _rank_vector(ranked, codes, size):
+    # rank of each code in the user's ranking, inf when not ranked; size includes sentinels
+    ranks = np.full(size, np.inf)
+    for r, key in enumerate(ranked):
+        code = codes.get(key)
+        if code is not None:
+            ranks[code] = r
+    return ranks
+
+def _first_by_rank(rank, mask, index):
+    # lowest rank wins, then catalog order: the loops' iteration order
+    score = np.where(mask & np.isfinite(rank), rank * len(index) + index, np.inf)
+    best = int(score.argmin()) if len(score) else 0
+    return best if len(score) and np.isfinite(score[best]) else None
+
+def his_pick_numpy(snap, ranked_flower, ranked_color, flower_count, color_count, user_products_ids, recommended_list):
+    '''
+    Vectorized rec_user_his candidate search (REC_HIS_ENGINE=numpy). Returns
+    (product_id, color) for the same product the loops would pick, or ('', '').
+    '''
+    arrays = snap.product_arrays
+    if arrays is None:
+        arrays = snap.product_arrays = encode_products(snap.products)
+    # rows, sizes and product dicts all come from the arrays: a product added by
+    # a delta that hasn't been re-encoded yet is simply not a candidate
+    products = arrays['products']
+    ft_codes, color_codes = arrays['flower_type_codes'], arrays['color_codes']
+    index = arrays['index']
+    n = len(index)
+
+    bought = np.zeros(n, dtype=bool)
+    recommended = np.zeros(n, dtype=bool)
+    for ids, mask in ((user_products_ids, bought), (recommended_list, recommended)):
+        positions = [pos for pos in (snap.product_pos.get(pid) for pid in ids) if pos is not None and pos < n]
+        mask[positions] = True
+    candidates = arrays['sellable'] & ~recommended
+
+    # same flower_type with a color they haven't bought
+    known_colors = np.zeros(len(color_codes), dtype=bool)
+    known_colors[[color_codes[c] for c in color_count if c in color_codes]] = True
+    has_new_color = (arrays['colors'] & ~known_colors).any(axis=1)
+    ft_rank = _rank_vector(ranked_flower, ft_codes, len(ft_codes) + 1)[arrays['flower_type']]
+    best = _first_by_rank(ft_rank, candidates & ~bought & has_new_color, index)
+    if best is not None:
+        p = products[best]
+        color = next(c for c in p['flower_details']['color'] if c not in color_count)
+        return p['product_id'], color
+
+    # fallback: top color they like but new product
+    color_rank = _rank_vector(ranked_color, color_codes, len(color_codes))
+    product_color_rank = np.where(arrays['colors'], color_rank, np.inf).min(axis=1, initial=np.inf)
+    best = _first_by_rank(product_color_rank, candidates & ~bought, index)
+    if best is not None:
+        return products[best]['product_id'], ranked_color[int(product_color_rank[best])]
+
+    # final fallback: any new flower type
+    seen_types = np.zeros(len(ft_codes) + 1, dtype=bool)
+    seen_types[[ft_codes[ft] for ft in flower_count if ft in ft_codes]] = True
+    seen_types[len(ft_codes)] = True  # "no flower_type" never qualifies
+    new_type = candidates & ~seen_types[arrays['flower_type']]
+    if new_type.any():
+        return products[int(new_type.argmax())]['product_id'], ''
+    return '', ''
+
 ############# Recommendation Occasion
 
-def rec_user_occasion(products, recommended_list):
+# "DD/MM" single days or "DD/MM - DD/MM" ranges, repeating every year
+events = {
+    "New Year": "01/01",
+    "Valentine's Day": "14/02",
+    "International Women's Day": "08/03",
+    "Easter": "22/03 - 25/04",
+    "Mother's Day": "08/05 - 14/05",
+    "Father's Day": "15/06 - 21/06",
+    "Mid-Autumn Festival": "15/09 - 10/10",
+    "Halloween": "31/10",
+    "Thanksgiving": "22/11 - 28/11",
+    "Christmas": "25/12",
+    "Vietnamese Women's Day": "20/10",
+    "Vietnamese Teacher's Day": "20/11",
+    "Lunar New Year (Tết)": "20/01 - 20/02",
+    "Reunification Day": "30/04",
+    "Labor Day": "01/05",
+    "Vietnam National Day": "02/09",
+    "Chinese New Year": "21/01 - 20/02",
+    "Earth Day": "22/04",
+    "Summer Solstice": "20/06 - 22/06",
+    "Mid-Year Sales": "01/06 - 15/07",
+    "Black Friday": "23/11 - 29/11",
+    "Cyber Monday": "26/11 - 02/12",
+    "Singles' Day": "11/11",
+    "World Environment Day": "05/06",
+    "International Friendship Day": "30/07",
+    "Oktoberfest": "21/09 - 06/10",
+    "Winter Solstice": "20/12 - 23/12",
+    "Boxing Day": "26/12",
+    "Hung Kings Commemoration Day": "10/03",
+    "Tet Trung Thu (Children's Festival)": "15/08",
+}
+
+def _event_occurrences(events, year):
+    # (start, order, end, name, is_range) with day ordinals; ranges like 25/12 - 05/01 wrap into next year
+    for order, (name, date_str) in enumerate(events.items()):
+        start_str, sep, end_str = (s.strip() for s in date_str.partition(' - '))
+        start = datetime.strptime(f"{start_str}/{year}", "%d/%m/%Y").toordinal()
+        end = datetime.strptime(f"{end_str or start_str}/{year}", "%d/%m/%Y").toordinal()
+        if end < start:
+            end = datetime.strptime(f"{end_str}/{year + 1}", "%d/%m/%Y").toordinal()
+        yield start, order, end, name, bool(sep)
+
+def build_event_calendar(events=events, year=None):
+    '''
+    Precompute "which event is current or next" for every day of `year` and the
+    year after, compressed into date-sorted change points: (starts, names) where
+    names[i] holds from starts[i] until starts[i + 1]. Same rules as the
+    notebook's scan: a date range in progress wins (first in `events` order),
+    otherwise the nearest start from today on, ties going to `events` order.
+    '''
+    year = year or datetime.now().year
+    occurrences = [o for y in (year - 1, year, year + 1, year + 2) for o in _event_occurrences(events, y)]
+    by_start = sorted(occurrences)
+    ranges = [o for o in by_start if o[4]]
+
+    first = datetime(year, 1, 1).toordinal()
+    last = datetime(year + 1, 12, 31).toordinal()
+    starts, names = [], []
+    for day in range(first, last + 1):
+        active = [o for o in ranges if o[0] <= day <= o[2]]
+        if active:
+            name = min(active, key=lambda o: o[1])[3]
+        else:
+            name = by_start[bisect.bisect_left(by_start, (day,))][3]
+        if not names or names[-1] != name:
+            starts.append(day)
+            names.append(name)
+    return {'first': first, 'last': last, 'starts': starts, 'names': names}
+
+_EVENT_CALENDAR = None
+
+def get_nearest_upcoming_event(now=None):
+    '''
+    The event in progress today, or the next upcoming one: one bisect into the
+    precomputed calendar (rebuilt once when the date leaves its two-year window).
+    '''
+    global _EVENT_CALENDAR
+    day = (now or datetime.now()).toordinal()
+    calendar = _EVENT_CALENDAR
+    if calendar is None or not calendar['first'] <= day <= calendar['last']:
+        calendar = _EVENT_CALENDAR = build_event_calendar(year=datetime.fromordinal(day).year)
+    return calendar['names'][bisect.bisect_right(calendar['starts'], day) - 1]
+
+def rec_user_occasion(snap, recommended_list, now=None):
+    '''
+    Recommend a sellable product tagged with the current / next event.
+    Costs one calendar bisect plus a walk over that occasion's pre-filtered products.
+    '''
+    up_comming_event = get_nearest_upcoming_event(now)
+    for product in snap.products_by_occasion.get(up_comming_event, []):
+        pid = product['product_id']
+        if pid in recommended_list:
+            continue
+        recommended_list.add(pid)
+        return {
+            'flag' : 'occasion',
+            'product_id' : pid,
+            'color' : '',
+            'event' : up_comming_event
+        }, recommended_list
+
     return {
         'flag' : 'occasion',
         'product_id' : '',
@@ -517,7 +1406,121 @@ def rec_user_occasion(products, recommended_list):
 
 ############# Recommendation Cart
 
-def rec_user_cross_selling(user_id, order_items, carts, recommended_list):
+_pair_regex = re.compile(r"^([A-Za-z]+)(\d+)$")
+
+def _natural_key(pid: ProductID) -> Tuple[str, int]:
+    m = _pair_regex.match(pid)
+    if not m:
+        return (pid, 0)
+    prefix, num = m.groups()
+    return (prefix, int(num))
+
+class CoOccurrence:
+    '''
+    How often two products were bought in the same order, as a sparse
+    symmetric matrix: products are mapped to integer indices and row i is a
+    dict {j: count} (array of dicts). Built once per snapshot and updated in
+    place by add_order as orders arrive; partners() results are cached per
+    product until one of its rows changes.
+    Built from a binary snapshot (from_csr), rows stay None and are read from the
+    mapped CSR arrays until add_order first changes them.
+    '''
+    def __init__(self, baskets=()):
+        self.index: Dict[ProductID, int] = {}
+        self.ids: List[ProductID] = []
+        self.rows: List[Optional[Dict[int, int]]] = []
+        self._partners: Dict[int, list] = {}
+        self._csr = None
+        for product_ids in baskets:
+            self.add_order(product_ids)
+
+    @classmethod
+    def from_csr(cls, ids, start, partner, count):
+        '''Row i is {partner[k]: count[k] for k in range(start[i], start[i + 1])}.'''
+        co = cls()
+        co.ids = list(ids)
+        co.index = {pid: i for i, pid in enumerate(co.ids)}
+        co.rows = [None] * len(co.ids)
+        co._csr = (start, partner, count)
+        return co
+
+    def items(self, i):
+        '''(partner index, count) pairs of row i.'''
+        row = self.rows[i]
+        if row is not None:
+            # list() copies the row atomically, sync may be updating it
+            return list(row.items())
+        start, partner, count = self._csr
+        return list(zip(partner[start[i]:start[i + 1]], count[start[i]:start[i + 1]]))
+
+    def _row(self, i):
+        # only add_order (the sync thread) materializes rows; readers go through items()
+        row = self.rows[i]
+        if row is None:
+            row = self.rows[i] = dict(self.items(i))
+        return row
+
+    def _idx(self, pid):
+        i = self.index.get(pid)
+        if i is None:
+            i = self.index[pid] = len(self.ids)
+            self.ids.append(pid)
+            self.rows.append({})
+        return i
+
+    def add_order(self, product_ids, sign=1):
+        # sign=-1 takes an order back out (used when sync replaces its lines)
+        unique = {self._idx(pid) for pid in product_ids}
+        for a, b in combinations(unique, 2):
+            for i, j in ((a, b), (b, a)):
+                row = self._row(i)
+                count = row.get(j, 0) + sign
+                if count > 0:
+                    row[j] = count
+                else:
+                    row.pop(j, None)
+        for i in unique:
+            self._partners.pop(i, None)
+
+    def partners(self, pid):
+        '''
+        Products bought together with pid as (-count, pair_key, partner_id), most
+        frequent first; ties are broken by the natural order of the pair like the
+        notebook's pair_normalize.
+        '''
+        i = self.index.get(pid)
+        if i is None:
+            return []
+        ranked = self._partners.get(i)
+        if ranked is None:
+            me = _natural_key(pid)
+            ranked = sorted(
+                (-count, tuple(sorted((me, _natural_key(self.ids[j])))), self.ids[j])
+                for j, count in self.items(i)
+            )
+            self._partners[i] = ranked
+        return ranked
+
+def rec_user_cross_selling(user_id, snap, recommended_list):
+    '''
+    Recommend the product most often bought together with something in the
+    user's cart (and not in the cart already). Only the partner lists of the
+    cart items are merged, lazily, so the cost does not depend on the catalog.
+    '''
+    user_products_id = get_products_from_user_carts(user_id, snap)
+
+    candidates = heapq.merge(*(snap.co_occurrence.partners(pid) for pid in user_products_id))
+    for _neg_count, _pair_key, pid in candidates:
+        if pid in user_products_id or pid in recommended_list or not _is_sellable(pid, snap):
+            continue
+        recommended_list.add(pid)
+        return {
+            'flag' : 'cross_selling',
+            'product_id': pid,
+            'color' : '',
+            'event': ''
+            }, recommended_list
+
     return {
         'flag' : 'cross_selling',
         'product_id': '',
@@ -525,42 +1528,178 @@ def rec_user_cross_selling(user_id, order_items, carts, recommended_list):
         'event': ''
         }, recommended_list
 
+############# Recommendation Similar Items
+
+class ItemNeighbors:
+    '''
+    Item-item collaborative filtering index over the user x product purchase
+    matrix: for each product, the top-N products bought by the same users,
+    scored by the cosine similarity of their buyer sets,
+    co-buyers / sqrt(buyers_a * buyers_b). Rows are CSR arrays over OrderStore's
+    product indices, best first (ties: lower index):
+        neighbor[start[i]:start[i + 1]], score[start[i]:start[i + 1]]
+    build() counts each user's most recent max_user_items distinct products and
+    visits products most bought first, so a build stopped by its time budget
+    still covers the popular ones; a build whose estimated memory exceeds the
+    budget is skipped (empty index). stats says which happened.
+    Sync deltas don't change the index (the next full load rebuilds it), but
+    rec_user_similar reads the user's purchases from the live store.
+    '''
+    def __init__(self, start, neighbor, score, stats):
+        self.start = start
+        self.neighbor = neighbor
+        self.score = score
+        self.stats = stats
+
+    @classmethod
+    def build(cls, store, neighbors=None, max_user_items=None, budget=None, max_mb=None):
+        if np is None:
+            raise RuntimeError("REC_CF needs numpy (pip install numpy)")
+        neighbors = neighbors or CF_NEIGHBORS
+        max_user_items = max_user_items or CF_MAX_USER_ITEMS
+        budget = CF_BUDGET if budget is None else budget
+        max_mb = CF_MAX_MB if max_mb is None else max_mb
+        started = time.perf_counter()
+        n_items, n_users = len(store.product_ids), len(store.user_ids)
+
+        span = np.asarray(store.item_span, dtype=np.int64)
+        rows = np.flatnonzero(span >= 0)
+        counts = span[rows] & _SPAN_MASK
+        n_lines = int(counts.sum())
+        # the per-line arrays below dominate: ~72 bytes per line at peak (benchmark.py cf)
+        estimated = n_lines * 80 + n_items * (neighbors * 12 + 64) + n_users * 16
+        stats = {'seconds': 0.0, 'products': n_items, 'products_done': 0, 'products_bought': 0,
+                 'pairs': 0, 'estimated_mb': round(estimated / 2**20, 1), 'index_mb': 0.0, 'stopped': None}
+        if estimated > max_mb * 2**20:
+            stats['stopped'] = 'memory'
+            return cls(np.zeros(n_items + 1, np.int64), np.zeros(0, np.int32), np.zeros(0, np.float32), stats)
+
+        # one entry per live line: its user, day and product
+        ends = np.cumsum(counts)
+        line = np.repeat((span[rows] >> _SPAN_BITS) - (ends - counts), counts) + np.arange(n_lines)
+        user = np.repeat(np.asarray(store.order_user)[rows], counts)
+        day = np.repeat(np.asarray(store.order_day)[rows], counts)
+        item = np.asarray(store.item_product)[line]
+        del line, span, rows
+
+        # distinct (user, product) pairs, grouped by user, most recent first
+        order = np.lexsort((-day, user))
+        user, item = user[order], item[order]
+        _, first = np.unique(user.astype(np.int64) * n_items + item, return_index=True)
+        first.sort()
+        user, item = user[first], item[first]
+        del order, day, first
+        user_len = np.bincount(user, minlength=n_users)
+        keep = np.arange(len(user)) - (np.cumsum(user_len) - user_len)[user] < max_user_items
+        user, item = user[keep], item[keep]
+        user_len = np.minimum(user_len, max_user_items)
+        user_start = np.cumsum(user_len) - user_len
+        stats['pairs'] = len(user)
+
+        # buyers per product (the matrix's columns)
+        buyers = np.bincount(item, minlength=n_items)
+        buyer_start = np.cumsum(buyers) - buyers
+        item_users = user[np.argsort(item, kind='stable')]
+        norm = np.sqrt(buyers)
+
+        found = [None] * n_items
+        by_popularity = np.argsort(-buyers, kind='stable')
+        stats['products_bought'] = int(np.count_nonzero(buyers))
+        for i in by_popularity[:stats['products_bought']]:
+            if time.perf_counter() - started > budget:
+                stats['stopped'] = 'time'
+                break
+            stats['products_done'] += 1
+            # every product of every buyer of i: co-buyer counts in one bincount
+            users = item_users[buyer_start[i]:buyer_start[i] + buyers[i]]
+            lens = user_len[users]
+            ends = np.cumsum(lens)
+            co = np.bincount(item[np.repeat(user_start[users] - (ends - lens), lens) + np.arange(ends[-1])],
+                             minlength=n_items)
+            co[i] = 0
+            partners = np.flatnonzero(co)
+            if not len(partners):
+                continue
+            sim = co[partners] / (norm[i] * norm[partners])
+            top = np.lexsort((partners, -sim))[:neighbors]
+            found[i] = (partners[top], sim[top])
+
+        lengths = np.array([0 if f is None else len(f[0]) for f in found], dtype=np.int64)
+        start = np.zeros(n_items + 1, np.int64)
+        np.cumsum(lengths, out=start[1:])
+        rows = [f for f in found if f is not None]
+        neighbor = np.concatenate([f[0] for f in rows]).astype(np.int32) if rows else np.zeros(0, np.int32)
+        score = np.concatenate([f[1] for f in rows]).astype(np.float32) if rows else np.zeros(0, np.float32)
+        stats['index_mb'] = round((start.nbytes + neighbor.nbytes + score.nbytes) / 2**20, 2)
+        stats['seconds'] = time.perf_counter() - started
+        return cls(start, neighbor, score, stats)
+
+    def row(self, i):
+        '''(neighbour index, score) pairs of product index i, best first.'''
+        if i + 1 >= len(self.start):
+            return []
+        s, e = self.start[i], self.start[i + 1]
+        return zip(self.neighbor[s:e].tolist(), self.score[s:e].tolist())
+
+def rec_user_similar(user_id, snap, recommended_list):
+    '''
+    Recommend the product closest to what the user bought (ItemNeighbors): each
+    candidate scores the sum of its similarity to the user's most recent
+    CF_MAX_USER_ITEMS distinct products. Only the neighbour lists of those
+    products are merged, so the cost does not depend on the catalog.
+    '''
+    store = snap.orders
+    bought = store.user_products(user_id, CF_MAX_USER_ITEMS)
+    scores = defaultdict(float)
+    for i in bought:
+        for j, score in snap.item_neighbors.row(i):
+            scores[j] += score
+    bought = set(bought)
+    for j in sorted(scores, key=lambda j: (-scores[j], j)):
+        pid = store.product_ids[j]
+        if j in bought or pid in recommended_list or not _is_sellable(pid, snap):
+            continue
+        recommended_list.add(pid)
+        return {'flag': 'similar', 'product_id': pid, 'color': '', 'event': ''}, recommended_list
+
+    return {'flag': 'similar', 'product_id': '', 'color': '', 'event': ''}, recommended_list
+
 ############# Recommendation Best Selling
-from collections import defaultdict
 
-def get_products_from_user_carts(user_id, carts):
-    cart_item = next((c for c in carts if c["user_id"] == user_id), None)
+def add_revenue(revenue, lines, sign=1):
+    # lines are (product_id, quantity, unit_price) from OrderStore, the unit price
+    # already resolved (option price if present, else product price);
+    # sign=-1 takes lines back out (used when sync replaces them)
+    for pid, qty, price in lines:
+        if pid and qty:
+            revenue[pid] += sign * price * qty
+
+def build_revenue(store):
+    revenue = defaultdict(float)
+    add_revenue(revenue, store.iter_lines())
+    return revenue
+
+def rank_best_sellers(revenue):
+    # revenue desc; ties keep first-sold order (sort is stable)
+    return sorted(revenue, key=revenue.get, reverse=True)
+
+def get_products_from_user_carts(user_id, snap):
+    cart_item = snap.cart_by_user.get(user_id)
     return {p["product_id"] for p in cart_item["products"]} if cart_item else set()
 
-def rec_user_best_selling(user_id, order_items, carts, recommended_list):
+def rec_user_best_selling(user_id, snap, recommended_list):
     """
     Returns up to 3 best-selling product_ids.
     - First pass: obey filters (not in cart, not in recommended_list, sellable).
     - Backfill: ignore cart/recommended filters, but still require sellable.
     - Always returns at least 3 items if possible.
     """
-    user_products_id = set(get_products_from_user_carts(user_id, carts))
-
-    # 1) Build revenue per product
-    revenue = defaultdict(float)
-    for order in order_items:
-        for product in order.get('products', []):
-            pid = product.get('product_id', '')
-            if not pid:
-                continue
-            opt = product.get('option') or {}
-            qty = product.get('quantity', 0) or 0
-
-            # prefer option price if present, else product price
-            price = float(opt.get('price', product.get('price', 0.0) or 0.0))
-            if qty:
-                revenue[pid] += price * qty
+    user_products_id = get_products_from_user_carts(user_id, snap)
 
-    if not revenue:
+    # 1-2) Products ranked by revenue desc: user independent, computed once per snapshot
+    sorted_pids = snap.best_ranking
+    if not sorted_pids:
         return {'flag': 'best', 'product_ids': [], 'color': '', 'event': ''}, recommended_list
-    
-    # 2) Sort products by revenue desc
-    sorted_pids = [pid for pid, _rev in sorted(revenue.items(), key=lambda kv: kv[1], reverse=True)]
 
     picks = []
 
@@ -572,7 +1711,7 @@ def rec_user_best_selling(user_id, order_items, carts, recommended_list):
             continue
         if pid in recommended_list:
             continue
-        if not _is_sellable(pid):
+        if not _is_sellable(pid, snap):
             continue
         picks.append(pid)
 
@@ -583,7 +1722,7 @@ def rec_user_best_selling(user_id, order_items, carts, recommended_list):
                 break
             if pid in picks:
                 continue
-            if not _is_sellable(pid):
+            if not _is_sellable(pid, snap):
                 continue
             picks.append(pid)
 
@@ -594,18 +1733,41 @@ def rec_user_best_selling(user_id, order_items, carts, recommended_list):
 
 
 ############# Recommendation wrapper
-def rec_user(user_id, top_k=3):
-    global recommended_list
-    recommended_list = set()  # reset per request/user
-
-    rec_his, recommended_list  = rec_user_his(user_id, orders, order_items, products, top_k,recommended_list)
-    rec_cross, recommended_list = rec_user_cross_selling(user_id, order_items, carts,recommended_list)
-    rec_occ, recommended_list   = rec_user_occasion(products, recommended_list)
-    rec_best, recommended_list  = rec_user_best_selling(user_id, order_items, carts,recommended_list)
-    return rec_his, rec_cross, rec_occ, rec_best
-
-def rec_user_converter(user_id, top_k = 3):
-    rec_his, rec_cross, rec_occ, rec_best = rec_user(user_id, top_k)
+
+STAGE_SECONDS = metrics.Histogram("rec_stage_seconds", "Time spent in each recommendation stage", ["stage"])
+
+def rec_user(user_id, top_k=3, snap=None):
+    # read the published snapshot once, so a concurrent reload can't mix datasets
+    snap = snap or _SNAPSHOT
+
+    # per-call exclusion set; nothing here is shared between concurrent requests
+    recommended_list = set()
+
+    clock = time.perf_counter
+    t0 = clock()
+    rec_his, recommended_list  = rec_user_his(user_id, snap, top_k,recommended_list)
+    t1 = clock()
+    rec_cross, recommended_list = rec_user_cross_selling(user_id, snap,recommended_list)
+    t2 = clock()
+    rec_occ, recommended_list   = rec_user_occasion(snap, recommended_list)
+    t3 = clock()
+    rec_best, recommended_list  = rec_user_best_selling(user_id, snap,recommended_list)
+    t4 = clock()
+
+    STAGE_SECONDS.observe(t1 - t0, "history")
+    STAGE_SECONDS.observe(t2 - t1, "cross_selling")
+    STAGE_SECONDS.observe(t3 - t2, "occasion")
+    STAGE_SECONDS.observe(t4 - t3, "best_selling")
+    if snap.item_neighbors is None:
+        return rec_his, rec_cross, rec_occ, rec_best
+
+    rec_sim, recommended_list   = rec_user_similar(user_id, snap, recommended_list)
+    STAGE_SECONDS.observe(clock() - t4, "similar")
+    return rec_his, rec_cross, rec_occ, rec_best, rec_sim
+
+def rec_user_converter(user_id, top_k = 3, snap = None):
+    rec_his, rec_cross, rec_occ, rec_best, *rec_extra = rec_user(user_id, top_k, snap)
+    started = time.perf_counter()
     
     #print(rec_best.get('product_ids', []))
     
@@ -622,18 +1784,788 @@ def rec_user_converter(user_id, top_k = 3):
     rec_best['product_id'] = rec_best.get('product_ids',[])[0] if len(rec_best.get('product_ids',[])) > 0 else ''
     
     #print(rec_best['product_ids'])
-        
-    return rec_his, rec_cross, rec_occ, rec_best
+
+    STAGE_SECONDS.observe(time.perf_counter() - started, "conversion")
+    return (rec_his, rec_cross, rec_occ, rec_best, *rec_extra)
+
+def rec_user_converter_batch(user_ids, top_k = 3, snap = None):
+    '''
+    Offline / bulk version of rec_user_converter: yields (user_id, results) for
+    every user, all computed on the same snapshot so the per-snapshot work
+    (indexes, best-seller ranking) is shared across the batch. Being a generator,
+    memory stays flat however many users are passed.
+    '''
+    snap = snap or _SNAPSHOT
+    for user_id in user_ids:
+        yield user_id, rec_user_converter(user_id, top_k, snap)
+
+############# Snapshot
+
+_VERSIONS = itertools.count(1)
+
+class Snapshot:
+    '''
+    Everything the recommenders read: the OrderStore, products and carts, the
+    product_by_id lookup and the indexes from build_indexes. A snapshot is built completely off the
+    request path and published with one reference assignment (swap_snapshot);
+    requests grab the current one once and use it throughout, so they never
+    see a mix of old and new data. apply_delta may patch the published
+    snapshot, but only with single-assignment swaps of index entries.
+    co_occurrence and revenue are derived from orders unless given (a binary
+    snapshot stores them); item_neighbors is built from orders with REC_CF=1.
+    '''
+    def __init__(self, orders, products, carts, sync_state=None, co_occurrence=None, revenue=None):
+        self.version = next(_VERSIONS)
+        self.orders = orders  # OrderStore
+        self.products = products
+        self.carts = carts
+        self.product_by_id = {p["product_id"]: p for p in products}
+        self.sellable = {pid for pid, p in self.product_by_id.items() if _product_sellable(p)}
+        self.sync_state = dict(sync_state or {})
+
+        indexes = build_indexes(products, carts)
+        self.cart_by_user = indexes['cart_by_user']
+        self.products_by_flower_type = indexes['products_by_flower_type']
+        self.products_by_color = indexes['products_by_color']
+        self.products_by_occasion = indexes['products_by_occasion']
+        self.product_pos = indexes['product_pos']
+
+        # best-seller ranking, kept up to date by apply_delta
+        self.revenue = revenue if revenue is not None else build_revenue(orders)
+        self.best_ranking = rank_best_sellers(self.revenue)
+        self.co_occurrence = co_occurrence if co_occurrence is not None else CoOccurrence(orders.baskets())
+        # catalog arrays for the numpy history engine; otherwise built on first use
+        self.product_arrays = encode_products(products) if HIS_ENGINE == 'numpy' and np is not None else None
+        # item-item neighbours for rec_user_similar (REC_CF=1)
+        self.item_neighbors = ItemNeighbors.build(orders) if CF_ENABLED else None
+
+    def bump_version(self):
+        # called after in-place patches so result caches keyed by version go stale
+        self.version = next(_VERSIONS)
+
+    def with_cart(self, user_id, cart):
+        '''
+        Request-scoped view of this snapshot in which user_id's cart is `cart`
+        (a live cart, in load_data structure). Everything else is shared; the
+        snapshot itself is not modified.
+        '''
+        view = copy.copy(self)
+        view.cart_by_user = ChainMap({user_id: cart}, self.cart_by_user)
+        return view
+
+# The snapshot served to requests; replaced wholesale by swap_snapshot
+_SNAPSHOT = Snapshot(OrderStore(), [], [])
+
+def current_snapshot():
+    return _SNAPSHOT
+
+def swap_snapshot(snap):
+    global _SNAPSHOT
+    _SNAPSHOT = snap
+
+############# Live carts
+
+LIVE_CART = metrics.Counter("rec_live_cart_total", "Live cart lookups by outcome (cached, fetched, fallback, overloaded)", ["outcome"])
+LIVE_CART_WAIT_SECONDS = metrics.Histogram("rec_live_cart_wait_seconds", "Time a request waited for a cart fetch")
+
+def convert_live_cart(user_id, payload):
+    '''CartApi.get_by_user_id response -> cart in load_data structure; no cart means an empty one.'''
+    if isinstance(payload, list):
+        payload = payload[0] if payload else None
+    if not payload:
+        return {"user_id": user_id, "products": []}
+    return _convert_cart({**payload, "user_id": payload.get("user_id", user_id)})
+
+def cart_key(cart):
+    # what the recommenders read from a cart; None and an empty cart are the same
+    return tuple((p["product_id"], p.get("quantity")) for p in cart["products"]) if cart else ()
+
+class LiveCarts:
+    '''
+    Users' current carts from the backend (CartApi.get_by_user_id), to lay over
+    the snapshot with Snapshot.with_cart.
+        - fetched carts are kept for `ttl` seconds in an LRU of `max_size` users,
+          so a page view within the TTL costs no backend round trip
+        - concurrent lookups of the same user share one fetch (single flight)
+        - a lookup waits at most `timeout` seconds; a slow or failed fetch returns
+          None (use the snapshot cart), and a slow one still fills the cache
+        - at most `max_inflight` fetches run at once; beyond that, None right away
+    get() is for threads (rec_sever), aget() for the event loop (rec_asgi).
+    '''
+    def __init__(self, ttl=None, max_size=None, timeout=None, max_inflight=16, fetch=None):
+        self.ttl = LIVE_CART_TTL if ttl is None else ttl
+        self.max_size = LIVE_CART_CACHE_SIZE if max_size is None else max_size
+        self.timeout = LIVE_CART_TIMEOUT if timeout is None else timeout
+        self.max_inflight = max_inflight
+        self.fetch = fetch or CartApi.get_by_user_id
+        self._entries = OrderedDict()  # user_id -> (fetched_at, cart)
+        self._inflight = {}            # user_id -> Future (get) or Task (aget)
+        # reentrant: add_done_callback runs _done right away if the fetch already finished
+        self._lock = threading.RLock()
+        self._pool = None
+
+    def cached(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or time.monotonic() - entry[0] > self.ttl:
+                return None
+            self._entries.move_to_end(user_id)
+            return entry[1]
+
+    def store(self, user_id, cart):
+        with self._lock:
+            self._entries[user_id] = (time.monotonic(), cart)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _fetched(self, user_id, payload):
+        cart = convert_live_cart(user_id, payload)
+        self.store(user_id, cart)
+        return cart
+
+    def _done(self, user_id, future):
+        with self._lock:
+            self._inflight.pop(user_id, None)
+        if not future.cancelled():
+            future.exception()  # retrieved, even when every waiter has given up
+
+    def get(self, user_id):
+        cart = self.cached(user_id)
+        if cart is not None:
+            LIVE_CART.inc("cached")
+            return cart
+        with self._lock:
+            future = self._inflight.get(user_id)
+            if future is None:
+                if len(self._inflight) >= self.max_inflight:
+                    LIVE_CART.inc("overloaded")
+                    return None
+                if self._pool is None:
+                    self._pool = ThreadPoolExecutor(self.max_inflight, thread_name_prefix="live-cart")
+                future = self._inflight[user_id] = self._pool.submit(lambda: self._fetched(user_id, self.fetch(user_id)))
+                future.add_done_callback(functools.partial(self._done, user_id))
+        started = time.perf_counter()
+        try:
+            cart = future.result(timeout=self.timeout)
+        except Exception:
+            LIVE_CART.inc("fallback")
+            return None
+        finally:
+            LIVE_CART_WAIT_SECONDS.observe(time.perf_counter() - started)
+        LIVE_CART.inc("fetched")
+        return cart
+
+    async def aget(self, user_id, fetch):
+        '''Like get(), with `fetch` a coroutine function (e.g. AsyncApi.get_cart_by_user_id).'''
+        cart = self.cached(user_id)
+        if cart is not None:
+            LIVE_CART.inc("cached")
+            return cart
+        task = self._inflight.get(user_id)
+        if task is None:
+            if len(self._inflight) >= self.max_inflight:
+                LIVE_CART.inc("overloaded")
+                return None
+            async def load():
+                return self._fetched(user_id, await fetch(user_id))
+            task = self._inflight[user_id] = asyncio.ensure_future(load())
+            task.add_done_callback(functools.partial(self._done, user_id))
+        started = time.perf_counter()
+        try:
+            # shield: a waiter timing out must not cancel the fetch the others share
+            cart = await asyncio.wait_for(asyncio.shield(task), self.timeout)
+        except Exception:
+            LIVE_CART.inc("fallback")
+            return None
+        finally:
+            LIVE_CART_WAIT_SECONDS.observe(time.perf_counter() - started)
+        LIVE_CART.inc("fetched")
+        return cart
+
+############# Binary snapshot
+
+# File layout: BINARY_MAGIC, the header length (8 bytes, little endian), a JSON
+# header, then the data: sections aligned to 8 bytes, each a flat array in native
+# byte order. The header maps section name -> [typecode, offset in the data, count].
+# Strings live in interned tables (UTF-8 text + character offsets) and the
+# columns hold indexes into them:
+#   - users, products, order_ids: ids used by the OrderStore (and by carts and co-occurrence)
+#   - text: every other string (product attributes, cart user ids, JSON fallbacks)
+# Lists (image urls, colors, cart lines, co-occurrence rows) are CSR: a values
+# section plus a "<name>.start" section of n + 1 offsets.
+BINARY_MAGIC = b"RECSNAP1"
+BINARY_VERSION = 1
+_ALIGN = 8
+
+# products and carts in exactly this shape are stored column by column;
+# anything else is kept whole as JSON in the text table
+_PRODUCT_KEYS = ["product_id", "type", "name", "price", "stock", "available", "description", "image_url", "flower_details"]
+_FLOWER_DETAIL_KEYS = ["occasion", "color", "flower_type", "options"]
+# column values written for a product stored as JSON
+_PLACEHOLDER_PRODUCT = {"product_id": "", "type": "", "name": "", "price": 0.0, "stock": 0, "available": False,
+                        "description": "", "image_url": [],
+                        "flower_details": {"occasion": [], "color": [], "flower_type": "", "options": []}}
+
+def _str_list(value):
+    return type(value) is list and all(type(s) is str for s in value)
+
+def _fixed_product(p):
+    details = p.get("flower_details")
+    return (list(p) == _PRODUCT_KEYS and type(details) is dict and list(details) == _FLOWER_DETAIL_KEYS
+            and all(type(p[key]) is str for key in ("product_id", "type", "name", "description"))
+            and type(p["price"]) in (int, float) and type(p["stock"]) is int and type(p["available"]) is bool
+            and type(details["flower_type"]) is str and details["options"] == []
+            and _str_list(p["image_url"]) and _str_list(details["occasion"]) and _str_list(details["color"]))
+
+def _fixed_cart(cart):
+    return (list(cart) == ["user_id", "products"] and type(cart["user_id"]) is str and type(cart["products"]) is list
+            and all(type(line) is dict and list(line) == ["product_id", "quantity"]
+                    and type(line["product_id"]) is str and type(line["quantity"]) is int for line in cart["products"]))
+
+def _aligned(size):
+    return -(-size // _ALIGN) * _ALIGN
+
+def is_binary_snapshot(data_path):
+    with open(data_path, 'rb') as f:
+        return f.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+
+
+class _BinaryWriter:
+    def __init__(self):
+        self.sections = {}
+
+    def column(self, name, typecode, values):
+        self.sections[name] = array(typecode, values)
+
+    def strings(self, name, strings):
+        offsets = array('q', [0])
+        for s in strings:
+            offsets.append(offsets[-1] + len(s))
+        self.sections[f"{name}.text"] = array('B', "".join(strings).encode("utf-8"))
+        self.sections[f"{name}.offsets"] = offsets
+
+    def lists(self, name, typecode, lists):
+        start, values = array('q', [0]), array(typecode)
+        for values_of_row in lists:
+            values.extend(values_of_row)
+            start.append(len(values))
+        self.sections[name] = values
+        self.sections[f"{name}.start"] = start
+
+    def write(self, path, meta):
+        sections, offset = {}, 0
+        for name, values in self.sections.items():
+            sections[name] = [values.typecode, offset, len(values)]
+            offset += _aligned(len(values) * values.itemsize)
+        header = json.dumps({"version": BINARY_VERSION, "byteorder": sys.byteorder, **meta, "sections": sections}).encode("utf-8")
+        prefix = BINARY_MAGIC + len(header).to_bytes(8, "little") + header
+        with open(path, "wb") as f:
+            f.write(prefix + b"\0" * (_aligned(len(prefix)) - len(prefix)))
+            for values in self.sections.values():
+                size = len(values) * values.itemsize
+                values.tofile(f)
+                f.write(b"\0" * (_aligned(size) - size))
+
+
+class _BinaryReader:
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[:len(BINARY_MAGIC)] != BINARY_MAGIC:
+            raise ValueError(f"{path} is not a binary snapshot")
+        start = len(BINARY_MAGIC) + 8
+        size = int.from_bytes(self.mm[len(BINARY_MAGIC):start], "little")
+        self.header = json.loads(self.mm[start:start + size])
+        self.data_start = _aligned(start + size)
+        if self.header["version"] != BINARY_VERSION or self.header["byteorder"] != sys.byteorder:
+            raise ValueError(f"{path}: binary snapshot version {self.header['version']} ({self.header['byteorder']} endian) "
+                             f"cannot be read here, convert it again from JSON")
+        self.view = memoryview(self.mm)
+
+    def column(self, name):
+        '''Read-only view of a section, no copy.'''
+        typecode, offset, count = self.header["sections"][name]
+        offset += self.data_start
+        return self.view[offset:offset + count * array(typecode).itemsize].cast(typecode)
+
+    def strings(self, name):
+        text = str(self.column(f"{name}.text"), "utf-8")
+        return [text[a:b] for a, b in itertools.pairwise(self.column(f"{name}.offsets"))]
+
+    def lists(self, name):
+        return self.column(name), self.column(f"{name}.start")
+
+
+def write_binary_snapshot(snap, data_path):
+    '''
+    Write `snap` as a binary snapshot (layout above) for load_data to memory-map.
+    Like extract_to_json, the file is written to a temp path and renamed, so
+    workers that still map the previous file keep reading it unchanged.
+    Sync watermarks go to the same side file as for JSON.
+    '''
+    data_path = str(data_path)
+    store, co = snap.orders, snap.co_occurrence
+    w = _BinaryWriter()
+    product_index = {pid: i for i, pid in enumerate(store.product_ids)}
+    text_index = {}
+
+    def product(pid):
+        return product_index.setdefault(pid, len(product_index))
+
+    def text(s):
+        return text_index.setdefault(s, len(text_index))
+
+    # orders: live lines only, in their current order (iter_lines order, which the best-seller ties follow)
+    rows = sorted((row for row in range(len(store)) if store.item_span[row] >= 0), key=store.item_span.__getitem__)
+    span = array('q', [-1]) * len(store)
+    item_product, item_qty, item_price = array('i'), array('i'), array('d')
+    for row in rows:
+        start, end = store._range(row)
+        span[row] = len(item_product) << _SPAN_BITS | (end - start)
+        item_product.extend(store.item_product[start:end])
+        item_qty.extend(store.item_qty[start:end])
+        item_price.extend(store.item_price[start:end])
+    order_ids = [None] * len(store)
+    for order_id, row in store.order_row.items():
+        order_ids[row] = order_id
+    w.column("order_user", 'i', store.order_user)
+    w.column("order_day", 'i', store.order_day)
+    w.column("item_span", 'q', span)
+    w.column("item_product", 'i', item_product)
+    w.column("item_qty", 'i', item_qty)
+    w.column("item_price", 'd', item_price)
+    w.lists("user_rows", 'i', (store.orders_by_user.get(user_id, ()) for user_id in store.user_ids))
+
+    # products, in catalog order
+    columns = defaultdict(list)
+    for p in snap.products:
+        if _fixed_product(p):
+            columns["json"].append(-1)
+        else:
+            columns["json"].append(text(json.dumps(p, ensure_ascii=False)))
+            p = _PLACEHOLDER_PRODUCT
+        details = p["flower_details"]
+        columns["id"].append(product(p["product_id"]))
+        for key in ("type", "name", "description"):
+            columns[key].append(text(p[key]))
+        columns["flower_type"].append(text(details["flower_type"]))
+        columns["price"].append(float(p["price"]))
+        columns["stock"].append(p["stock"])
+        columns["flags"].append(p["available"] | (type(p["price"]) is int) << 1)
+        columns["image_url"].append([text(s) for s in p["image_url"]])
+        columns["occasion"].append([text(s) for s in details["occasion"]])
+        columns["color"].append([text(s) for s in details["color"]])
+    for key in ("id", "json", "type", "name", "description", "flower_type"):
+        w.column(f"product.{key}", 'i', columns[key])
+    w.column("product.price", 'd', columns["price"])
+    w.column("product.stock", 'q', columns["stock"])
+    w.column("product.flags", 'B', columns["flags"])
+    for key in ("image_url", "occasion", "color"):
+        w.lists(f"product.{key}", 'i', columns[key])
+
+    # carts, in file order
+    fixed = [_fixed_cart(cart) for cart in snap.carts]
+    w.column("cart.user", 'i', [text(cart["user_id"]) if ok else -1 for cart, ok in zip(snap.carts, fixed)])
+    w.column("cart.json", 'i', [-1 if ok else text(json.dumps(cart, ensure_ascii=False)) for cart, ok in zip(snap.carts, fixed)])
+    lines = [cart["products"] if ok else [] for cart, ok in zip(snap.carts, fixed)]
+    w.lists("cart.product", 'i', ([product(line["product_id"]) for line in cart_lines] for cart_lines in lines))
+    w.lists("cart.quantity", 'q', ([line["quantity"] for line in cart_lines] for cart_lines in lines))
+
+    # co-occurrence rows, partners as indexes into co.ids
+    w.column("co.ids", 'i', [product(pid) for pid in co.ids])
+    co_rows = [co.items(i) for i in range(len(co.ids))]
+    w.lists("co.partner", 'i', ([j for j, _count in items] for items in co_rows))
+    w.lists("co.count", 'i', ([count for _j, count in items] for items in co_rows))
+    # revenue per product, in first-sold order (the best-seller tie break)
+    w.column("revenue.product", 'i', [product(pid) for pid in snap.revenue])
+    w.column("revenue.amount", 'd', snap.revenue.values())
+
+    w.strings("users", store.user_ids)
+    w.strings("products", list(product_index))
+    w.strings("order_ids", order_ids)
+    w.strings("text", list(text_index))
+
+    tmp_path = f"{data_path}.tmp"
+    w.write(tmp_path, {"orders": len(store), "order_lines": len(item_product),
+                       "products": len(snap.products), "carts": len(snap.carts)})
+    os.replace(tmp_path, data_path)
+    with open(_sync_state_path(data_path), "w", encoding="utf-8") as f:
+        json.dump(snap.sync_state, f)
+    return data_path
+
+def read_binary_snapshot(data_path):
+    '''
+    Memory-map a binary snapshot read-only: (OrderStore, products, carts, CoOccurrence, revenue).
+    The order columns and co-occurrence rows stay in the mapped file, so every
+    worker mapping the same file shares those pages (nothing is parsed or copied);
+    the id tables, products and carts (catalog sized) are rebuilt as Python objects.
+    '''
+    r = _BinaryReader(data_path)
+    product_ids = r.strings("products")
+    text = r.strings("text")
+
+    user_rows, user_start = r.lists("user_rows")
+    orders = OrderStore.from_columns({name: r.column(name) for name, _typecode in _ORDER_COLUMNS},
+                                     r.strings("users"), product_ids, functools.partial(r.strings, "order_ids"),
+                                     user_start, user_rows)
+
+    ids, raw, types, names, descriptions, flower_types = (
+        r.column(f"product.{key}") for key in ("id", "json", "type", "name", "description", "flower_type"))
+    prices, stocks, flags = r.column("product.price"), r.column("product.stock"), r.column("product.flags")
+    image_urls, occasions, colors = (r.lists(f"product.{key}") for key in ("image_url", "occasion", "color"))
+
+    def texts(lists, i):
+        values, start = lists
+        return [text[t] for t in values[start[i]:start[i + 1]]]
+
+    products = []
+    for i in range(len(ids)):
+        if raw[i] >= 0:
+            products.append(json.loads(text[raw[i]]))
+            continue
+        products.append({
+            "product_id": product_ids[ids[i]],
+            "type": text[types[i]],
+            "name": text[names[i]],
+            "price": int(prices[i]) if flags[i] & 2 else prices[i],
+            "stock": stocks[i],
+            "available": bool(flags[i] & 1),
+            "description": text[descriptions[i]],
+            "image_url": texts(image_urls, i),
+            "flower_details": {
+                "occasion": texts(occasions, i),
+                "color": texts(colors, i),
+                "flower_type": text[flower_types[i]],
+                "options": [],
+            },
+        })
+
+    cart_users, cart_raw = r.column("cart.user"), r.column("cart.json")
+    (cart_products, start), (cart_quantities, _start) = r.lists("cart.product"), r.lists("cart.quantity")
+    carts = []
+    for i in range(len(cart_users)):
+        if cart_raw[i] >= 0:
+            carts.append(json.loads(text[cart_raw[i]]))
+            continue
+        carts.append({
+            "user_id": text[cart_users[i]],
+            "products": [{"product_id": product_ids[pid], "quantity": qty}
+                         for pid, qty in zip(cart_products[start[i]:start[i + 1]], cart_quantities[start[i]:start[i + 1]])],
+        })
+
+    (partners, co_start), (counts, _start) = r.lists("co.partner"), r.lists("co.count")
+    co_occurrence = CoOccurrence.from_csr([product_ids[i] for i in r.column("co.ids")], co_start, partners, counts)
+    revenue = defaultdict(float, zip((product_ids[i] for i in r.column("revenue.product")), r.column("revenue.amount")))
+    return orders, products, carts, co_occurrence, revenue
 
 # Data_loader
-def load_data(data_path='data.json'):
-    global orders, order_items, products, carts, _PRODUCT_BY_ID
-    orders, order_items, products, carts = init_data(data_path)
-    _PRODUCT_BY_ID = {p["product_id"]: p for p in products}
 
-# call once at module import (keeps current behavior)
-load_data()
+# Stats of the last load_data call: time spent and peak memory
+LOAD_STATS = {}
+
+LOAD_SECONDS = metrics.Histogram("rec_load_build_seconds", "Time to build a snapshot in load_data (startup and reloads)", ["mode"],
+                                 buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0))
+SWAP_SECONDS = metrics.Histogram("rec_load_swap_seconds", "Time to publish a built snapshot",
+                                 buckets=(1e-7, 1e-6, 1e-5, 1e-4, 1e-3))
+metrics.Gauge("rec_data_version", "Version of the published snapshot", lambda: _SNAPSHOT.version)
+metrics.Gauge("rec_data_loaded_timestamp_seconds", "When the last load_data finished", lambda: LOAD_STATS.get('loaded_at'))
+metrics.Gauge("rec_data_orders", "Orders in the last loaded snapshot", lambda: LOAD_STATS.get('orders'))
+
+def _peak_rss_kb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS, kilobytes on Linux
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+def build_snapshot(data_path=None, stream=False):
+    data_path = data_path or DATA_PATH
+    co_occurrence = revenue = None
+    if is_binary_snapshot(data_path):
+        orders, products, carts, co_occurrence, revenue = read_binary_snapshot(data_path)
+    elif stream:
+        # orders and order_items go straight into the columns, one record at a time
+        orders = OrderStore()
+        products, carts = [], []
+        for section, record in iter_json_sections(data_path):
+            if section == 'orders':
+                orders.add_order(record)
+            elif section == 'order_items':
+                orders.add_order_item(record)
+            elif section == 'products':
+                products.append(record)
+            elif section == 'carts':
+                carts.append(record)
+        orders.finish()
+    else:
+        order_list, order_items, products, carts = init_data(data_path)
+        orders = OrderStore(order_list, order_items)
+        del order_list, order_items
+
+    sync_state = {}
+    if os.path.exists(_sync_state_path(data_path)):
+        with open(_sync_state_path(data_path), 'r', encoding='utf-8') as f:
+            sync_state = json.load(f)
+
+    snap = Snapshot(orders, products, carts, sync_state, co_occurrence, revenue)
+    get_nearest_upcoming_event()  # warm the event calendar off the request path
+    return snap
+
+def load_data(data_path=None, stream=None, trace_memory=False):
+    '''
+    Build a new Snapshot from data_path and swap it in. Safe to call while
+    requests are being served (hot reload): the snapshot is built completely
+    before the single-assignment swap.
+        - a binary snapshot (write_binary_snapshot, detected by its magic bytes) is
+          memory-mapped instead of parsed; `stream` does not apply to it
+        - stream: parse data.json section by section (default: REC_STREAM_LOAD=1)
+        - trace_memory: also measure the loader's own peak allocation with tracemalloc
+          (slower, meant for benchmarking)
+    Build/swap timings and memory are recorded in LOAD_STATS.
+    '''
+    global LOAD_STATS
+    data_path = data_path or DATA_PATH
+    if stream is None:
+        stream = os.environ.get("REC_STREAM_LOAD", "0") == "1"
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+
+    source = os.stat(data_path)
+    mode = 'binary' if is_binary_snapshot(data_path) else 'stream' if stream else 'json'
+    snap = build_snapshot(data_path, stream=stream)
+    built = time.perf_counter()
+    swap_snapshot(snap)
+    swapped = time.perf_counter()
+
+    stats = {
+        'data_path': str(data_path),
+        'mode': mode,
+        'version': snap.version,
+        'seconds': swapped - started,
+        'build_seconds': built - started,
+        'swap_seconds': swapped - built,
+        'loaded_at': time.time(),
+        'source_signature': [source.st_size, source.st_mtime_ns],
+        'peak_rss_kb': _peak_rss_kb(),
+        'orders': len(snap.orders),
+        'order_lines': snap.orders.line_count(),
+        'products': len(snap.products),
+        'carts': len(snap.carts),
+        'cf': snap.item_neighbors.stats if snap.item_neighbors is not None else None,
+    }
+    if trace_memory:
+        stats['traced_peak_kb'] = tracemalloc.get_traced_memory()[1] // 1024
+        tracemalloc.stop()
+    LOAD_STATS = stats
+    LOAD_SECONDS.observe(stats['build_seconds'], stats['mode'])
+    SWAP_SECONDS.observe(stats['swap_seconds'])
+    return stats
+
+############# Incremental sync
+
+def _bucket_put(snap, index, key, product):
+    # swap in the new pool with one assignment; it copies one chunk, not the pool
+    pool = index.get(key)
+    index[key] = pool.put(product, snap.product_pos) if pool is not None else ProductPool.from_products([product], snap.product_pos)
+
+def _bucket_drop(snap, index, key, pid):
+    pool = index.get(key)
+    if pool is None:
+        return
+    pool = pool.drop(pid, snap.product_pos)
+    if pool:
+        index[key] = pool
+    else:
+        index.pop(key, None)
+
+def _product_keys(product):
+    # the pools a product belongs in: none unless it is sellable
+    if not _product_sellable(product):
+        return None, set(), set()
+    details = product.get('flower_details', {})
+    return details.get('flower_type'), set(details.get('color', [])), set(details.get('occasion', []))
+
+def _move_product(snap, product, old_keys, new_keys):
+    pid = product['product_id']
+    (old_ft, old_colors, old_occasions), (ft, colors, occasions) = old_keys, new_keys
+    if old_ft and old_ft != ft:
+        _bucket_drop(snap, snap.products_by_flower_type, old_ft, pid)
+    if ft:
+        _bucket_put(snap, snap.products_by_flower_type, ft, product)
+    for c in old_colors - colors:
+        _bucket_drop(snap, snap.products_by_color, c, pid)
+    for c in colors:
+        _bucket_put(snap, snap.products_by_color, c, product)
+    for occasion in old_occasions - occasions:
+        _bucket_drop(snap, snap.products_by_occasion, occasion, pid)
+    for occasion in occasions:
+        _bucket_put(snap, snap.products_by_occasion, occasion, product)
+
+def _upsert_product(snap, product):
+    pid = product['product_id']
+    old = snap.product_by_id.get(pid)
+    if old is None:
+        snap.product_pos[pid] = len(snap.products)
+        snap.products.append(product)
+        old_keys = None, set(), set()
+    else:
+        snap.products[snap.product_pos[pid]] = product
+        old_keys = _product_keys(old)
+    snap.product_by_id[pid] = product
+    if _product_sellable(product):
+        snap.sellable.add(pid)
+    else:
+        snap.sellable.discard(pid)
+    # the pools only hold sellable products, so a stock-out leaves them here
+    _move_product(snap, product, old_keys, _product_keys(product))
+
+def _upsert_order_item(snap, order_item):
+    old = snap.orders.replace_lines(order_item)
+    if old:
+        add_revenue(snap.revenue, old, sign=-1)
+        snap.co_occurrence.add_order([pid for pid, _qty, _price in old], sign=-1)
+    new = snap.orders.lines(snap.orders.order_row[order_item['order_id']])
+    add_revenue(snap.revenue, new)
+    snap.co_occurrence.add_order([pid for pid, _qty, _price in new])
+
+def _upsert_cart(snap, cart):
+    old = snap.cart_by_user.get(cart['user_id'])
+    if old is None:
+        snap.carts.append(cart)
+        snap.cart_by_user[cart['user_id']] = cart
+    else:
+        old['products'] = cart['products']
+
+# Serialises the in-place writers (apply_delta from the sync thread, update_stock
+# from request threads): each one reads a pool, builds the new list and assigns
+# it back, so two at once would lose one's change. Readers never take it.
+_WRITE_LOCK = threading.Lock()
+
+def apply_delta(carts=(), products=(), orders=(), order_items=(), snap=None):
+    '''
+    Merge changed records (already converted to the load_data structure) into
+    the published snapshot and its indexes in place, without reloading anything.
+    Every index entry is swapped with a single assignment, so a request running
+    concurrently sees either the old or the new entry. Writers hold _WRITE_LOCK.
+    '''
+    snap = snap or _SNAPSHOT
+    with _WRITE_LOCK:
+        _apply_delta(snap, carts, products, orders, order_items)
+
+def _apply_delta(snap, carts, products, orders, order_items):
+    for product in products:
+        _upsert_product(snap, product)
+    if products and snap.product_arrays is not None:
+        snap.product_arrays = encode_products(snap.products)
+    for order in orders:
+        snap.orders.upsert_order(order)
+    revenue_changed = False
+    for order_item in order_items:
+        if order_item['order_id'] in snap.orders.order_row:
+            _upsert_order_item(snap, order_item)
+            revenue_changed = True
+    if revenue_changed:
+        # the ranking is nearly sorted already, so this is close to linear
+        snap.best_ranking = rank_best_sellers(snap.revenue)
+    for cart in carts:
+        _upsert_cart(snap, cart)
+    snap.bump_version()
+
+def update_stock(changes, snap=None):
+    '''
+    Apply stock changes pushed by the backend ({"product_id", "stock" and/or
+    "available"}) to the published snapshot in place, without waiting for a sync.
+        - stock / available are set on the product's dict (one assignment each)
+        - only when that flips the product's sellability does it join or leave
+          snap.sellable and its flower_type / color / occasion pools (one
+          ProductPool.put or drop per pool, like apply_delta)
+        - the numpy engine's arrays are patched at the product's position
+    Returns {"updated": [...], "flipped": [...], "unknown": [...]} product ids.
+    Holds _WRITE_LOCK, like apply_delta.
+    '''
+    snap = snap or _SNAPSHOT
+    with _WRITE_LOCK:
+        return _update_stock(snap, changes)
+
+def _update_stock(snap, changes):
+    result = {"updated": [], "flipped": [], "unknown": []}
+    for change in changes:
+        pid = change['product_id']
+        product = snap.product_by_id.get(pid)
+        if product is None:
+            result["unknown"].append(pid)
+            continue
+        old_keys = _product_keys(product)
+        for field in ('stock', 'available'):
+            if field in change:
+                product[field] = change[field]
+        sellable = _product_sellable(product)
+        if sellable != (pid in snap.sellable):
+            if sellable:
+                snap.sellable.add(pid)
+            else:
+                snap.sellable.discard(pid)
+            _move_product(snap, product, old_keys, _product_keys(product))
+            result["flipped"].append(pid)
+        arrays = snap.product_arrays
+        pos = snap.product_pos[pid]
+        if arrays is not None and pos < len(arrays['index']):
+            arrays['available'][pos] = bool(product.get("available", True))
+            arrays['in_stock'][pos] = product.get("stock", 0) > 0
+            arrays['sellable'][pos] = sellable
+        result["updated"].append(pid)
+    if result["updated"]:
+        snap.bump_version()
+    return result
+
+def _since_params(since):
+    return {"updatedSince": since} if since else None
+
+def _changed_since(records, since):
+    if not since:
+        return list(records)
+    return [r for r in records if r.get("updatedAt", "") > since]
+
+def sync_delta(max_workers=None):
+    '''
+    Fetch the records updated since the snapshot's high-water marks
+    (snap.sync_state) and merge them with apply_delta. The backend gets the mark
+    as updatedSince; records are filtered here as well, so a backend that ignores
+    it costs bandwidth only. Returns how many records were merged per collection.
+    '''
+    # a reload during the sync drops these patches along with the old snapshot,
+    # and the new snapshot brings its own marks, so nothing is skipped
+    snap = _SNAPSHOT
+    since = dict(snap.sync_state)
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        carts_job = pool.submit(CartApi.get_all, _since_params(since.get('carts')))
+        products_job = pool.submit(get_all_products, max_workers, _since_params(since.get('products')))
+        orders_job = pool.submit(OrderApi.get_all, _since_params(since.get('orders')))
+        changed = {
+            'carts': _changed_since(carts_job.result(), since.get('carts')),
+            'products': _changed_since(products_job.result(), since.get('products')),
+            'orders': _changed_since(orders_job.result(), since.get('orders')),
+        }
 
-# also guard the demo print so it doesn't run on import
+    if any(changed.values()):
+        new_orders, new_order_items = conver_orders(changed['orders'])
+        apply_delta(
+            carts=convert_carts(changed['carts']),
+            products=convert_products(products=changed['products']),
+            orders=new_orders,
+            order_items=new_order_items,
+            snap=snap,
+        )
+        for collection, records in changed.items():
+            _advance_watermark(collection, records, snap.sync_state)
+    return {collection: len(records) for collection, records in changed.items()}
+
+# Importing this module does no I/O; callers (rec_sever, scripts) call load_data()
 if __name__ == "__main__":
+    load_data()
     print(rec_user_converter('68b192b6f62f87ee1a7f23ae'))
@@ -0,0 +1,81 @@
+"""
+Response bodies for recommendations, shared by every path that produces one
+(rec_sever's live path and result cache, precompute.py's store), so the same
+results always give the same bytes and the same ETag whichever path served
+them: sorted keys, compact separators, a trailing newline.
+"""
+import hashlib
+import json
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:  # optional: faster encoding, json is used without it
+    orjson = None
+
+
+def dumps(value: Any) -> bytes:
+    # sorted keys, compact: the same bytes as jsonify for ASCII text (orjson leaves non-ASCII unescaped)
+    if orjson is not None:
+        return orjson.dumps(value, option=orjson.OPT_SORT_KEYS)
+    return json.dumps(value, sort_keys=True, separators=(",", ":")).encode("utf-8")
+
+def etag(body: bytes) -> str:
+    return hashlib.sha1(body).hexdigest()[:20]
+
+def product_card(product: Dict[str, Any]) -> Dict[str, Any]:
+    images = product.get("image_url") or []
+    return {
+        "product_id": product["product_id"],
+        "name": product.get("name", ""),
+        "price": product.get("price", 0),
+        "image": images[0] if images else "",
+    }
+
+class ProductFragments:
+    """
+    Serialized product cards (product_card) for ?expand= responses, built once
+    per data version and spliced into response bodies as they are. A reload or
+    delta sync bumps the version, which starts a new set; a request still on an
+    older snapshot gets fresh fragments without resetting the current ones.
+    `version` is the one the request read before building its response (it
+    defaults to snap.version): apply_delta and update_stock bump the version of
+    the same snapshot object, so reading it again later could file fragments of
+    older data under a newer version.
+    """
+    def __init__(self):
+        self._current: Tuple[int, Dict[str, bytes]] = (0, {})
+
+    def get(self, snap, product_id: str, version: Optional[int] = None) -> bytes:
+        version = snap.version if version is None else version
+        current, fragments = self._current
+        if version != current:
+            fragments = {}
+            if version > current:
+                self._current = (version, fragments)
+        fragment = fragments.get(product_id)
+        if fragment is None:
+            product = snap.product_by_id.get(product_id)
+            fragment = fragments[product_id] = dumps(product_card(product)) if product else b"null"
+        return fragment
+
+product_fragments = ProductFragments()
+
+def results_body(results: List[Dict[str, Any]], snap=None, expand: bool = False,
+                 version: Optional[int] = None) -> bytes:
+    '''
+    Response body for the recommendation dicts, byte for byte what jsonify
+    writes. With expand (needs snap), every dict also gets "product": the card
+    of its product_id (null when empty or unknown), so the storefront needs no
+    ProductApi.get_by_id call per result. version: see ProductFragments.
+    '''
+    if not expand:
+        return dumps(list(results)) + b"\n"
+    version = snap.version if version is None else version
+    parts = []
+    for result in results:
+        encoded = dumps(result)
+        # keys are sorted and "product" comes right before "product_id", which every result has
+        i = encoded.index(b'"product_id":')
+        parts.append(encoded[:i] + b'"product":' + product_fragments.get(snap, result.get("product_id", ""), version) + b"," + encoded[i:])
+    return b"[" + b",".join(parts) + b"]\n"
@@ -0,0 +1,202 @@
+"""
+Snapshot extraction, run separately from the server.
+
+Fetches carts, products and orders from the backend, converts them to the
+structure recommendation.load_data expects and writes them to REC_DATA_PATH.
+
+    python snapshot.py                 # write to REC_DATA_PATH (default ./data.json)
+    python snapshot.py --out data.json
+    python snapshot.py --api-base http://localhost:5001 --workers 8
+    python snapshot.py --binary --out data.bin       # binary snapshot, memory-mapped by load_data
+    python snapshot.py --binary                      # next to REC_DATA_PATH, with .bin (data.bin)
+    python snapshot.py --from-json data.json --out data.bin  # convert an existing JSON snapshot
+
+A binary snapshot (recommendation.write_binary_snapshot) is loaded with mmap
+instead of json.load: no parse at startup, and every worker process serving
+the same file shares its order data pages. Point REC_DATA_PATH at it.
+"""
+import argparse
+import os
+import threading
+import time
+
+import metrics
+import recommendation as rec
+
+SYNC_SECONDS = metrics.Histogram("rec_sync_seconds", "Duration of delta sync runs",
+                                 buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0))
+SYNC_FAILURES = metrics.Counter("rec_sync_failures_total", "Delta sync runs that failed")
+RELOAD_FAILURES = metrics.Counter("rec_reload_failures_total", "Hot reloads that failed and kept the previous snapshot")
+
+log = metrics.json_logger("snapshot", os.environ.get("REC_LOG_LEVEL", "INFO"))
+
+
+def refresh_snapshot(data_path=None, budget=None, binary=None):
+    '''
+    Run the extraction and write the snapshot.
+        - budget: seconds to wait for the backend. If it is exceeded (or the
+          fetch fails) the previous snapshot is left untouched and False is returned.
+        - binary: write a binary snapshot (extract_to_binary) instead of JSON;
+          data_path then defaults to binary_path(rec.DATA_PATH), never the JSON one.
+          None (the default): whichever format data_path has, binary when it is a
+          binary snapshot or a new .bin file (binary_path), so REC_EXTRACT_ON_START
+          with REC_DATA_PATH=data.bin refreshes data.bin in place
+    '''
+    if data_path is None:
+        data_path = binary_path(rec.DATA_PATH) if binary else rec.DATA_PATH
+    if binary is None:
+        binary = binary_path(data_path) == str(data_path)
+    extract = rec.extract_to_binary if binary else rec.extract_to_json
+    started = time.perf_counter()
+    outcome = {}
+
+    def run():
+        try:
+            outcome['path'] = extract(data_path)
+        except Exception as e:
+            outcome['error'] = e
+
+    # daemon thread: a hung backend can't keep the process alive past the budget
+    worker = threading.Thread(target=run, name="snapshot-extract", daemon=True)
+    worker.start()
+    worker.join(budget)
+    elapsed = time.perf_counter() - started
+
+    if worker.is_alive():
+        log.warning("extraction exceeded its budget, keeping the previous snapshot",
+                    extra={"fields": {"budget_s": budget, "path": str(data_path)}})
+        return False
+    if 'error' in outcome:
+        log.error("extraction failed, keeping the previous snapshot", extra={"fields": {
+            "error": str(outcome['error']), "seconds": round(elapsed, 1), "path": str(data_path),
+        }})
+        return False
+    timings = {f"{name}_s": round(value, 2) for name, value in rec.FETCH_TIMINGS.items()}
+    log.info("snapshot written", extra={"fields": {
+        "path": str(outcome['path']), "seconds": round(elapsed, 1),
+        "product_pages": rec.FETCH_COUNTS.get('product_pages', 0), **timings,
+    }})
+    return True
+
+
+def binary_path(data_path):
+    '''
+    Default path of a binary snapshot for data_path: data_path itself when it
+    is one (or does not exist yet and ends in .bin), else the same name with
+    .bin, so a JSON snapshot is never overwritten with the binary format.
+    '''
+    data_path = str(data_path)
+    root, ext = os.path.splitext(data_path)
+    if os.path.exists(data_path):
+        if rec.is_binary_snapshot(data_path):
+            return data_path
+    elif ext == ".bin":
+        return data_path
+    return root + ".bin" if ext != ".bin" else data_path + ".bin"
+
+
+def convert_to_binary(json_path, out_path):
+    '''Write the binary form of an existing JSON snapshot (sync watermarks included).'''
+    started = time.perf_counter()
+    snap = rec.build_snapshot(json_path)
+    rec.write_binary_snapshot(snap, out_path)
+    log.info("snapshot converted", extra={"fields": {
+        "from": str(json_path), "from_mib": round(os.path.getsize(json_path) / 2**20, 1),
+        "path": str(out_path), "mib": round(os.path.getsize(out_path) / 2**20, 1),
+        "seconds": round(time.perf_counter() - started, 1),
+    }})
+    return out_path
+
+
+def start_sync_loop(interval):
+    '''
+    Run rec.sync_delta every `interval` seconds in a daemon thread, merging
+    records changed since the last run into the loaded data.
+    '''
+    def run():
+        while True:
+            time.sleep(interval)
+            started = time.perf_counter()
+            try:
+                merged = rec.sync_delta()
+            except Exception as e:
+                SYNC_FAILURES.inc()
+                log.error("delta sync failed, will retry", extra={"fields": {"error": str(e), "retry_in_s": interval}})
+                continue
+            SYNC_SECONDS.observe(time.perf_counter() - started)
+            if any(merged.values()):
+                log.info("delta sync merged", extra={"fields": {
+                    "merged": merged, "ms": round((time.perf_counter() - started) * 1000),
+                }})
+
+    worker = threading.Thread(target=run, name="delta-sync", daemon=True)
+    worker.start()
+    return worker
+
+
+def _file_signature(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def start_reload_watcher(data_path=None, interval=5.0, force_every=None):
+    '''
+    Hot reload: poll the snapshot file every `interval` seconds and rebuild the
+    dataset in this background thread when it changes (or every `force_every`
+    seconds regardless). rec.load_data builds the new Snapshot off the request
+    path and swaps it in with one assignment, so requests never wait on it.
+    '''
+    data_path = str(data_path or rec.DATA_PATH)
+
+    def run():
+        seen = _file_signature(data_path)
+        last_load = time.monotonic()
+        while True:
+            time.sleep(interval)
+            current = _file_signature(data_path)
+            due = force_every is not None and time.monotonic() - last_load >= force_every
+            if current is None or (current == seen and not due):
+                continue
+            try:
+                stats = rec.load_data(data_path)
+            except Exception as e:
+                # typically a snapshot caught mid-write by a non-atomic writer; retry next tick
+                RELOAD_FAILURES.inc()
+                log.error("reload failed, keeping the loaded snapshot", extra={"fields": {
+                    "error": str(e), "data_version": rec.current_snapshot().version,
+                }})
+                continue
+            seen, last_load = current, time.monotonic()
+            log.info("data reloaded", extra={"fields": {
+                "data_version": stats['version'], "build_ms": round(stats['build_seconds'] * 1000, 1),
+                "swap_us": round(stats['swap_seconds'] * 1e6, 1),
+            }})
+
+    worker = threading.Thread(target=run, name="snapshot-reload", daemon=True)
+    worker.start()
+    return worker
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract a recommendation data snapshot from the backend")
+    parser.add_argument("--out", default=None,
+                        help="output path (default: REC_DATA_PATH or ./data.json; with --binary, that path with .bin)")
+    parser.add_argument("--budget", type=float, default=None, help="give up after this many seconds")
+    parser.add_argument("--api-base", default=None, help="backend base URL (default: REC_API_BASE)")
+    parser.add_argument("--workers", type=int, default=None, help="concurrent requests (default: REC_FETCH_WORKERS)")
+    parser.add_argument("--binary", action="store_true", help="write a binary snapshot instead of JSON")
+    parser.add_argument("--from-json", default=None, metavar="PATH",
+                        help="convert this JSON snapshot to a binary one instead of fetching (default --out: PATH with .bin)")
+    args = parser.parse_args()
+    if args.from_json:
+        convert_to_binary(args.from_json, args.out or binary_path(args.from_json))
+        raise SystemExit(0)
+    if args.api_base:
+        rec.API_BASE = args.api_base.rstrip("/")
+    if args.workers:
+        rec.FETCH_WORKERS = args.workers
+    # without --binary, the format follows --out (a .bin path gets a binary snapshot)
+    raise SystemExit(0 if refresh_snapshot(args.out, args.budget, args.binary or None) else 1)